@@ -0,0 +1,182 @@
+from math import exp
+from numpy import arange
+from numpy import array
+from numpy import float64
+from numpy import full
+from numpy import int64
+from numpy import zeros
+from os import getenv
+from threading import Lock
+from time import time
+
+
+AGGREGATE_WINDOWS = {"5m": 5 * 60, "1h": 60 * 60, "1d": 24 * 60 * 60}
+AGGREGATE_BUCKETS = 60
+AGGREGATE_EWMA_TAU_S = float(getenv("AGGREGATE_EWMA_TAU_S", str(60 * 60)))
+
+
+class TickerWindows:
+    """Mention counts and sentiment sums for one ticker over each window,
+    kept in ring buffers of time buckets.
+
+    Each window is split into AGGREGATE_BUCKETS buckets. A slot holds the
+    bucket whose ID it was last written with and is reset when a newer
+    bucket lands on it, so adding a result touches one slot per window and
+    reading a window sums a fixed number of slots, however much history
+    there is.
+
+    The moving average keeps a sum of sentiments and a sum of weights,
+    both decayed by exp(-dt / ewma_tau_s) as time moves on, so every
+    result counts, including results that arrive at the same instant.
+    """
+
+    def __init__(
+        self, widths, buckets=AGGREGATE_BUCKETS, ewma_tau_s=AGGREGATE_EWMA_TAU_S
+    ):
+
+        self.widths = array(widths, dtype=float64) / buckets
+        self.buckets = buckets
+        self.rows = arange(len(widths))
+        self.bucket_ids = full((len(widths), buckets), -1, dtype=int64)
+        self.counts = zeros((len(widths), buckets), dtype=int64)
+        self.sums = zeros((len(widths), buckets), dtype=float64)
+        self.ewma_tau_s = ewma_tau_s
+        self.ewma_sum = 0.0
+        self.ewma_weight = 0.0
+        self.ewma_at = None
+
+    def add(self, sentiment, timestamp):
+        """Adds one result. Results older than a window are left out of
+        it.
+        """
+
+        bucket_ids = (timestamp // self.widths).astype(int64)
+        slots = bucket_ids % self.buckets
+        current = self.bucket_ids[self.rows, slots]
+        reset = current < bucket_ids
+        self.counts[self.rows[reset], slots[reset]] = 0
+        self.sums[self.rows[reset], slots[reset]] = 0.0
+        self.bucket_ids[self.rows[reset], slots[reset]] = bucket_ids[reset]
+        keep = current <= bucket_ids
+        self.counts[self.rows[keep], slots[keep]] += 1
+        self.sums[self.rows[keep], slots[keep]] += sentiment
+
+        if self.ewma_at is None:
+            self.ewma_at = timestamp
+        if timestamp >= self.ewma_at:
+            decay = exp(-(timestamp - self.ewma_at) / self.ewma_tau_s)
+            self.ewma_sum = self.ewma_sum * decay + sentiment
+            self.ewma_weight = self.ewma_weight * decay + 1
+            self.ewma_at = timestamp
+        else:
+            weight = exp(-(self.ewma_at - timestamp) / self.ewma_tau_s)
+            self.ewma_sum += weight * sentiment
+            self.ewma_weight += weight
+
+    def get_ewma(self):
+        """Returns the moving average of the sentiment, or None if there
+        are no results.
+        """
+
+        if not self.ewma_weight:
+
+            return None
+
+        return self.ewma_sum / self.ewma_weight
+
+    def get_window(self, row, now):
+        """Returns the count, mean sentiment and momentum of a window. The
+        momentum is the mean sentiment of its newer half minus that of its
+        older half, or None unless both halves have results.
+        """
+
+        newest = int(now // self.widths[row])
+        age = newest - self.bucket_ids[row]
+        live = (age >= 0) & (age < self.buckets)
+        newer = live & (age < self.buckets // 2)
+        older = live & ~newer
+
+        counts = self.counts[row]
+        sums = self.sums[row]
+        newer_mean = get_mean(sums, counts, newer)
+        older_mean = get_mean(sums, counts, older)
+        momentum = None
+        if newer_mean is not None and older_mean is not None:
+            momentum = newer_mean - older_mean
+
+        return {
+            "count": int(counts[live].sum()),
+            "mean_sentiment": get_mean(sums, counts, live),
+            "momentum": momentum,
+        }
+
+
+def get_mean(sums, counts, mask):
+    """Returns the mean sentiment of the masked slots, or None if they
+    are empty.
+    """
+
+    count = counts[mask].sum()
+    if not count:
+
+        return None
+
+    return float(sums[mask].sum() / count)
+
+
+class SignalAggregates:
+    """Rolling per-ticker signals: mention counts, mean sentiment and
+    momentum over AGGREGATE_WINDOWS, plus an exponentially weighted moving
+    average of the sentiment.
+    """
+
+    def __init__(self, windows=AGGREGATE_WINDOWS):
+
+        self.names = list(windows)
+        self.widths = [windows[name] for name in self.names]
+        self.tickers = {}
+        self.lock = Lock()
+
+    def add(self, companies, timestamp=None):
+        """Adds the sentiment of each company's ticker."""
+
+        timestamp = timestamp or time()
+        with self.lock:
+            for company in companies:
+                ticker = company.get("ticker")
+                sentiment = company.get("sentiment")
+                if not ticker or sentiment is None:
+
+                    continue
+
+                windows = self.tickers.get(ticker)
+                if not windows:
+                    windows = self.tickers[ticker] = TickerWindows(self.widths)
+                windows.add(sentiment, timestamp)
+
+    def get(self, ticker, now=None):
+        """Returns the aggregates of a ticker, or None if it was never
+        seen.
+        """
+
+        now = now or time()
+        with self.lock:
+            windows = self.tickers.get(ticker)
+            if not windows:
+
+                return None
+
+            return {
+                "ticker": ticker,
+                "ewma_sentiment": windows.get_ewma(),
+                "windows": {
+                    name: windows.get_window(row, now)
+                    for row, name in enumerate(self.names)
+                },
+            }
+
+    def get_tickers(self):
+        """Returns every ticker seen so far."""
+
+        with self.lock:
+            return sorted(self.tickers)
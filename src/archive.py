@@ -0,0 +1,300 @@
+from glob import glob
+from mmap import ACCESS_READ
+from mmap import mmap
+from os import getenv
+from os import makedirs
+from os import remove
+from os.path import getmtime
+from os.path import getsize
+from os.path import join
+from queue import Empty
+from queue import Queue
+from re import compile
+from struct import Struct
+from threading import Thread
+from time import monotonic
+from time import sleep
+from time import time
+from zlib import compress
+from zlib import decompress
+
+from logs import report_error
+
+
+ARCHIVE_DIR = getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_BLOCK_BYTES = 256 * 1024
+ARCHIVE_SEGMENT_BYTES = int(getenv("ARCHIVE_SEGMENT_BYTES", str(256 * 1024 * 1024)))
+ARCHIVE_RETENTION_S = float(getenv("ARCHIVE_RETENTION_S", str(7 * 24 * 60 * 60)))
+ARCHIVE_FLUSH_S = 1.0
+SEGMENT_NAME = "segment-%015d"
+# Block header: compressed length.
+BLOCK_HEADER = Struct("<I")
+# Record header: tweet ID, received at, payload length.
+RECORD_HEADER = Struct("<QdI")
+# Index entry: lowest and highest tweet ID, first and last received at,
+# block offset in the segment.
+INDEX_ENTRY = Struct("<QQddQ")
+TWEET_ID_PATTERN = compile(rb'"id":\s*(\d+)')
+
+
+def get_tweet_id(data):
+    """Returns the ID of the tweet in a raw payload without parsing it,
+    or 0 for payloads that are not tweets.
+    """
+
+    match = TWEET_ID_PATTERN.search(data)
+    if not match:
+
+        return 0
+
+    return int(match.group(1))
+
+
+class Archiver:
+    """Appends raw stream payloads to compressed segment files.
+
+    Payloads are buffered into blocks of about ARCHIVE_BLOCK_BYTES, and
+    each block is compressed on its own, so reading one tweet means
+    decompressing one block. For every block a fixed-size entry with its
+    tweet ID and time range and its offset is appended to the segment's
+    index file. A new segment is started once one reaches
+    ARCHIVE_SEGMENT_BYTES, and segments last written more than
+    retention_s ago are deleted then, unless retention_s is 0. append()
+    only queues the payload, and a background thread does the compressing
+    and writing. A block that fails to write is reported and dropped, and
+    the next one starts a new segment.
+    """
+
+    def __init__(
+        self,
+        directory=ARCHIVE_DIR,
+        block_bytes=ARCHIVE_BLOCK_BYTES,
+        segment_bytes=ARCHIVE_SEGMENT_BYTES,
+        flush_s=ARCHIVE_FLUSH_S,
+        retention_s=ARCHIVE_RETENTION_S,
+    ):
+
+        self.directory = directory
+        self.block_bytes = block_bytes
+        self.segment_bytes = segment_bytes
+        self.flush_s = flush_s
+        self.retention_s = retention_s
+        self.queue = Queue()
+        self.segment = None
+        self.index = None
+        makedirs(directory, exist_ok=True)
+        self.thread = Thread(target=self.write_queue)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, data, received_at=None):
+        """Queues a raw payload for archiving."""
+
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        self.queue.put((data, received_at or time()))
+
+    def close(self):
+        """Writes everything still queued and stops the writer thread."""
+
+        self.queue.put(None)
+        self.thread.join()
+
+    def write_queue(self):
+        """Writes queued payloads in blocks until closed."""
+
+        block = []
+        size = 0
+        flush_at = monotonic() + self.flush_s
+        while True:
+            try:
+                item = self.queue.get(timeout=max(flush_at - monotonic(), 0))
+            except Empty:
+                item = False
+
+            if item:
+                block.append(item)
+                size += len(item[0]) + RECORD_HEADER.size
+
+            if block and (not item or size >= self.block_bytes):
+                try:
+                    self.write_block(block)
+                except OSError:
+                    report_error("Archiving a block failed", payloads=len(block))
+                    self.close_segment()
+                block = []
+                size = 0
+
+            if not item:
+                flush_at = monotonic() + self.flush_s
+
+            if item is None:
+                self.close_segment()
+
+                return
+
+    def write_block(self, block):
+        """Compresses and appends a block, then records it in the index."""
+
+        if not self.segment or self.segment.tell() >= self.segment_bytes:
+            self.open_segment(block[0][1])
+
+        records = []
+        tweet_ids = []
+        for data, received_at in block:
+            tweet_id = get_tweet_id(data)
+            if tweet_id:
+                tweet_ids.append(tweet_id)
+            records.append(RECORD_HEADER.pack(tweet_id, received_at, len(data)))
+            records.append(data)
+
+        compressed = compress(b"".join(records))
+        offset = self.segment.tell()
+        self.segment.write(BLOCK_HEADER.pack(len(compressed)))
+        self.segment.write(compressed)
+        self.segment.flush()
+        self.index.write(
+            INDEX_ENTRY.pack(
+                min(tweet_ids, default=0),
+                max(tweet_ids, default=0),
+                block[0][1],
+                block[-1][1],
+                offset,
+            )
+        )
+        self.index.flush()
+
+    def open_segment(self, started_at):
+
+        self.close_segment()
+        self.purge()
+        name = join(self.directory, SEGMENT_NAME % int(started_at * 1000))
+        self.segment = open("%s.arc" % name, "ab")
+        self.index = open("%s.idx" % name, "ab")
+
+    def close_segment(self):
+
+        segment, index = self.segment, self.index
+        self.segment = self.index = None
+        for handle in [segment, index]:
+            try:
+                if handle:
+                    handle.close()
+            except OSError:
+                report_error("Closing an archive segment failed", path=handle.name)
+
+    def purge(self):
+        """Deletes the segments last written before the retention."""
+
+        if not self.retention_s:
+
+            return
+
+        cutoff = time() - self.retention_s
+        for name in ArchiveReader(self.directory).get_segments():
+            try:
+                if getmtime("%s.arc" % name) < cutoff:
+                    remove("%s.arc" % name)
+                    remove("%s.idx" % name)
+            except OSError:
+                report_error("Deleting an archive segment failed", segment=name)
+
+
+class ArchiveReader:
+    """Finds and replays archived payloads by tweet ID or time.
+
+    Only the index files are read up front. Segments are memory-mapped
+    and just the blocks whose index entry can hold a match are
+    decompressed.
+    """
+
+    def __init__(self, directory=ARCHIVE_DIR):
+
+        self.directory = directory
+
+    def get_segments(self):
+        """Returns the segment names, oldest first."""
+
+        paths = glob(join(self.directory, "segment-*.idx"))
+
+        return sorted(path[: -len(".idx")] for path in paths)
+
+    def get_index(self, name):
+        """Returns the index entries of a segment."""
+
+        with open("%s.idx" % name, "rb") as index:
+            data = index.read()
+
+        size = len(data) - len(data) % INDEX_ENTRY.size
+
+        return list(INDEX_ENTRY.iter_unpack(data[:size]))
+
+    def find_blocks(self, matches):
+        """Yields the records of every block whose index entry matches."""
+
+        for name in self.get_segments():
+            offsets = [entry[4] for entry in self.get_index(name) if matches(entry)]
+            if not offsets or not getsize("%s.arc" % name):
+
+                continue
+
+            with open("%s.arc" % name, "rb") as segment_file:
+                with mmap(segment_file.fileno(), 0, access=ACCESS_READ) as segment:
+                    for offset in offsets:
+                        yield from read_block(segment, offset)
+
+    def get(self, tweet_id):
+        """Returns the archived payload of a tweet, or None."""
+
+        tweet_id = int(tweet_id)
+        blocks = self.find_blocks(lambda entry: entry[0] <= tweet_id <= entry[1])
+        for record_id, _, data in blocks:
+            if record_id == tweet_id:
+
+                return data
+
+        return None
+
+    def get_range(self, start, end):
+        """Yields (tweet ID, received at, payload) for everything received
+        between the start and end times, in order.
+        """
+
+        blocks = self.find_blocks(lambda entry: entry[2] <= end and entry[3] >= start)
+        for record in blocks:
+            if start <= record[1] <= end:
+                yield record
+
+    def replay(self, start, end, listener, speed=None):
+        """Feeds archived payloads to a stream listener's on_data. With a
+        speed, the original gaps between payloads are kept, divided by it.
+        """
+
+        previous = None
+        replayed = 0
+        for _, received_at, data in self.get_range(start, end):
+            if speed and previous is not None:
+                sleep(max(received_at - previous, 0) / speed)
+            previous = received_at
+            if listener.on_data(data.decode("utf-8")) is False:
+
+                break
+
+            replayed += 1
+
+        return replayed
+
+
+def read_block(segment, offset):
+    """Decompresses the block at the offset and yields its records."""
+
+    (length,) = BLOCK_HEADER.unpack_from(segment, offset)
+    start = offset + BLOCK_HEADER.size
+    data = decompress(segment[start : start + length])
+    position = 0
+    while position < len(data):
+        tweet_id, received_at, size = RECORD_HEADER.unpack_from(data, position)
+        position += RECORD_HEADER.size
+        yield tweet_id, received_at, data[position : position + size]
+        position += size
@@ -0,0 +1,145 @@
+from concurrent.futures import ThreadPoolExecutor
+from json import dump
+from json import dumps
+from json import load
+from os import getenv
+from os import replace
+from os.path import exists
+from tqdm import tqdm
+
+
+BACKFILL_WORKERS = int(getenv("BACKFILL_WORKERS", "20"))
+BACKFILL_OUTPUT = "backfill.jsonl"
+BACKFILL_STATE = "backfill-state.json"
+BACKFILL_BATCH_SIZE = int(getenv("BACKFILL_BATCH_SIZE", "20"))
+
+
+class Backfill:
+    """Pushes historical timelines through the company and sentiment
+    analysis.
+
+    Timeline pages are fetched lazily and the tweets on each page are
+    analyzed concurrently, while the next page is being fetched. The
+    upstream limiters keep the workers under quota. Results are appended to
+    a JSON lines file as each page finishes, and the oldest ID reached per
+    account is saved alongside, so an interrupted run resumes from the last
+    finished page. A page that was written but not yet recorded when the
+    run stopped is analyzed again. The progress is kept along with the
+    since_id it was made for, and an account is backfilled from the start
+    again when run with a different one.
+
+    Given a BatchAnnotator, tweets are analyzed batch_size at a time with
+    their texts packed into shared Natural Language documents.
+    """
+
+    def __init__(
+        self,
+        checker,
+        twitter,
+        output_path=BACKFILL_OUTPUT,
+        state_path=BACKFILL_STATE,
+        workers=BACKFILL_WORKERS,
+        annotator=None,
+        batch_size=BACKFILL_BATCH_SIZE,
+    ):
+
+        self.checker = checker
+        self.twitter = twitter
+        self.output_path = output_path
+        self.state_path = state_path
+        self.workers = workers
+        self.annotator = annotator
+        self.batch_size = batch_size if annotator else 1
+        self.state = self.load_state()
+
+    def load_state(self):
+        """Reads the per-account progress, if there is any."""
+
+        if not exists(self.state_path):
+
+            return {}
+
+        with open(self.state_path) as state_file:
+            return load(state_file)
+
+    def save_state(self):
+        """Writes the per-account progress atomically."""
+
+        temp_path = "%s.tmp" % self.state_path
+        with open(temp_path, "w") as state_file:
+            dump(self.state, state_file)
+        replace(temp_path, self.state_path)
+
+    def run(self, accounts, since_id=None):
+        """Backfills each account's timeline back to, but not including,
+        since_id.
+        """
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            with open(self.output_path, "a") as output:
+                for account in accounts:
+                    self.run_account(account, since_id, executor, output)
+
+    def run_account(self, account, since_id, executor, output):
+        """Backfills one account, resuming where the last run stopped."""
+
+        progress = self.state.get(account)
+        if not progress or progress.get("since_id") != since_id:
+            progress = {"max_id": None, "done": False, "since_id": since_id}
+            self.state[account] = progress
+        if progress["done"]:
+
+            return
+
+        pages = self.twitter.get_timeline_pages(
+            account, since_id=since_id, max_id=progress["max_id"]
+        )
+        with tqdm(desc=account, unit="tweets") as bar:
+            pending = None
+            size = self.batch_size
+            for page in pages:
+                futures = [
+                    executor.submit(self.analyze, page[start : start + size])
+                    for start in range(0, len(page), size)
+                ]
+                if pending:
+                    self.finish_page(account, pending, output, bar)
+                pending = (page, futures)
+
+            if pending:
+                self.finish_page(account, pending, output, bar)
+
+        progress["done"] = True
+        self.save_state()
+
+    def finish_page(self, account, pending, output, bar):
+        """Writes the results of a page and records the progress."""
+
+        page, futures = pending
+        for future in futures:
+            for result in future.result():
+                output.write("%s\n" % dumps(result))
+        output.flush()
+
+        progress = self.state[account]
+        progress["max_id"] = str(page[-1]["id"] - 1)
+        self.save_state()
+        bar.update(len(page))
+
+    def analyze(self, tweets):
+        """Returns the analysis results for a list of tweets."""
+
+        if self.annotator:
+            results = self.annotator.search_companies(tweets)
+        else:
+            results = [self.checker.search_company_intweet(tweet) for tweet in tweets]
+
+        return [
+            {
+                "id_str": tweet.get("id_str"),
+                "created_at": tweet.get("created_at"),
+                "account": tweet.get("user", {}).get("id_str"),
+                "companies": [dict(company) for company in companies or []],
+            }
+            for tweet, companies in zip(tweets, results)
+        ]
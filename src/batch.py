@@ -0,0 +1,131 @@
+from os import getenv
+from time import monotonic
+
+from logs import report_error
+from records import Entity
+from sentiment import get_language
+from sentiment import NL_ENTITIES
+from sentiment import TWEET_DEADLINE_S
+
+
+BATCH_DOCUMENT_CHARS = int(getenv("BATCH_DOCUMENT_CHARS", "1000"))
+BATCH_SEPARATOR = "\n\n"
+
+
+class BatchAnnotator:
+    """Analyzes many tweets with one Natural Language request per packed
+    document.
+
+    Tweet texts are joined into documents of up to max_chars characters,
+    the size of one billing unit, and each document is sent as a single
+    annotateText request for both entities and sentiment. Entity mentions
+    and sentences are mapped back to their tweets by character offset. A
+    tweet's sentiment is the mean score of its sentences, which is close
+    to, but not always equal to, the document score of a single-tweet
+    request. The tweets of a document whose request fails are analyzed
+    one at a time instead.
+    """
+
+    def __init__(self, checker, max_chars=BATCH_DOCUMENT_CHARS):
+
+        self.checker = checker
+        self.max_chars = max_chars
+
+    def search_companies(self, tweets):
+        """Returns, for each tweet, the companies search_company_intweet
+        would find, or None where it would return None.
+        """
+
+        results = [None] * len(tweets)
+        texts = []
+        for index, tweet in enumerate(tweets):
+            text = self.checker.get_longtext(tweet)
+            if text:
+                texts.append((index, text))
+
+        for content, spans in self.pack(texts):
+            try:
+                response = self.annotate(content)
+            except Exception:
+                report_error("Batch annotation failed", tweets=len(spans))
+                for index, _, _ in spans:
+                    results[index] = self.checker.search_company_intweet(
+                        tweets[index]
+                    )
+
+                continue
+
+            for index, entities, sentiment in self.split(response, spans):
+                deadline = monotonic() + TWEET_DEADLINE_S
+                results[index], _ = self.checker.find_companies(
+                    entities, lambda sentiment=sentiment: sentiment, deadline
+                )
+
+        return results
+
+    def pack(self, texts):
+        """Packs (index, text) pairs into documents. Returns a list of the
+        document contents with the (index, begin, end) span of each text.
+        """
+
+        documents = []
+        parts = []
+        spans = []
+        size = 0
+        for index, text in texts:
+            begin = size + len(BATCH_SEPARATOR) if parts else 0
+            if parts and begin + len(text) > self.max_chars:
+                documents.append((BATCH_SEPARATOR.join(parts), spans))
+                parts = []
+                spans = []
+                begin = 0
+
+            parts.append(text)
+            spans.append((index, begin, begin + len(text)))
+            size = begin + len(text)
+
+        if parts:
+            documents.append((BATCH_SEPARATOR.join(parts), spans))
+
+        return documents
+
+    def annotate(self, content):
+        """Requests entities and sentiment for a document, with offsets in
+        code points so they match Python string indices.
+        """
+
+        language = get_language()
+        document = language.types.Document(
+            content=content,
+            type=language.enums.Document.Type.PLAIN_TEXT,
+            language="en",
+        )
+        features = language.types.AnnotateTextRequest.Features(
+            extract_entities=True, extract_document_sentiment=True
+        )
+
+        return NL_ENTITIES.call(
+            self.checker.language_client.annotate_text,
+            document,
+            features,
+            encoding_type=language.enums.EncodingType.UTF32,
+        )
+
+    def split(self, response, spans):
+        """Yields the index, entities and sentiment of each packed text."""
+
+        for index, begin, end in spans:
+            entities = []
+            for entity in response.entities:
+                offsets = [mention.text.begin_offset for mention in entity.mentions]
+                if any(begin <= offset < end for offset in offsets):
+                    entities.append(Entity.from_api(entity))
+
+            scores = [
+                sentence.sentiment.score
+                for sentence in response.sentences
+                if begin <= sentence.text.begin_offset < end
+            ]
+            sentiment = sum(scores) / len(scores) if scores else 0
+
+            yield index, entities, sentiment
@@ -0,0 +1,99 @@
+from concurrent.futures import Future
+from threading import Condition
+from time import monotonic
+
+
+class MicroBatcher:
+    """Collects keys requested by many threads over a short window and
+    resolves the unique set with one call.
+
+    The first thread to request a key in a new batch becomes its leader:
+    it waits up to max_wait_s, or until max_items keys are pending, then
+    resolves the whole batch on its own thread and fans the results out.
+    Other threads wait on their key's future. A key that is already
+    pending or being resolved is shared rather than requested again.
+    resolve_batch is called with the keys and the time left until the
+    latest deadline of the threads waiting on the batch, or None if one
+    of them waits without a timeout.
+    """
+
+    def __init__(self, resolve_batch, max_items, max_wait_s):
+
+        self.resolve_batch = resolve_batch
+        self.max_items = max_items
+        self.max_wait_s = max_wait_s
+        self.pending = {}
+        self.deadlines = []
+        self.in_flight = {}
+        self.condition = Condition()
+        self.batches = 0
+        self.keys = 0
+        self.requests = 0
+
+    def get(self, key, timeout=None):
+        """Returns the value for the key, resolved in a batch. Re-raises the
+        error the batch raised, and raises TimeoutError if the result does
+        not arrive within the timeout.
+        """
+
+        leader = False
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.condition:
+            self.requests += 1
+            future = self.in_flight.get(key) or self.pending.get(key)
+            if not future:
+                future = Future()
+                self.pending[key] = future
+                leader = len(self.pending) == 1
+                if len(self.pending) >= self.max_items:
+                    self.condition.notify_all()
+            if key in self.pending:
+                self.deadlines.append(deadline)
+
+        if leader:
+            self.lead()
+
+        return future.result(timeout)
+
+    def lead(self):
+        """Waits for the batch to fill up or time out, then resolves it."""
+
+        with self.condition:
+            self.condition.wait_for(
+                lambda: len(self.pending) >= self.max_items, self.max_wait_s
+            )
+            batch = self.pending
+            deadlines = self.deadlines
+            self.pending = {}
+            self.deadlines = []
+            self.in_flight.update(batch)
+            self.batches += 1
+            self.keys += len(batch)
+
+        timeout = None
+        if None not in deadlines:
+            timeout = max(max(deadlines) - monotonic(), 0)
+
+        try:
+            results = self.resolve_batch(list(batch), timeout)
+        except Exception as exception:
+            for future in batch.values():
+                future.set_exception(exception)
+        else:
+            for key, future in batch.items():
+                future.set_result(results.get(key))
+
+        finally:
+            with self.condition:
+                for key in batch:
+                    self.in_flight.pop(key, None)
+
+    def get_stats(self):
+        """Returns how many requests were folded into how many batches."""
+
+        with self.condition:
+            return {
+                "requests": self.requests,
+                "keys": self.keys,
+                "batches": self.batches,
+            }
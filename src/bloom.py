@@ -0,0 +1,265 @@
+from hashlib import blake2b
+from math import ceil
+from math import log
+from os import replace
+from struct import Struct
+from threading import Event
+from threading import Lock
+from threading import Thread
+from time import time
+
+from logs import report_error
+
+
+FILTER_SAVE_S = 60.0
+FILTER_MAGIC = b"NEG1"
+# File header: magic, bits and hashes per filter, then the start time and
+# key count of the current and the previous generation.
+FILTER_HEADER = Struct("<4sQIdQdQ")
+HASH_HALVES = Struct("<QQ")
+
+
+def get_filter_size(capacity, error_rate):
+    """Returns the bits and hash count of a Bloom filter that holds the
+    capacity in keys at about the false positive rate.
+    """
+
+    bits = ceil(-capacity * log(error_rate) / log(2) ** 2)
+    bits = (bits + 7) // 8 * 8
+    hashes = max(round(bits / capacity * log(2)), 1)
+
+    return bits, hashes
+
+
+class BloomFilter:
+    """A fixed-size set of strings that can answer with false positives
+    but never with false negatives.
+
+    Keys are hashed with BLAKE2 rather than hash(), so the bit positions
+    are the same in every process and the bytes can be saved and shared.
+    """
+
+    def __init__(self, bits, hashes, data=None, count=0):
+
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data else bytearray(bits // 8)
+        self.count = count
+
+    def get_positions(self, key):
+
+        digest = blake2b(key.encode("utf-8"), digest_size=HASH_HALVES.size).digest()
+        first, second = HASH_HALVES.unpack(digest)
+
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+
+        for position in self.get_positions(key):
+            self.data[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+
+        return all(
+            self.data[position >> 3] & (1 << (position & 7))
+            for position in self.get_positions(key)
+        )
+
+
+class NegativeFilter:
+    """Remembers keys that were looked up and had nothing, so they can be
+    skipped next time.
+
+    Keys go into the current of two Bloom filter generations, and a key is
+    known if either has it. Every rebuild_s, or sooner once the current
+    generation is at capacity, the previous generation is dropped and a new
+    one is started, so a key is forgotten after one to two rebuilds unless
+    it is added again. With a path, the filters are loaded from it on
+    start and saved back every save_s from a background thread.
+    """
+
+    def __init__(
+        self, capacity, error_rate, rebuild_s, path=None, save_s=FILTER_SAVE_S
+    ):
+
+        self.capacity = capacity
+        self.rebuild_s = rebuild_s
+        self.bits, self.hashes = get_filter_size(capacity, error_rate)
+        self.path = path
+        self.save_s = save_s
+        self.lock = Lock()
+        self.current = BloomFilter(self.bits, self.hashes)
+        self.previous = None
+        self.started_at = time()
+        self.previous_started_at = None
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self.stop_event = Event()
+        if path:
+            self.load()
+            self.thread = Thread(target=self.save_periodically)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def add(self, key):
+
+        with self.lock:
+            self.rebuild_if_due()
+            self.current.add(key)
+            self.changed = True
+
+    def __contains__(self, key):
+
+        with self.lock:
+            self.rebuild_if_due()
+            found = key in self.current or (
+                self.previous is not None and key in self.previous
+            )
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+            return found
+
+    def rebuild_if_due(self, now=None):
+        """Starts a new generation if the current one is too old or full.
+        Expects the lock to be held.
+        """
+
+        now = now or time()
+        if (
+            now - self.started_at < self.rebuild_s
+            and self.current.count < self.capacity
+        ):
+
+            return
+
+        if now - self.started_at < 2 * self.rebuild_s:
+            self.previous = self.current
+            self.previous_started_at = self.started_at
+        else:
+            self.previous = None
+            self.previous_started_at = None
+        self.current = BloomFilter(self.bits, self.hashes)
+        self.started_at = now
+        self.changed = True
+        self.rebuilds += 1
+
+    def clear(self):
+        """Forgets every key by starting over with an empty generation."""
+
+        with self.lock:
+            self.current = BloomFilter(self.bits, self.hashes)
+            self.previous = None
+            self.started_at = time()
+            self.previous_started_at = None
+            self.changed = True
+
+    def save(self):
+        """Writes both generations to the path, replacing the file in one
+        step so readers never see a partial one.
+        """
+
+        with self.lock:
+            previous = self.previous or BloomFilter(self.bits, self.hashes)
+            header = FILTER_HEADER.pack(
+                FILTER_MAGIC,
+                self.bits,
+                self.hashes,
+                self.started_at,
+                self.current.count,
+                self.previous_started_at or 0.0,
+                previous.count,
+            )
+            data = header + bytes(self.current.data) + bytes(previous.data)
+            self.changed = False
+
+        temporary = "%s.tmp" % self.path
+        with open(temporary, "wb") as filter_file:
+            filter_file.write(data)
+        replace(temporary, self.path)
+
+    def load(self):
+        """Reads the generations saved at the path, if it holds filters of
+        the same size. Returns whether it did.
+        """
+
+        try:
+            with open(self.path, "rb") as filter_file:
+                data = filter_file.read()
+        except FileNotFoundError:
+
+            return False
+
+        size = self.bits // 8
+        if len(data) != FILTER_HEADER.size + 2 * size:
+
+            return False
+
+        magic, bits, hashes, started_at, count, previous_started_at, previous_count = (
+            FILTER_HEADER.unpack_from(data)
+        )
+        if (magic, bits, hashes) != (FILTER_MAGIC, self.bits, self.hashes):
+
+            return False
+
+        start = FILTER_HEADER.size
+        with self.lock:
+            self.current = BloomFilter(
+                bits, hashes, data[start : start + size], count
+            )
+            self.started_at = started_at
+            self.previous = None
+            self.previous_started_at = None
+            if previous_started_at:
+                self.previous = BloomFilter(
+                    bits, hashes, data[start + size :], previous_count
+                )
+                self.previous_started_at = previous_started_at
+            self.rebuild_if_due()
+
+        return True
+
+    def save_periodically(self):
+        """Saves the filters every save_s while they change, until
+        stopped.
+        """
+
+        while not self.stop_event.wait(self.save_s):
+            if not self.changed:
+
+                continue
+
+            try:
+                self.save()
+            except OSError:
+                report_error("Saving the negative filter failed", path=self.path)
+
+    def stop(self):
+        """Stops the background saving and saves a last time."""
+
+        self.stop_event.set()
+        if self.path:
+            self.thread.join()
+            self.save()
+
+    def get_stats(self):
+        """Returns the filter size, the keys per generation and how often
+        lookups were skipped.
+        """
+
+        with self.lock:
+            return {
+                "bytes": 2 * self.bits // 8,
+                "hashes": self.hashes,
+                "keys": self.current.count,
+                "previous_keys": self.previous.count if self.previous else 0,
+                "started_at": self.started_at,
+                "hits": self.hits,
+                "misses": self.misses,
+                "rebuilds": self.rebuilds,
+            }
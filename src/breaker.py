@@ -0,0 +1,173 @@
+from collections import deque
+from os import getenv
+from threading import Lock
+from time import monotonic
+
+
+BREAKER_WINDOW_SIZE = int(getenv("BREAKER_WINDOW_SIZE", "20"))
+BREAKER_MIN_CALLS = int(getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_FAILURE_RATE = float(getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_SLOW_CALL_S = float(getenv("BREAKER_SLOW_CALL_S", "5"))
+BREAKER_SLOW_CALL_RATE = float(getenv("BREAKER_SLOW_CALL_RATE", "0.8"))
+BREAKER_OPEN_S = float(getenv("BREAKER_OPEN_S", "30"))
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class UpstreamError(Exception):
+    """Raised when a call to an upstream service fails."""
+
+
+class BreakerOpen(UpstreamError):
+    """Raised when a call is refused because its circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Fails fast on an upstream whose recent calls mostly failed or were
+    slow.
+
+    The breaker keeps the outcome of the last window_size calls. Once at
+    least min_calls are recorded and either the failure rate or the slow
+    call rate crosses its threshold, the breaker opens and refuses calls
+    for open_s seconds. It then lets a single probe call through and
+    closes again if that call succeeds.
+    """
+
+    def __init__(
+        self,
+        name,
+        window_size=BREAKER_WINDOW_SIZE,
+        min_calls=BREAKER_MIN_CALLS,
+        failure_rate=BREAKER_FAILURE_RATE,
+        slow_call_s=BREAKER_SLOW_CALL_S,
+        slow_call_rate=BREAKER_SLOW_CALL_RATE,
+        open_s=BREAKER_OPEN_S,
+    ):
+
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_s = slow_call_s
+        self.slow_call_rate = slow_call_rate
+        self.open_s = open_s
+        self.calls = deque(maxlen=window_size)
+        self.state = CLOSED
+        self.opened_at = None
+        self.probing = False
+        self.rejected = 0
+        self.lock = Lock()
+
+    def allow(self):
+        """Returns whether a call may go ahead right now."""
+
+        with self.lock:
+            if self.state == CLOSED:
+
+                return True
+
+            if self.state == OPEN:
+                if monotonic() - self.opened_at < self.open_s:
+                    self.rejected += 1
+
+                    return False
+
+                self.state = HALF_OPEN
+
+            if self.probing:
+                self.rejected += 1
+
+                return False
+
+            self.probing = True
+            return True
+
+    def record(self, success, duration):
+        """Records the outcome of a call that allow() let through."""
+
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probing = False
+                if success and duration < self.slow_call_s:
+                    self.state = CLOSED
+                    self.calls.clear()
+                else:
+                    self.trip()
+
+                return
+
+            self.calls.append((success, duration >= self.slow_call_s))
+            if len(self.calls) < self.min_calls:
+
+                return
+
+            failures = sum(1 for success, _ in self.calls if not success)
+            slow_calls = sum(1 for _, slow in self.calls if slow)
+            if (
+                failures >= self.failure_rate * len(self.calls)
+                or slow_calls >= self.slow_call_rate * len(self.calls)
+            ):
+                self.trip()
+
+    def trip(self):
+        """Opens the breaker. Must be called with the lock held."""
+
+        self.state = OPEN
+        self.opened_at = monotonic()
+        self.probing = False
+
+    def call(self, func, *args, **kwargs):
+        """Calls the function through the breaker. Raises BreakerOpen without
+        calling it if the breaker is open, and re-raises any error the
+        function raises after recording it as a failure.
+        """
+
+        if not self.allow():
+
+            raise BreakerOpen("%s circuit breaker is open" % self.name)
+
+        start_time = monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record(False, monotonic() - start_time)
+            raise
+
+        self.record(True, monotonic() - start_time)
+        return result
+
+    def is_open(self):
+        """Returns whether calls are currently being refused."""
+
+        with self.lock:
+            return (
+                self.state == OPEN and monotonic() - self.opened_at < self.open_s
+            )
+
+    def get_stats(self):
+        """Returns the breaker state and its recent call statistics."""
+
+        with self.lock:
+            return {
+                "state": self.state,
+                "calls": len(self.calls),
+                "failures": sum(1 for success, _ in self.calls if not success),
+                "slow_calls": sum(1 for _, slow in self.calls if slow),
+                "rejected": self.rejected,
+            }
+
+
+BREAKERS = {}
+BREAKERS_LOCK = Lock()
+
+
+def get_breaker(name, **options):
+    """Returns the process-wide breaker for the named upstream, creating it
+    with the given options on first use.
+    """
+
+    with BREAKERS_LOCK:
+        if name not in BREAKERS:
+            BREAKERS[name] = CircuitBreaker(name, **options)
+
+        return BREAKERS[name]
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+MISSING = object()
+
+
+class TTLCache:
+    """A thread-safe LRU cache whose entries go stale after a TTL.
+
+    Stale entries are kept until max_stale_s so they can still be served
+    when the upstream they came from is unavailable.
+    """
+
+    def __init__(self, max_size, ttl_s, max_stale_s=None):
+
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self.max_stale_s = max_stale_s if max_stale_s is not None else ttl_s
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        """Returns the fresh value for the key, or the default."""
+
+        value, age = self.get_with_age(key)
+        if value is MISSING or age > self.ttl_s:
+            self.misses += 1
+
+            return default
+
+        self.hits += 1
+        return value
+
+    def get_stale(self, key, default=MISSING):
+        """Returns the value for the key even if it is past its TTL, as long
+        as it is within the maximum stale age.
+        """
+
+        value, age = self.get_with_age(key)
+        if value is MISSING or age > self.max_stale_s:
+
+            return default
+
+        return value
+
+    def get_with_age(self, key):
+        """Returns the value for the key and its age in seconds."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+
+                return MISSING, None
+
+            self.entries.move_to_end(key)
+
+        value, stored_at = entry
+        age = monotonic() - stored_at
+        if age > self.max_stale_s:
+            self.discard(key)
+
+            return MISSING, None
+
+        return value, age
+
+    def set(self, key, value):
+        """Stores the value, evicting the least recently used entries."""
+
+        with self.lock:
+            self.entries[key] = (value, monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        """Removes the key, if present."""
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Removes every entry."""
+
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+
+        return len(self.entries)
@@ -0,0 +1,199 @@
+from argparse import ArgumentParser
+from csv import DictWriter
+from json import load
+from os import environ
+from sys import stdout
+from threading import Event
+from threading import Lock
+from threading import Thread
+from time import monotonic
+
+from faults import FaultPlan
+from faults import INJECTOR
+
+
+CURVE_FIELDS = [
+    "scenario",
+    "cache",
+    "workers",
+    "completed",
+    "errors",
+    "throughput_per_s",
+    "p50_s",
+    "p90_s",
+    "p99_s",
+    "max_s",
+]
+
+
+def get_percentile(values, percentile):
+    """Returns the percentile of sorted values, or None if there are
+    none.
+    """
+
+    if not values:
+
+        return None
+
+    index = min(int(len(values) * percentile / 100), len(values) - 1)
+
+    return values[index]
+
+
+def measure(handler, make_item, workers, duration_s):
+    """Keeps the number of workers calling the handler with new items for
+    the duration, each starting its next call as soon as one returns, and
+    returns the throughput and the latency percentiles of the calls.
+    """
+
+    latencies = []
+    errors = [0]
+    lock = Lock()
+    stop_event = Event()
+
+    def work():
+
+        while not stop_event.is_set():
+            item = make_item()
+            start_time = monotonic()
+            try:
+                handler(item)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+
+                continue
+
+            with lock:
+                latencies.append(monotonic() - start_time)
+
+    threads = [Thread(target=work) for _ in range(workers)]
+    start_time = monotonic()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    stop_event.wait(duration_s)
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+    elapsed_s = monotonic() - start_time
+
+    latencies.sort()
+
+    return {
+        "workers": workers,
+        "completed": len(latencies),
+        "errors": errors[0],
+        "throughput_per_s": len(latencies) / elapsed_s,
+        "p50_s": get_percentile(latencies, 50),
+        "p90_s": get_percentile(latencies, 90),
+        "p99_s": get_percentile(latencies, 99),
+        "max_s": latencies[-1] if latencies else None,
+    }
+
+
+def sweep(
+    handler,
+    make_item,
+    scenarios,
+    worker_counts,
+    duration_s,
+    set_workers=None,
+    on_row=None,
+    reset=None,
+):
+    """Measures every scenario at every worker count. A scenario is a dict
+    with a name and the fault plan options by upstream to inject while it
+    runs. set_workers is called with each worker count before it is
+    measured, and reset before each scenario so it starts from cold
+    caches; without it the caches stay warm from the scenarios before,
+    and each row says which. Returns the rows of the curves, and passes
+    each to on_row as it is measured.
+    """
+
+    rows = []
+    for scenario in scenarios:
+        INJECTOR.clear()
+        if reset:
+            reset()
+        for name, options in scenario.get("faults", {}).items():
+            INJECTOR.set_plan(name, FaultPlan.from_options(options))
+
+        try:
+            for workers in worker_counts:
+                if set_workers:
+                    set_workers(workers)
+                row = measure(handler, make_item, workers, duration_s)
+                row["scenario"] = scenario["name"]
+                row["cache"] = "cold" if reset else "warm"
+                rows.append(row)
+                if on_row:
+                    on_row(row)
+        finally:
+            INJECTOR.clear()
+
+    return rows
+
+
+def parse_args():
+    """Parses the command line."""
+
+    parser = ArgumentParser(
+        description="Measures pipeline throughput and latency under injected"
+        " upstream faults, with posting turned off."
+    )
+    parser.add_argument(
+        "scenarios",
+        help="JSON file with a list of scenarios, each with a name and the"
+        " fault plan options by upstream",
+    )
+    parser.add_argument(
+        "--workers",
+        default="10,25,50,100",
+        help="comma-separated worker counts to measure",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=60, help="seconds per measurement"
+    )
+    parser.add_argument("--seed", type=int, help="seed for the synthetic tweets")
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="keep the caches warm across scenarios instead of clearing them"
+        " before each",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    environ["TWITTER_POST"] = "0"
+    from main import Main
+    from sentiment import clear_caches
+    from standin import TweetFactory
+
+    args = parse_args()
+    with open(args.scenarios) as scenarios_file:
+        scenarios = load(scenarios_file)
+
+    main = Main(no_ticker_path="")
+    main.warm_up()
+    factory = TweetFactory(target_ratio=1, seed=args.seed)
+    writer = DictWriter(stdout, CURVE_FIELDS)
+    writer.writeheader()
+
+    def write_row(row):
+
+        writer.writerow(row)
+        stdout.flush()
+
+    sweep(
+        main.twitter_callback,
+        factory.make_tweet,
+        scenarios,
+        [int(workers) for workers in args.workers.split(",")],
+        args.duration,
+        set_workers=main.gate.set_concurrency,
+        on_row=write_row,
+        reset=None if args.warm else clear_caches,
+    )
@@ -0,0 +1,290 @@
+from json import loads
+from math import exp
+from math import log
+from os import getenv
+from random import Random
+from threading import Lock
+from time import sleep
+
+from breaker import UpstreamError
+
+
+FAULTS = getenv("FAULTS", "")
+FAULTS_ENDPOINT = getenv("FAULTS_ENDPOINT", "0") == "1"
+FAULT_TIMEOUT_S = 30.0
+# The standard normal quantile at 0.99, to turn a p99 into a lognormal
+# sigma.
+NORMAL_P99 = 2.326
+DISTRIBUTIONS = ["fixed", "uniform", "lognormal"]
+PLAN_OPTIONS = [
+    "distribution",
+    "latency_s",
+    "min_s",
+    "max_s",
+    "median_s",
+    "p99_s",
+    "error_rate",
+    "timeout_rate",
+    "timeout_s",
+    "partial_rate",
+    "seed",
+]
+
+
+class InjectedError(UpstreamError):
+    """Raised in place of an upstream call by a fault plan."""
+
+
+class FaultPlan:
+    """The faults to inject into the calls to one upstream.
+
+    Each call is first delayed by a latency drawn from the distribution:
+    latency_s for "fixed", between min_s and max_s for "uniform", or a
+    lognormal with the given median_s and p99_s. Then it fails with
+    error_rate, or hangs for timeout_s and fails with timeout_rate, or
+    else runs and with partial_rate has part of its result cut off. A
+    call made with a shorter timeout argument gives up after it instead.
+    """
+
+    def __init__(
+        self,
+        distribution=None,
+        latency_s=0.0,
+        min_s=0.0,
+        max_s=0.0,
+        median_s=0.0,
+        p99_s=0.0,
+        error_rate=0.0,
+        timeout_rate=0.0,
+        timeout_s=FAULT_TIMEOUT_S,
+        partial_rate=0.0,
+        seed=None,
+    ):
+
+        if distribution and distribution not in DISTRIBUTIONS:
+
+            raise ValueError("Unknown latency distribution: %s" % distribution)
+
+        if distribution == "lognormal" and not 0 < float(median_s) <= float(p99_s):
+
+            raise ValueError("A lognormal latency needs 0 < median_s <= p99_s")
+
+        self.distribution = distribution
+        self.latency_s = float(latency_s)
+        self.min_s = float(min_s)
+        self.max_s = float(max_s)
+        self.median_s = float(median_s)
+        self.p99_s = float(p99_s)
+        self.error_rate = float(error_rate)
+        self.timeout_rate = float(timeout_rate)
+        self.timeout_s = float(timeout_s)
+        self.partial_rate = float(partial_rate)
+        self.seed = seed
+        self.random = Random(seed)
+        self.lock = Lock()
+
+    @classmethod
+    def from_options(cls, options):
+        """Creates a plan from option names and values, ignoring any other
+        keys, such as the query of a /faults request.
+        """
+
+        return cls(**{name: options[name] for name in PLAN_OPTIONS if name in options})
+
+    def get_options(self):
+        """Returns the options the plan was created with."""
+
+        return {name: getattr(self, name) for name in PLAN_OPTIONS}
+
+    def get_latency(self):
+        """Draws the delay for one call."""
+
+        with self.lock:
+            if self.distribution == "fixed":
+
+                return self.latency_s
+
+            if self.distribution == "uniform":
+
+                return self.random.uniform(self.min_s, self.max_s)
+
+            if self.distribution == "lognormal" and self.median_s > 0:
+                sigma = max(log(self.p99_s / self.median_s), 0) / NORMAL_P99
+
+                return exp(self.random.gauss(log(self.median_s), sigma))
+
+            return 0.0
+
+    def get_fault(self):
+        """Draws what goes wrong with one call: "error", "timeout",
+        "partial" or None.
+        """
+
+        with self.lock:
+            draw = self.random.random()
+
+        for fault, rate in [
+            ("error", self.error_rate),
+            ("timeout", self.timeout_rate),
+            ("partial", self.partial_rate),
+        ]:
+            if draw < rate:
+
+                return fault
+
+            draw -= rate
+
+        return None
+
+
+def get_partial(result):
+    """Returns the result with its second half cut off: the items of a
+    dict or sequence, or the entities of a Natural Language response.
+    """
+
+    if isinstance(result, dict):
+        keys = list(result)[: len(result) // 2]
+
+        return {key: result[key] for key in keys}
+
+    if isinstance(result, (list, tuple)):
+
+        return result[: len(result) // 2]
+
+    entities = getattr(result, "entities", None)
+    if entities is not None:
+        del entities[len(entities) // 2 :]
+
+    return result
+
+
+class FaultInjector:
+    """Applies fault plans to upstream calls by upstream name, and counts
+    what it injected. Plans can be swapped at any time.
+    """
+
+    def __init__(self, plans=None):
+
+        self.plans = dict(plans or {})
+        self.lock = Lock()
+        self.stats = {}
+
+    @classmethod
+    def from_json(cls, text):
+        """Creates an injector from a JSON object of plan options by
+        upstream name.
+        """
+
+        if not text:
+
+            return cls()
+
+        return cls(
+            {
+                name: FaultPlan.from_options(options)
+                for name, options in loads(text).items()
+            }
+        )
+
+    def set_plan(self, name, plan):
+        """Injects the plan into the upstream's calls, or stops injecting
+        if it is None.
+        """
+
+        with self.lock:
+            if plan:
+                self.plans[name] = plan
+            else:
+                self.plans.pop(name, None)
+
+    def clear(self):
+
+        with self.lock:
+            self.plans = {}
+
+    def get_plan(self, name):
+
+        return self.plans.get(name)
+
+    def count(self, name, key, value=1):
+
+        with self.lock:
+            stats = self.stats.setdefault(
+                name,
+                {"calls": 0, "delay_s": 0.0, "errors": 0, "timeouts": 0, "partials": 0},
+            )
+            stats[key] += value
+
+    def call(self, name, func, *args, **kwargs):
+        """Calls the function with the upstream's plan applied."""
+
+        plan = self.get_plan(name)
+        if not plan:
+
+            return func(*args, **kwargs)
+
+        self.count(name, "calls")
+        timeout = kwargs.get("timeout")
+        latency = plan.get_latency()
+        fault = plan.get_fault()
+        if fault == "timeout":
+            latency += plan.timeout_s
+
+        if timeout is not None and latency > timeout:
+            self.count(name, "timeouts")
+            self.count(name, "delay_s", timeout)
+            sleep(timeout)
+
+            raise InjectedError("%s timed out after %s s (injected)" % (name, timeout))
+
+        self.count(name, "delay_s", latency)
+        sleep(latency)
+        if fault == "timeout":
+            self.count(name, "timeouts")
+
+            raise InjectedError("%s timed out (injected)" % name)
+
+        if fault == "error":
+            self.count(name, "errors")
+
+            raise InjectedError("%s failed (injected)" % name)
+
+        result = func(*args, **kwargs)
+        if fault == "partial":
+            self.count(name, "partials")
+
+            return get_partial(result)
+
+        return result
+
+    def get_stats(self):
+        """Returns the plan options and injection counts by upstream."""
+
+        with self.lock:
+            names = set(self.plans) | set(self.stats)
+            stats = {}
+            for name in sorted(names):
+                plan = self.plans.get(name)
+                stats[name] = dict(self.stats.get(name, {}))
+                stats[name]["plan"] = plan.get_options() if plan else None
+
+            return stats
+
+
+INJECTOR = FaultInjector.from_json(FAULTS)
+
+
+def configure_faults(query):
+    """Handles a /faults request. With an upstream in the query, replaces
+    its plan with the other options, or removes it if there are none.
+    With clear, removes every plan. Returns the plans and counts.
+    """
+
+    if "clear" in query:
+        INJECTOR.clear()
+    elif "upstream" in query:
+        options = {name: query[name] for name in PLAN_OPTIONS if name in query}
+        plan = FaultPlan.from_options(options) if options else None
+        INJECTOR.set_plan(query["upstream"], plan)
+
+    return INJECTOR.get_stats()
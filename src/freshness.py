@@ -0,0 +1,192 @@
+from collections import deque
+from heapq import heappop
+from heapq import heappush
+from itertools import count
+from os import getenv
+from queue import Empty
+from re import compile
+from threading import Condition
+from time import monotonic
+from time import time
+
+from archive import get_tweet_id
+
+
+TWITTER_EPOCH_MS = 1288834974657
+SCHEDULE_ORDERS = ["newest", "deadline", "fifo"]
+SCHEDULE_ORDER = getenv("SCHEDULE_ORDER", "newest")
+SCHEDULE_MAX_AGE_S = float(getenv("SCHEDULE_MAX_AGE_S", "300"))
+SCHEDULE_BOOST_S = float(getenv("SCHEDULE_BOOST_S", "60"))
+SCHEDULE_WAITS_SIZE = 1000
+USER_ID_PATTERN = compile(rb'"user":\s*\{[^{}]*?"id_str":\s*"(\d+)"')
+
+
+def parse_weights(text):
+    """Parses comma-separated account:weight pairs."""
+
+    weights = {}
+    for pair in text.split(","):
+        if ":" in pair:
+            account, weight = pair.split(":", 1)
+            weights[account.strip()] = float(weight)
+
+    return weights
+
+
+ACCOUNT_WEIGHTS = parse_weights(getenv("ACCOUNT_WEIGHTS", ""))
+
+
+def get_created_s(tweet_id):
+    """Returns the creation time encoded in a snowflake tweet ID."""
+
+    return ((tweet_id >> 22) + TWITTER_EPOCH_MS) / 1000
+
+
+def get_account(data):
+    """Returns the ID of the author in a raw payload without parsing it,
+    or None.
+    """
+
+    match = USER_ID_PATTERN.search(data)
+    if not match:
+
+        return None
+
+    return match.group(1).decode("ascii")
+
+
+class FreshnessQueue:
+    """A work queue for raw stream payloads that serves the freshest
+    tweets first, with the interface of queue.Queue the workers use.
+
+    Tweets are ordered by the creation time in their ID, newest first, or
+    earliest deadline first, where a tweet's deadline is max_age_s after
+    it was created. An account's weight above 1 moves its tweets ahead as
+    if they were boost_s newer per unit, and below 1 moves them back. A
+    tweet found older than max_age_s is moved to a backfill lane, which
+    is served oldest first and only while no fresh tweets wait, so a
+    backlog of stale tweets does not hold up new ones.
+    """
+
+    def __init__(
+        self,
+        order=SCHEDULE_ORDER,
+        max_age_s=SCHEDULE_MAX_AGE_S,
+        boost_s=SCHEDULE_BOOST_S,
+        weights=None,
+    ):
+
+        if order not in SCHEDULE_ORDERS:
+
+            raise ValueError("Unknown schedule order: %s" % order)
+
+        self.order = order
+        self.max_age_s = max_age_s
+        self.boost_s = boost_s
+        self.weights = ACCOUNT_WEIGHTS if weights is None else weights
+        self.fresh = []
+        self.backfill = []
+        self.sequence = count()
+        self.condition = Condition()
+        self.all_done = Condition(self.condition)
+        self.unfinished = 0
+        self.expired = 0
+        self.fresh_served = 0
+        self.backfill_served = 0
+        self.fresh_waits = deque(maxlen=SCHEDULE_WAITS_SIZE)
+
+    def get_priority(self, created_s, account):
+        """Returns the sort key of a tweet in the fresh lane, lowest
+        first.
+        """
+
+        boost = (self.weights.get(account, 1.0) - 1) * self.boost_s
+        if self.order == "newest":
+
+            return -(created_s + boost)
+
+        if self.order == "deadline":
+
+            return created_s + self.max_age_s - boost
+
+        return 0
+
+    def put(self, data):
+        """Queues a raw payload by the age and author of its tweet.
+        Payloads without a tweet ID count as new.
+        """
+
+        raw = data.encode("utf-8") if isinstance(data, str) else data
+        tweet_id = get_tweet_id(raw)
+        created_s = get_created_s(tweet_id) if tweet_id else time()
+        priority = self.get_priority(created_s, get_account(raw))
+        with self.condition:
+            entry = (priority, next(self.sequence), created_s, monotonic(), data)
+            heappush(self.fresh, entry)
+            self.unfinished += 1
+            self.condition.notify()
+
+    def get(self, block=True, timeout=None):
+        """Returns the next payload to work on. Raises Empty if there is
+        none, after waiting up to the timeout if block is set.
+        """
+
+        with self.condition:
+            if block and not self.condition.wait_for(self.qsize, timeout):
+
+                raise Empty
+
+            now = time()
+            while self.fresh:
+                _, sequence, created_s, queued_at, data = heappop(self.fresh)
+                if now - created_s <= self.max_age_s:
+                    self.fresh_served += 1
+                    self.fresh_waits.append(monotonic() - queued_at)
+
+                    return data
+
+                self.expired += 1
+                heappush(self.backfill, (created_s, sequence, data))
+
+            if not self.backfill:
+
+                raise Empty
+
+            self.backfill_served += 1
+
+            return heappop(self.backfill)[2]
+
+    def task_done(self):
+
+        with self.condition:
+            self.unfinished -= 1
+            if not self.unfinished:
+                self.all_done.notify_all()
+
+    def join(self):
+        """Waits until every queued payload was got and marked done."""
+
+        with self.condition:
+            self.all_done.wait_for(lambda: not self.unfinished)
+
+    def qsize(self):
+
+        return len(self.fresh) + len(self.backfill)
+
+    def get_stats(self):
+        """Returns the lane sizes, how many tweets were served from each
+        and expired, and the median wait of fresh tweets.
+        """
+
+        with self.condition:
+            waits = sorted(self.fresh_waits)
+
+            return {
+                "order": self.order,
+                "fresh": len(self.fresh),
+                "backfill": len(self.backfill),
+                "fresh_served": self.fresh_served,
+                "backfill_served": self.backfill_served,
+                "expired": self.expired,
+                "fresh_wait_p50_s": waits[len(waits) // 2] if waits else None,
+            }
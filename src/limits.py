@@ -0,0 +1,294 @@
+from os import getenv
+from threading import Condition
+from threading import Lock
+from time import monotonic
+from time import sleep
+
+from breaker import UpstreamError
+
+
+LIMIT_MAX_WAIT_S = float(getenv("LIMIT_MAX_WAIT_S", "30"))
+LIMIT_ADAPTIVE = getenv("LIMIT_ADAPTIVE", "1") == "1"
+LIMIT_DEFAULTS = {
+    # name: (initial concurrent calls, max concurrent calls, calls per second,
+    # burst size)
+    "wikidata": (2, 5, 5.0, 5),
+    "nl_entities": (10, 50, 10.0, 20),
+    "nl_sentiment": (10, 50, 10.0, 20),
+    "twitter": (5, 20, 0, 0),
+}
+LIMIT_DEFAULT = (5, 20, 0, 0)
+AIMD_BACKOFF_RATIO = float(getenv("AIMD_BACKOFF_RATIO", "0.75"))
+AIMD_LATENCY_TOLERANCE = float(getenv("AIMD_LATENCY_TOLERANCE", "2"))
+AIMD_SHORT_WINDOW = 10
+AIMD_LONG_WINDOW = 100
+
+
+class LimitTimeout(UpstreamError):
+    """Raised when a call waited too long for its limiter."""
+
+
+class TokenBucket:
+    """Hands out tokens at a steady rate with bursts up to the capacity.
+
+    Callers reserve a token and sleep for the returned delay, so waiting
+    callers are served in order without polling. A rate of 0 disables the
+    bucket.
+    """
+
+    def __init__(self, rate, capacity):
+
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated_at = monotonic()
+        self.lock = Lock()
+
+    def reserve(self):
+        """Takes a token and returns how many seconds to wait before using
+        it.
+        """
+
+        if not self.rate:
+
+            return 0
+
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+
+                return 0
+
+            return -self.tokens / self.rate
+
+
+class Limiter:
+    """Caps the calls in flight to an upstream and the rate they start at,
+    and measures how long callers wait.
+    """
+
+    def __init__(self, name, concurrency, rate, burst, max_wait_s=LIMIT_MAX_WAIT_S):
+
+        self.name = name
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.max_wait_s = max_wait_s
+        self.in_flight = 0
+        self.waits = 0
+        self.wait_s_total = 0.0
+        self.wait_s_max = 0.0
+        self.condition = Condition()
+
+    def get_limit(self):
+        """Returns how many calls may currently be in flight."""
+
+        return self.concurrency
+
+    def set_concurrency(self, concurrency):
+        """Changes how many calls may be in flight. Calls already in flight
+        above a lowered limit finish normally.
+        """
+
+        with self.condition:
+            self.concurrency = concurrency
+            self.condition.notify_all()
+
+    def acquire(self):
+        """Waits for a free slot and a token. Raises LimitTimeout if no slot
+        frees up within max_wait_s.
+        """
+
+        start_time = monotonic()
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: self.in_flight < self.get_limit(), self.max_wait_s
+            ):
+                self.record_wait(monotonic() - start_time)
+
+                raise LimitTimeout("%s limiter timed out" % self.name)
+
+            self.in_flight += 1
+
+        delay = self.bucket.reserve()
+        if delay:
+            sleep(delay)
+
+        with self.condition:
+            self.record_wait(monotonic() - start_time)
+
+    def release(self):
+        """Frees the slot taken by acquire()."""
+
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def record_wait(self, wait_s):
+        """Adds one wait to the wait time metrics. Must be called with the
+        condition held.
+        """
+
+        self.waits += 1
+        self.wait_s_total += wait_s
+        self.wait_s_max = max(self.wait_s_max, wait_s)
+
+    def record_result(self, latency_s, success):
+        """Observes the outcome of a call. Fixed limiters ignore it."""
+
+        pass
+
+    def __enter__(self):
+
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.release()
+
+    def get_stats(self):
+        """Returns the limits, calls in flight and wait time metrics."""
+
+        with self.condition:
+            return {
+                "concurrency": self.get_limit(),
+                "rate": self.bucket.rate,
+                "in_flight": self.in_flight,
+                "waits": self.waits,
+                "wait_s_total": self.wait_s_total,
+                "wait_s_max": self.wait_s_max,
+                "wait_s_mean": self.wait_s_total / self.waits if self.waits else 0.0,
+            }
+
+
+class AdaptiveLimiter(Limiter):
+    """A limiter whose concurrency follows the upstream's latency, using
+    additive increase and multiplicative decrease (AIMD).
+
+    The latency of successful calls is averaged over a short and a long
+    window of about AIMD_SHORT_WINDOW and AIMD_LONG_WINDOW calls, so an
+    upstream answering queries of different cost, like wikidata, is not
+    taken to be slowing down whenever a costly one comes back. While the
+    short average stays within latency_tolerance times the long one and
+    the limit is actually being used, the limit grows by 1/limit, i.e. by
+    about one per limit's worth of calls. An error or a short average
+    above that cuts the limit by backoff_ratio, at most once per round
+    trip, so the calls already in flight when it was cut do not cut it
+    again. The limit stays between 1 and max_concurrency.
+    """
+
+    def __init__(
+        self,
+        name,
+        concurrency,
+        max_concurrency,
+        rate,
+        burst,
+        backoff_ratio=AIMD_BACKOFF_RATIO,
+        latency_tolerance=AIMD_LATENCY_TOLERANCE,
+        **options
+    ):
+
+        super().__init__(name, concurrency, rate, burst, **options)
+        self.limit = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.short_s = None
+        self.long_s = None
+        self.decreased_at = None
+        self.increases = 0
+        self.decreases = 0
+
+    def get_limit(self):
+
+        return int(self.limit)
+
+    def record_result(self, latency_s, success):
+        """Raises or cuts the limit based on the call's outcome."""
+
+        with self.condition:
+            if success and self.short_s is None:
+                self.short_s = self.long_s = latency_s
+            elif success:
+                self.short_s += (latency_s - self.short_s) / AIMD_SHORT_WINDOW
+                self.long_s += (latency_s - self.long_s) / AIMD_LONG_WINDOW
+
+            if not success or self.short_s > self.long_s * self.latency_tolerance:
+                now = monotonic()
+                if (
+                    self.decreased_at is None
+                    or now - self.decreased_at >= (self.short_s or latency_s)
+                ):
+                    self.limit = max(1.0, self.limit * self.backoff_ratio)
+                    self.decreased_at = now
+                    self.decreases += 1
+
+            elif self.in_flight * 2 >= self.get_limit():
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                self.increases += 1
+                self.condition.notify()
+
+    def get_stats(self):
+
+        stats = super().get_stats()
+        with self.condition:
+            stats.update(
+                {
+                    "max_concurrency": self.max_concurrency,
+                    "limit": self.limit,
+                    "short_latency_s": self.short_s,
+                    "long_latency_s": self.long_s,
+                    "increases": self.increases,
+                    "decreases": self.decreases,
+                }
+            )
+
+        return stats
+
+
+LIMITERS = {}
+LIMITERS_LOCK = Lock()
+
+
+def get_limiter(name):
+    """Returns the process-wide limiter for the named upstream. The
+    defaults can be overridden with <NAME>_CONCURRENCY,
+    <NAME>_MAX_CONCURRENCY, <NAME>_RATE and <NAME>_BURST environment
+    variables. Limiters adapt their concurrency unless LIMIT_ADAPTIVE=0.
+    """
+
+    with LIMITERS_LOCK:
+        if name not in LIMITERS:
+            defaults = LIMIT_DEFAULTS.get(name, LIMIT_DEFAULT)
+            concurrency, max_concurrency, rate, burst = defaults
+            prefix = name.upper()
+            concurrency = int(getenv("%s_CONCURRENCY" % prefix, concurrency))
+            max_concurrency = int(
+                getenv("%s_MAX_CONCURRENCY" % prefix, max_concurrency)
+            )
+            rate = float(getenv("%s_RATE" % prefix, rate))
+            burst = int(getenv("%s_BURST" % prefix, burst))
+            if LIMIT_ADAPTIVE:
+                limiter = AdaptiveLimiter(
+                    name, concurrency, max_concurrency, rate, burst
+                )
+            else:
+                limiter = Limiter(name, concurrency, rate, burst)
+            LIMITERS[name] = limiter
+
+        return LIMITERS[name]
+
+
+def get_limits():
+    """Returns the current concurrency limit of every upstream by name."""
+
+    with LIMITERS_LOCK:
+        limiters = list(LIMITERS.values())
+
+    return {limiter.name: limiter.get_limit() for limiter in limiters}
@@ -0,0 +1,255 @@
+from datetime import datetime
+from datetime import timezone
+from json import dumps
+from os import getenv
+from queue import Empty
+from queue import Full
+from queue import Queue
+from random import random
+from sys import exc_info
+from threading import Lock
+from threading import Thread
+from traceback import format_exc
+
+
+LOG_SINK = getenv("LOG_SINK", "file")
+LOG_PATH = getenv("LOG_PATH", "trump2cash.log")
+LOG_NAME = getenv("LOG_NAME", "trump2cash")
+LOG_BUFFER_SIZE = int(getenv("LOG_BUFFER_SIZE", "10000"))
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_S = 1.0
+
+
+class FileSink:
+    """Appends records to a local file as JSON lines."""
+
+    def __init__(self, path=LOG_PATH):
+
+        self.path = path
+
+    def write(self, records):
+
+        with open(self.path, "a") as log_file:
+            for record in records:
+                log_file.write("%s\n" % dumps(record, default=str))
+
+
+class CloudSink:
+    """Sends records to Cloud Logging as structured entries, and errors to
+    Cloud Error Reporting as well. The client libraries are imported on
+    first use.
+    """
+
+    def __init__(self, name=LOG_NAME):
+
+        self.name = name
+        self._logger = None
+        self._error_client = None
+
+    @property
+    def logger(self):
+
+        if not self._logger:
+            from google.cloud import logging
+
+            self._logger = logging.Client().logger(self.name)
+
+        return self._logger
+
+    @property
+    def error_client(self):
+
+        if not self._error_client:
+            from google.cloud import error_reporting
+
+            self._error_client = error_reporting.Client(service=self.name)
+
+        return self._error_client
+
+    def write(self, records):
+
+        batch = self.logger.batch()
+        for record in records:
+            batch.log_struct(record, severity=record.get("severity"))
+        batch.commit()
+
+        for record in records:
+            if record.get("traceback"):
+                self.error_client.report(
+                    "%s\n%s" % (record.get("message"), record["traceback"])
+                )
+
+
+SINKS = {"file": FileSink, "cloud": CloudSink}
+
+
+class Shipper:
+    """Ships log records to a sink in batches from a background thread.
+
+    Logging only puts the record on a bounded queue and never waits. When
+    the queue is full the record is dropped and counted, so a slow sink
+    can never hold up the workers. A sink that fails loses its batch.
+    """
+
+    def __init__(
+        self,
+        sink,
+        max_size=LOG_BUFFER_SIZE,
+        batch_size=LOG_BATCH_SIZE,
+        flush_s=LOG_FLUSH_S,
+    ):
+
+        self.sink = sink
+        self.queue = Queue(max_size)
+        self.batch_size = batch_size
+        self.flush_s = flush_s
+        self.lock = Lock()
+        self.shipped = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.failed = 0
+        self.thread = Thread(target=self.ship_queue)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, record):
+        """Queues the record, or drops it if the buffer is full."""
+
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self.lock:
+                self.dropped += 1
+
+    def skip(self):
+        """Counts a record left out by sampling."""
+
+        with self.lock:
+            self.sampled_out += 1
+
+    def close(self):
+        """Ships everything still queued and stops the thread."""
+
+        self.queue.put(None)
+        self.thread.join()
+
+    def ship_queue(self):
+        """Ships queued records in batches until closed."""
+
+        closed = False
+        while not closed:
+            batch = []
+            try:
+                record = self.queue.get(timeout=self.flush_s)
+                while True:
+                    if record is None:
+                        closed = True
+
+                        break
+
+                    batch.append(record)
+                    if len(batch) >= self.batch_size:
+
+                        break
+
+                    record = self.queue.get_nowait()
+            except Empty:
+
+                pass
+
+            if batch:
+                self.ship_batch(batch)
+
+    def ship_batch(self, batch):
+        """Writes a batch to the sink, counting it as lost if that fails."""
+
+        try:
+            self.sink.write(batch)
+        except Exception:
+            with self.lock:
+                self.failed += len(batch)
+
+            return
+
+        with self.lock:
+            self.shipped += len(batch)
+
+    def get_stats(self):
+        """Returns how many records were shipped, dropped and sampled out."""
+
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "shipped": self.shipped,
+                "dropped": self.dropped,
+                "sampled_out": self.sampled_out,
+                "failed": self.failed,
+            }
+
+
+SHIPPER = None
+SHIPPER_LOCK = Lock()
+
+
+def get_shipper():
+    """Returns the process-wide shipper for the LOG_SINK sink, started on
+    first use.
+    """
+
+    global SHIPPER
+
+    with SHIPPER_LOCK:
+        if not SHIPPER:
+            SHIPPER = Shipper(SINKS[LOG_SINK]())
+
+        return SHIPPER
+
+
+def is_sampled(sample_rate):
+    """Returns whether to keep a record logged at the sample rate."""
+
+    if sample_rate >= 1 or random() < sample_rate:
+
+        return True
+
+    get_shipper().skip()
+    return False
+
+
+def log(message, severity="INFO", sample_rate=1.0, **fields):
+    """Queues a structured log record. Only a sample_rate fraction of calls
+    are kept, for noisy paths.
+    """
+
+    if not is_sampled(sample_rate):
+
+        return
+
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "severity": severity,
+        "message": message,
+    }
+    record.update(fields)
+    get_shipper().put(record)
+
+
+def report_error(message, sample_rate=1.0, **fields):
+    """Queues an error record, with the traceback of the exception being
+    handled, if any.
+    """
+
+    if not is_sampled(sample_rate):
+
+        return
+
+    if exc_info()[0] is not None:
+        fields["traceback"] = format_exc()
+
+    log(message, severity="ERROR", **fields)
+
+
+def get_log_stats():
+    """Returns the shipper statistics."""
+
+    return get_shipper().get_stats()
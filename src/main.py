@@ -1,28 +1,102 @@
+from archive import ARCHIVE_DIR
+from archive import ArchiveReader
+from archive import Archiver
+from argparse import ArgumentParser
+from breaker import UpstreamError
+from collections import deque
 from datetime import datetime
+from faults import configure_faults
+from faults import FAULTS_ENDPOINT
 from http.server import BaseHTTPRequestHandler
 from http.server import HTTPServer
+from json import dumps
+from json import loads
+from os import getenv
+from os.path import splitext
+from queue import Queue
 from threading import Event
+from threading import Lock
 from threading import Thread
+from time import monotonic
 from time import sleep
+from time import time
+from urllib.parse import parse_qsl
+from urllib.parse import urlparse
+from limits import get_limits
+from limits import Limiter
+from logs import get_log_stats
+from logs import report_error
+from market import CLOSED
+from market import MarketScheduler
+from market import PRE_OPEN
+from pubsub import Publisher
+from pubsub import PUBSUB_PATH
+from records import Company
 from sentiment import Checker
+from sentiment import COMPANY_BATCH_WAIT_S
+from sentiment import NO_TICKER_PATH
+from startup import StartupTimer
+from taskqueue import TaskDeferred
+from taskqueue import TaskPool
+from taskqueue import TaskQueue
+from store import parse_created_at
+from store import SignalStore
+from store import STORE_PATH
+from twitter import ACC_USER_ID
+from twitter import NUM_THREADS
+from twitter import STREAM_STATS
 from twitter import Twitter
+from twitter import TwitterListener
+from upstream import get_upstream_stats
 
 
 BACKOFF_STEP_S = 0.1
 MAX_TRIES = 12
 BACKOFF_RESET_S = 30 * 60
 Webserver_HOST = "0.0.0.0"
-Webserver_PORT = 1025
+Webserver_PORT = int(getenv("WEBSERVER_PORT", "1025"))
 Webserver_MESSAGE = "OK"
+Webserver_WARMING_MESSAGE = "warming"
+STARTUP_TIMER = StartupTimer()
+MARKET_SCHEDULE = getenv("MARKET_SCHEDULE", "1") == "1"
+MARKET_WARM_COMPANIES = int(getenv("MARKET_WARM_COMPANIES", "200"))
+AFTER_HOURS_WORKERS = int(getenv("AFTER_HOURS_WORKERS", "10"))
+AFTER_HOURS_BATCH_WAIT_S = float(getenv("AFTER_HOURS_BATCH_WAIT_S", "0.5"))
+DEFERRED_POSTS_MAX = 1000
+TWITTER_POST = getenv("TWITTER_POST", "1") == "1"
+POST_WORKERS = 4
+POST_RETRY_S = 60.0
+TASKQUEUE_PURGE_S = 60 * 60
+
+
+def get_worker_path(path, worker_id):
+    """Returns the path with the worker ID inserted before its extension,
+    so each work process keeps its own file, or the path unchanged if it
+    is empty.
+    """
+
+    if not path:
+
+        return path
+
+    root, extension = splitext(path)
+
+    return "%s-%s%s" % (root, worker_id, extension)
 
 
 class Webserver:
-    def __init__(self):
+    def __init__(self, port=Webserver_PORT):
         """Creates a Web server on a background thread."""
 
-        self.server = HTTPServer(
-            (Webserver_HOST, Webserver_PORT), self.WebserverHandler
-        )
+        self.server = HTTPServer((Webserver_HOST, port), self.WebserverHandler)
+        self.server.ready = Event()
+        self.server.routes = {}
+        self.add_route("/stats", lambda query: get_upstream_stats())
+        self.add_route("/stream", lambda query: STREAM_STATS.get_stats())
+        self.add_route("/limits", lambda query: get_limits())
+        self.add_route("/logs", lambda query: get_log_stats())
+        if FAULTS_ENDPOINT:
+            self.add_route("/faults", configure_faults)
         self.thread = Thread(target=self.server.serve_forever)
         self.thread.daemon = True
 
@@ -35,41 +109,62 @@ class Webserver:
         self.server.shutdown()
         self.server.server_close()
 
+    def set_ready(self):
+        """Switches the health response from warming to OK."""
+
+        self.server.ready.set()
+
+    def add_route(self, path, handler):
+        """Serves the JSON-encoded result of the handler at the path. The
+        handler is called with a dict of the query parameters.
+        """
+
+        self.server.routes[path] = handler
+
     class WebserverHandler(BaseHTTPRequestHandler):
-        def _set_headers(self):
+        def _set_headers(self, content_type="text/plain"):
             self.send_response(200)
-            self.send_header("Content-type", "text/plain")
+            self.send_header("Content-type", content_type)
             self.end_headers()
 
         def do_GET(self):
-            self._set_headers()
-            self.wfile.write(Webserver_MESSAGE.encode("utf-8"))
+            url = urlparse(self.path)
+            handler = self.server.routes.get(url.path)
+            if handler:
+                try:
+                    result = handler(dict(parse_qsl(url.query)))
+                except ValueError as error:
+                    self.send_error(400, str(error))
 
-        def do_HEAD(self):
-            self._set_headers()
+                    return
 
+                self._set_headers("application/json")
+                self.wfile.write(dumps(result).encode("utf-8"))
 
-class Main:
-    def __init__(self):
+                return
 
-        self.twitter = Twitter()
+            self._set_headers()
+            if self.server.ready.is_set():
+                message = Webserver_MESSAGE
+            else:
+                message = Webserver_WARMING_MESSAGE
+            self.wfile.write(message.encode("utf-8"))
 
-    def twitter_callback(self, tweet):
+        def do_HEAD(self):
+            self._set_headers()
 
-        checker = Checker()
 
-        companies = checker.search_company_intweet(tweet)
+class Streamer:
+    """Runs the tweet stream into a callback, reconnecting with backoff."""
 
-        if not companies:
-            return
+    def __init__(self, archive=None):
 
-        twitter = Twitter()
-        twitter.tweet(companies, tweet)
+        self.twitter = Twitter(archive=archive)
 
-    def run_session(self):
+    def run_session(self, callback):
 
         try:
-            self.twitter.start_streaming(self.twitter_callback)
+            self.twitter.start_streaming(callback)
 
         finally:
             self.twitter.stop_streaming()
@@ -80,12 +175,12 @@ class Main:
 
         sleep(delay)
 
-    def run(self):
+    def run(self, callback):
 
         tries = 0
         while True:
 
-            self.run_session()
+            self.run_session(callback)
 
             now = datetime.now()
             if tries == 0:
@@ -106,13 +201,448 @@ class Main:
             tries += 1
 
 
+class Ingest(Streamer):
+    """Queues the accepted tweets of the stream for work processes, with
+    only the Twitter client and the task queue.
+    """
+
+    def __init__(self, task_queue, archive=None):
+
+        super().__init__(archive=archive)
+        self.task_queue = task_queue
+
+    def enqueue(self, tweet):
+        """Queues an accepted tweet for the analysis workers."""
+
+        self.task_queue.put(tweet["id_str"], dumps(tweet))
+
+    def run(self):
+
+        super().run(self.enqueue)
+
+
+class Main(Streamer):
+    def __init__(
+        self,
+        publisher=None,
+        archive=None,
+        task_queue=None,
+        store_path=STORE_PATH,
+        no_ticker_path=NO_TICKER_PATH,
+        post=TWITTER_POST,
+    ):
+
+        from aggregates import SignalAggregates
+
+        super().__init__(archive=archive)
+        self.publisher = publisher
+        self.task_queue = task_queue
+        self.posting = post
+        self.checker = Checker(twitter=self.twitter, no_ticker_path=no_ticker_path)
+        self.store = SignalStore(store_path) if store_path else None
+        self.aggregates = SignalAggregates()
+        self.gate = Limiter("pipeline", NUM_THREADS, 0, 0, max_wait_s=None)
+        self.defer_posts = False
+        self.deferred_posts = deque(maxlen=DEFERRED_POSTS_MAX)
+        self.deferred_lock = Lock()
+        self.dropped_posts = 0
+        self.scheduler = MarketScheduler(self.set_phase)
+        self.posts = Queue()
+        if post and not task_queue:
+            for _ in range(POST_WORKERS):
+                poster = Thread(target=self.post_queue)
+                poster.daemon = True
+                poster.start()
+
+    def warm_up(self):
+        """Imports the client libraries and builds the API clients, so the
+        first tweet does not pay for them.
+        """
+
+        with STARTUP_TIMER.phase("twitter client"):
+            self.twitter.warm_up()
+
+        with STARTUP_TIMER.phase("language client"):
+            self.checker.warm_up()
+
+    def set_phase(self, phase):
+        """Runs the pipeline at full concurrency from the pre-open warm-up
+        to the close. After hours, fewer tweets are analyzed at once,
+        company lookups wait longer to fill their batches and posts are
+        held until the next pre-open.
+        """
+
+        if phase == CLOSED:
+            self.gate.set_concurrency(AFTER_HOURS_WORKERS)
+            self.checker.company_batcher.max_wait_s = AFTER_HOURS_BATCH_WAIT_S
+            self.defer_posts = True
+
+            return
+
+        self.gate.set_concurrency(NUM_THREADS)
+        self.checker.company_batcher.max_wait_s = COMPANY_BATCH_WAIT_S
+        self.defer_posts = False
+        if phase == PRE_OPEN:
+            self.warm_up_market()
+        self.post_deferred()
+
+    def warm_up_market(self):
+        """Rebuilds the API clients and refreshes the cached company rows of
+        the most frequently seen entities ahead of the open.
+        """
+
+        self.twitter.warm_up()
+        self.checker.warm_up()
+        self.checker.warm_companies(MARKET_WARM_COMPANIES)
+
+    def post(self, companies, tweet):
+        """Queues a post about the tweet, or holds it back after hours. With
+        a task queue, posts durably instead.
+        """
+
+        if self.task_queue:
+            self.post_durably(companies, tweet)
+        elif self.defer_posts:
+            self.defer_post(companies, tweet)
+        else:
+            self.posts.put((companies, tweet))
+
+    def defer_post(self, companies, tweet):
+        """Holds a post back until the next pre-open. Once DEFERRED_POSTS_MAX
+        are held, the oldest is dropped and reported.
+        """
+
+        with self.deferred_lock:
+            if len(self.deferred_posts) == self.deferred_posts.maxlen:
+                _, dropped = self.deferred_posts.popleft()
+                self.dropped_posts += 1
+                report_error("Deferred post dropped", tweet_id=dropped.get("id_str"))
+            self.deferred_posts.append((companies, tweet))
+
+    def post_deferred(self):
+        """Queues the posts held back after hours, oldest first."""
+
+        while True:
+            try:
+                self.posts.put(self.deferred_posts.popleft())
+            except IndexError:
+
+                return
+
+    def post_durably(self, companies, tweet):
+        """Posts about the tweet before returning, so its task is only
+        acknowledged once the post went out. After hours, or if the post
+        failed, queues the post as a task due at the next open or after
+        POST_RETRY_S instead.
+        """
+
+        if not self.defer_posts and self.twitter.tweet(companies, tweet):
+
+            return
+
+        if self.defer_posts:
+            ready_at = self.get_next_open()
+        else:
+            ready_at = time() + POST_RETRY_S
+        payload = {
+            "post": {
+                "companies": [dict(company) for company in companies],
+                "tweet": tweet,
+            }
+        }
+        self.task_queue.put("post:%s" % tweet["id_str"], dumps(payload), ready_at)
+
+    def get_next_open(self):
+        """Returns the Unix time the markets open next."""
+
+        return self.scheduler.calendar.next_open().timestamp()
+
+    def handle_task(self, payload):
+        """Analyzes a tweet from the task queue, or makes a post queued by
+        post_durably. Raises while a post cannot go out, so its task is
+        delivered again: TaskDeferred until the open after hours, or an
+        UpstreamError if posting failed.
+        """
+
+        task = loads(payload)
+        if "post" not in task:
+            self.twitter_callback(task)
+
+            return
+
+        if self.defer_posts:
+
+            raise TaskDeferred(self.get_next_open())
+
+        post = task["post"]
+        companies = [Company.from_dict(company) for company in post["companies"]]
+        if not self.twitter.tweet(companies, post["tweet"]):
+
+            raise UpstreamError("Failed to post tweet")
+
+    def post_queue(self):
+        """Posts queued tweets, off the analysis path."""
+
+        while True:
+            companies, tweet = self.posts.get()
+            self.twitter.tweet(companies, tweet)
+
+    def get_market(self, query):
+        """Returns the market phase and the pipeline mode."""
+
+        return {
+            "phase": self.scheduler.phase,
+            "workers": self.gate.get_limit(),
+            "defer_posts": self.defer_posts,
+            "deferred_posts": len(self.deferred_posts),
+            "dropped_posts": self.dropped_posts,
+            "queued_posts": self.posts.qsize(),
+        }
+
+    def twitter_callback(self, tweet, post=True):
+        """Analyzes a tweet, then publishes, aggregates, stores and, unless
+        post is off, posts what was found.
+        """
+
+        latencies = {}
+        with self.gate:
+            start_time = monotonic()
+            companies = self.checker.search_company_intweet(tweet, latencies)
+            latencies["analysis_s"] = monotonic() - start_time
+
+        if companies and self.publisher:
+            self.publisher.publish(tweet, companies)
+
+        if companies:
+            self.aggregates.add(companies, parse_created_at(tweet))
+
+        if companies and post and self.posting:
+            self.post(companies, tweet)
+
+        if self.store:
+            self.store.add(tweet, companies, latencies)
+
+    def get_signals(self, query):
+        """Returns the stored signals for the ticker in the query from the
+        last hours (24 by default).
+        """
+
+        if not self.store or "ticker" not in query:
+
+            return []
+
+        return self.store.get_signals(query["ticker"], float(query.get("hours", 24)))
+
+    def get_aggregates(self, query):
+        """Returns the rolling aggregates for the ticker in the query, or
+        the tickers that have any.
+        """
+
+        if "ticker" not in query:
+
+            return {"tickers": self.aggregates.get_tickers()}
+
+        return self.aggregates.get(query["ticker"])
+
+    def run(self):
+
+        super().run(self.twitter_callback)
+
+    def run_worker(self, workers=NUM_THREADS, worker_id=0):
+        """Analyzes the tweets on the task queue with a pool of worker
+        threads fed by one leasing thread, for as long as the process runs.
+        """
+
+        stop_event = Event()
+        pool = TaskPool(self.task_queue, self.handle_task, workers, worker_id)
+        thread = Thread(target=pool.run, args=[stop_event])
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                sleep(TASKQUEUE_PURGE_S)
+                self.task_queue.purge()
+        finally:
+            stop_event.set()
+            thread.join()
+
+    def run_replay(self, start, end, speed=None, directory=ARCHIVE_DIR):
+        """Pushes the archived stream payloads received between the start
+        and end times back through the pipeline, without posting.
+        """
+
+        listener = TwitterListener(
+            callback=lambda tweet: self.twitter_callback(tweet, post=False)
+        )
+        try:
+            return ArchiveReader(directory).replay(start, end, listener, speed)
+        finally:
+            listener.stop_queue()
+
+    def run_backfill(self, accounts, since_id=None, batch=False, **options):
+        """Runs the historical timelines of the accounts through the
+        analysis, optionally packing tweets into shared NL documents.
+        """
+
+        from backfill import Backfill
+
+        if batch:
+            from batch import BatchAnnotator
+
+            options["annotator"] = BatchAnnotator(self.checker)
+
+        backfill = Backfill(self.checker, self.twitter, **options)
+        backfill.run(accounts, since_id=since_id)
+
+
+def parse_args():
+    """Parses the command line."""
+
+    parser = ArgumentParser(description="Finds companies mentioned in tweets.")
+    parser.add_argument(
+        "mode",
+        nargs="?",
+        default="stream",
+        choices=["stream", "backfill", "replay", "ingest", "work"],
+        help="stream new tweets (default), backfill historical timelines,"
+        " replay the stream archive, or split streaming across processes:"
+        " ingest queues tweets from the stream and work analyzes them",
+    )
+    parser.add_argument(
+        "--accounts",
+        default=ACC_USER_ID,
+        help="comma-separated user IDs to backfill",
+    )
+    parser.add_argument(
+        "--since-id", help="backfill tweets newer than this ID, not including it"
+    )
+    parser.add_argument("--output", help="JSON lines file to append results to")
+    parser.add_argument("--state", help="file to keep backfill progress in")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="pack several tweets into each Natural Language request",
+    )
+    parser.add_argument(
+        "--start", type=float, default=0, help="replay from this Unix time"
+    )
+    parser.add_argument("--end", type=float, help="replay up to this Unix time")
+    parser.add_argument(
+        "--speed", type=float, help="replay at this multiple of the original pace"
+    )
+    parser.add_argument(
+        "--worker-id",
+        type=int,
+        help="stable number of a work process, required to work. It is added"
+        " to the names of the files and socket the process keeps to itself,"
+        " and it serves on WEBSERVER_PORT plus one plus the ID",
+    )
+
+    args = parser.parse_args()
+    if args.mode == "work" and (args.worker_id is None or args.worker_id < 0):
+        parser.error("work needs a --worker-id of 0 or more")
+
+    return args
+
+
 if __name__ == "__main__":
-    Webserver = Webserver()
-    Webserver.start()
-    try:
-        Main().run()
-    finally:
-        Webserver.stop()
+    args = parse_args()
+    if args.mode == "backfill":
+        options = {}
+        if args.output:
+            options["output_path"] = args.output
+        if args.state:
+            options["state_path"] = args.state
+
+        main = Main()
+        main.warm_up()
+        main.run_backfill(
+            args.accounts.split(","),
+            since_id=args.since_id,
+            batch=args.batch,
+            **options
+        )
+
+    elif args.mode == "replay":
+        main = Main(post=False)
+        main.warm_up()
+        main.run_replay(args.start, args.end or time(), speed=args.speed)
+
+    elif args.mode == "ingest":
+        with STARTUP_TIMER.phase("webserver"):
+            Webserver = Webserver()
+            Webserver.start()
+        archive = Archiver() if ARCHIVE_DIR else None
+        task_queue = TaskQueue()
+        try:
+            ingest = Ingest(task_queue, archive=archive)
+            Webserver.add_route("/tasks", lambda query: task_queue.get_stats())
+            with STARTUP_TIMER.phase("twitter client"):
+                ingest.twitter.warm_up()
+            Webserver.set_ready()
+            STARTUP_TIMER.print_report()
+            ingest.run()
+        finally:
+            Webserver.stop()
+            if archive:
+                archive.close()
+
+    else:
+        port = Webserver_PORT
+        if args.mode == "work":
+            port += 1 + args.worker_id
+        with STARTUP_TIMER.phase("webserver"):
+            Webserver = Webserver(port)
+            Webserver.start()
+        pubsub_path = PUBSUB_PATH
+        store_path = STORE_PATH
+        no_ticker_path = NO_TICKER_PATH
+        archive = None
+        task_queue = None
+        if args.mode == "work":
+            pubsub_path = get_worker_path(pubsub_path, args.worker_id)
+            store_path = get_worker_path(store_path, args.worker_id)
+            no_ticker_path = get_worker_path(no_ticker_path, args.worker_id)
+            task_queue = TaskQueue()
+            Webserver.add_route("/tasks", lambda query: task_queue.get_stats())
+        elif ARCHIVE_DIR:
+            archive = Archiver()
+        publisher = Publisher(pubsub_path) if pubsub_path else None
+        try:
+            main = Main(
+                publisher=publisher,
+                archive=archive,
+                task_queue=task_queue,
+                store_path=store_path,
+                no_ticker_path=no_ticker_path,
+            )
+            if publisher:
+                Webserver.add_route("/pubsub", lambda query: publisher.get_stats())
+            Webserver.add_route("/signals", main.get_signals)
+            Webserver.add_route("/market", main.get_market)
+            Webserver.add_route("/aggregates", main.get_aggregates)
+            Webserver.add_route(
+                "/schedule", lambda query: main.twitter.get_queue_stats()
+            )
+            Webserver.add_route(
+                "/no_ticker", lambda query: main.checker.no_ticker.get_stats()
+            )
+            main.warm_up()
+            if MARKET_SCHEDULE:
+                main.scheduler.start()
+            Webserver.set_ready()
+            STARTUP_TIMER.print_report()
+            if task_queue:
+                main.run_worker(worker_id=args.worker_id)
+            else:
+                main.run()
+        finally:
+            Webserver.stop()
+            if publisher:
+                publisher.close()
+            if archive:
+                archive.close()
 
 
 ####Modification of https://github.com/maxbbraun/trump2cash
@@ -0,0 +1,210 @@
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+from dateutil.easter import easter
+from holidays import US
+from os import getenv
+from pytz import timezone
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+from logs import report_error
+
+
+MARKET_TIMEZONE = timezone("America/New_York")
+MARKET_OPEN = time(9, 30)
+MARKET_CLOSE = time(16, 0)
+MARKET_EARLY_CLOSE = time(13, 0)
+MARKET_PRE_OPEN_S = float(getenv("MARKET_PRE_OPEN_S", str(15 * 60)))
+MARKET_CHECK_S = 30.0
+PRE_OPEN = "pre_open"
+OPEN = "open"
+CLOSED = "closed"
+NYSE_HOLIDAY_NAMES = {
+    "New Year's Day",
+    "Martin Luther King, Jr. Day",
+    "Washington's Birthday",
+    "Memorial Day",
+    "Independence Day",
+    "Labor Day",
+    "Thanksgiving",
+    "Christmas Day",
+}
+JUNETEENTH_FIRST_YEAR = 2022
+OBSERVED_SUFFIX = " (Observed)"
+
+
+def get_market_holidays(year):
+    """Returns the dates NYSE and NASDAQ are closed in the year.
+
+    These are the federal holidays except Columbus and Veterans Day, plus
+    Good Friday and, from 2022, Juneteenth. A Saturday New Year's Day is
+    not made up on the Friday before, unlike the federal calendar.
+    """
+
+    closed = set()
+    for date, name in US(years=year).items():
+        if date.year != year:
+
+            continue
+
+        if name.replace(OBSERVED_SUFFIX, "") not in NYSE_HOLIDAY_NAMES:
+
+            continue
+
+        if name.startswith("New Year's Day") and date.month == 12:
+
+            continue
+
+        closed.add(date)
+
+    closed.add(easter(year) - timedelta(days=2))
+    if year >= JUNETEENTH_FIRST_YEAR:
+        juneteenth = datetime(year, 6, 19).date()
+        if juneteenth.weekday() == 5:
+            juneteenth -= timedelta(days=1)
+        elif juneteenth.weekday() == 6:
+            juneteenth += timedelta(days=1)
+        closed.add(juneteenth)
+
+    return closed
+
+
+def get_early_closes(year):
+    """Returns the dates NYSE and NASDAQ close at 1 pm in the year: July 3,
+    the day after Thanksgiving and Christmas Eve, where they are trading
+    days.
+    """
+
+    dates = {datetime(year, 7, 3).date(), datetime(year, 12, 24).date()}
+    for date, name in US(years=year).items():
+        if name == "Thanksgiving":
+            dates.add(date + timedelta(days=1))
+
+    closed = get_market_holidays(year)
+
+    return {date for date in dates if date.weekday() < 5 and date not in closed}
+
+
+class MarketCalendar:
+    """Knows when the US stock markets trade, in New York time."""
+
+    def __init__(self, pre_open_s=MARKET_PRE_OPEN_S):
+
+        self.pre_open_s = pre_open_s
+        self.holidays = {}
+        self.early_closes = {}
+        self.lock = Lock()
+
+    def now(self):
+
+        return datetime.now(MARKET_TIMEZONE)
+
+    def is_trading_day(self, date):
+        """Returns whether the markets open on the date."""
+
+        if date.weekday() >= 5:
+
+            return False
+
+        holidays, _ = self.get_year(date.year)
+
+        return date not in holidays
+
+    def get_year(self, year):
+        """Returns the holidays and early closes of the year."""
+
+        with self.lock:
+            if year not in self.holidays:
+                self.holidays[year] = get_market_holidays(year)
+                self.early_closes[year] = get_early_closes(year)
+
+            return self.holidays[year], self.early_closes[year]
+
+    def get_session(self, date):
+        """Returns the open and close times on a trading day."""
+
+        _, early_closes = self.get_year(date.year)
+        close = MARKET_EARLY_CLOSE if date in early_closes else MARKET_CLOSE
+        open_at = MARKET_TIMEZONE.localize(datetime.combine(date, MARKET_OPEN))
+        close_at = MARKET_TIMEZONE.localize(datetime.combine(date, close))
+
+        return open_at, close_at
+
+    def get_phase(self, now=None):
+        """Returns PRE_OPEN in the run-up to the open, OPEN during the
+        session and CLOSED otherwise.
+        """
+
+        now = (now or self.now()).astimezone(MARKET_TIMEZONE)
+        if not self.is_trading_day(now.date()):
+
+            return CLOSED
+
+        open_at, close_at = self.get_session(now.date())
+        if open_at <= now < close_at:
+
+            return OPEN
+
+        if open_at - timedelta(seconds=self.pre_open_s) <= now < open_at:
+
+            return PRE_OPEN
+
+        return CLOSED
+
+    def next_open(self, now=None):
+        """Returns when the markets open next."""
+
+        now = (now or self.now()).astimezone(MARKET_TIMEZONE)
+        date = now.date()
+        while True:
+            if self.is_trading_day(date):
+                open_at, _ = self.get_session(date)
+                if open_at > now:
+
+                    return open_at
+
+            date += timedelta(days=1)
+
+
+class MarketScheduler:
+    """Calls on_phase on a background thread whenever the market moves
+    between PRE_OPEN, OPEN and CLOSED, and once with the current phase
+    when started.
+    """
+
+    def __init__(self, on_phase, calendar=None, check_s=MARKET_CHECK_S):
+
+        self.on_phase = on_phase
+        self.calendar = calendar or MarketCalendar()
+        self.check_s = check_s
+        self.phase = None
+        self.stop_event = Event()
+        self.thread = Thread(target=self.watch)
+        self.thread.daemon = True
+
+    def start(self):
+
+        self.thread.start()
+
+    def stop(self):
+
+        self.stop_event.set()
+        self.thread.join()
+
+    def watch(self):
+        """Checks the phase every check_s seconds until stopped."""
+
+        while True:
+            phase = self.calendar.get_phase()
+            if phase != self.phase:
+                self.phase = phase
+                try:
+                    self.on_phase(phase)
+                except Exception:
+                    report_error("Market phase change failed", phase=phase)
+
+            if self.stop_event.wait(self.check_s):
+
+                return
@@ -0,0 +1,181 @@
+from json import dumps
+from json import loads
+from os import getenv
+from os import remove
+from os.path import exists
+from queue import Full
+from queue import Queue
+from socket import AF_UNIX
+from socket import SOCK_STREAM
+from socket import socket
+from threading import Lock
+from threading import Thread
+from time import time
+
+
+PUBSUB_PATH = getenv("PUBSUB_PATH", "signals.sock")
+PUBSUB_BUFFER_SIZE = int(getenv("PUBSUB_BUFFER_SIZE", "1000"))
+PUBSUB_BACKLOG = 64
+
+
+def encode_signal(tweet, companies):
+    """Returns the compact JSON line published for an analyzed tweet."""
+
+    message = {
+        "id_str": tweet.get("id_str"),
+        "created_at": tweet.get("created_at"),
+        "account": tweet.get("user", {}).get("id_str"),
+        "published_at": time(),
+        "companies": [dict(company) for company in companies],
+    }
+
+    return ("%s\n" % dumps(message, separators=(",", ":"))).encode("utf-8")
+
+
+class Subscriber:
+    """One connected consumer with its own bounded queue and sender
+    thread.
+    """
+
+    def __init__(self, connection, publisher, buffer_size):
+
+        self.connection = connection
+        self.publisher = publisher
+        self.queue = Queue(buffer_size)
+        self.dropped = 0
+        self.thread = Thread(target=self.send_queue)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, message):
+        """Queues a message, or drops it if the consumer is behind."""
+
+        try:
+            self.queue.put_nowait(message)
+        except Full:
+            self.dropped += 1
+
+            return False
+
+        return True
+
+    def send_queue(self):
+        """Sends queued messages until the consumer goes away."""
+
+        while True:
+            message = self.queue.get()
+            if message is None:
+
+                break
+
+            try:
+                self.connection.sendall(message)
+            except OSError:
+
+                break
+
+        self.connection.close()
+        self.publisher.remove(self)
+
+    def close(self):
+
+        try:
+            self.queue.put_nowait(None)
+        except Full:
+            self.connection.close()
+
+
+class Publisher:
+    """Publishes analyzed tweets to local consumers over a Unix socket,
+    one JSON object per line.
+
+    publish() encodes a message once and hands it to every subscriber's
+    bounded queue without waiting. Each subscriber has its own sender
+    thread, so a slow consumer only falls behind on its own, and once its
+    queue is full its messages are dropped and counted.
+    """
+
+    def __init__(self, path=PUBSUB_PATH, buffer_size=PUBSUB_BUFFER_SIZE):
+
+        self.path = path
+        self.buffer_size = buffer_size
+        self.subscribers = set()
+        self.lock = Lock()
+        self.published = 0
+        self.dropped = 0
+        if exists(path):
+            remove(path)
+        self.server = socket(AF_UNIX, SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(PUBSUB_BACKLOG)
+        self.thread = Thread(target=self.accept)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def accept(self):
+        """Adds a subscriber for every new connection until closed."""
+
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+
+                return
+
+            subscriber = Subscriber(connection, self, self.buffer_size)
+            with self.lock:
+                self.subscribers.add(subscriber)
+
+    def remove(self, subscriber):
+
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            self.dropped += subscriber.dropped
+
+    def publish(self, tweet, companies):
+        """Sends the tweet's companies to every subscriber."""
+
+        message = encode_signal(tweet, companies)
+        with self.lock:
+            subscribers = list(self.subscribers)
+            self.published += 1
+
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+    def close(self):
+        """Stops accepting consumers and disconnects the current ones."""
+
+        self.server.close()
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.close()
+        if exists(self.path):
+            remove(self.path)
+
+    def get_stats(self):
+        """Returns the subscriber count and how many messages were
+        published and dropped.
+        """
+
+        with self.lock:
+            return {
+                "subscribers": len(self.subscribers),
+                "published": self.published,
+                "dropped": self.dropped
+                + sum(subscriber.dropped for subscriber in self.subscribers),
+            }
+
+
+def subscribe(path=PUBSUB_PATH):
+    """Connects to a publisher and yields its messages as they arrive."""
+
+    connection = socket(AF_UNIX, SOCK_STREAM)
+    connection.connect(path)
+    try:
+        with connection.makefile("rb") as lines:
+            for line in lines:
+                yield loads(line)
+    finally:
+        connection.close()
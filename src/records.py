@@ -0,0 +1,129 @@
+from collections.abc import Mapping
+
+
+class Record(Mapping):
+    """An immutable, slotted record that reads like a dict.
+
+    Fields listed in OPTIONAL are left out of the dict view while they are
+    None, which matches the plain dicts the pipeline used to pass around.
+    """
+
+    __slots__ = ()
+    OPTIONAL = ()
+
+    def __init__(self, *args, **kwargs):
+
+        values = dict(zip(self.__slots__, args))
+        values.update(kwargs)
+        for field in self.__slots__:
+            object.__setattr__(self, field, values.get(field))
+
+    def __setattr__(self, key, value):
+
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+    def __getitem__(self, key):
+
+        if key not in self.__slots__:
+
+            raise KeyError(key)
+
+        value = getattr(self, key)
+        if value is None and key in self.OPTIONAL:
+
+            raise KeyError(key)
+
+        return value
+
+    def __iter__(self):
+
+        for field in self.__slots__:
+            if field in self.OPTIONAL and getattr(self, field) is None:
+
+                continue
+
+            yield field
+
+    def __len__(self):
+
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+
+        if type(other) is type(self):
+
+            return self.astuple() == other.astuple()
+
+        return Mapping.__eq__(self, other)
+
+    def __hash__(self):
+
+        return hash(self.astuple())
+
+    def __repr__(self):
+
+        return "%s(%s)" % (
+            type(self).__name__,
+            ", ".join("%s=%r" % (key, value) for key, value in self.items()),
+        )
+
+    def astuple(self):
+        """Returns the field values in slot order."""
+
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def replace(self, **kwargs):
+        """Returns a copy with the given fields changed."""
+
+        values = dict(zip(self.__slots__, self.astuple()))
+        values.update(kwargs)
+        return type(self)(**values)
+
+
+class Company(Record):
+    """One company row resolved from Wikidata, optionally with sentiment."""
+
+    __slots__ = ("name", "ticker", "exchange", "root", "sentiment")
+    OPTIONAL = ("root", "sentiment")
+
+    @classmethod
+    def from_dict(cls, data):
+        """Creates a company from a plain dict."""
+
+        if isinstance(data, cls):
+
+            return data
+
+        return cls(
+            name=data.get("name"),
+            ticker=data.get("ticker"),
+            exchange=data.get("exchange"),
+            root=data.get("root"),
+            sentiment=data.get("sentiment"),
+        )
+
+
+class Entity(Record):
+    """The parts of a Natural Language entity the pipeline uses."""
+
+    __slots__ = ("name", "type", "mid", "salience")
+    OPTIONAL = ("mid",)
+
+    @classmethod
+    def from_api(cls, entity):
+        """Creates an entity from a Natural Language API entity."""
+
+        try:
+            mid = entity.metadata["mid"]
+        except KeyError:
+            mid = None
+
+        return cls(
+            name=entity.name, type=entity.type, mid=mid, salience=entity.salience
+        )
+
+
+def unique(records):
+    """Returns the records in order with duplicates removed."""
+
+    return list(dict.fromkeys(records))
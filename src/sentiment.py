@@ -1,12 +1,74 @@
-from google.cloud import language
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as ResultTimeout
+from concurrent.futures import wait
+from contextlib import closing
+from csv import DictReader
+from csv import Error as CsvError
+from functools import partial
+from hashlib import sha1
+from io import TextIOWrapper
+from os import getenv
 from re import compile
 from re import IGNORECASE
-from requests import get
+from threading import Lock
+from threading import Thread
+from time import monotonic
 from urllib.parse import quote_plus
 
-from twitter import Twitter
-
-WIKIDATA_QUERY_URL = "https://query.wikidata.org/sparql?query=%s&format=JSON"
+from batcher import MicroBatcher
+from bloom import NegativeFilter
+from breaker import UpstreamError
+from cache import MISSING
+from cache import TTLCache
+from logs import report_error
+from records import Company
+from records import Entity
+from records import unique
+from upstream import get_upstream
+
+WIKIDATA_CSV_URL = "https://query.wikidata.org/sparql?query=%s"
+WIKIDATA_CSV_TYPE = "text/csv"
+SKIPPED_ENTITY_TYPES = getenv(
+    "SKIPPED_ENTITY_TYPES", "PERSON,LOCATION,EVENT"
+).split(",")
+ENTITY_MIN_SALIENCE = float(getenv("ENTITY_MIN_SALIENCE", "0"))
+TWEET_DEADLINE_S = float(getenv("TWEET_DEADLINE_S", "10"))
+TWEET_DEADLINE_DROP = getenv("TWEET_DEADLINE_DROP", "0") == "1"
+FANOUT_WORKERS = int(getenv("FANOUT_WORKERS", "32"))
+SENTIMENT_SPECULATIVE = getenv("SENTIMENT_SPECULATIVE", "1") == "1"
+SENTIMENT_WORKERS = int(getenv("SENTIMENT_WORKERS", "8"))
+COMPANY_CACHE_SIZE = int(getenv("COMPANY_CACHE_SIZE", "10000"))
+COMPANY_CACHE_TTL_S = float(getenv("COMPANY_CACHE_TTL_S", str(6 * 60 * 60)))
+COMPANY_CACHE_MAX_STALE_S = float(
+    getenv("COMPANY_CACHE_MAX_STALE_S", str(7 * 24 * 60 * 60))
+)
+QID_CACHE_TTL_S = float(getenv("QID_CACHE_TTL_S", str(7 * 24 * 60 * 60)))
+LABEL_CACHE_SIZE = int(getenv("LABEL_CACHE_SIZE", "50000"))
+LABEL_CACHE_TTL_S = float(getenv("LABEL_CACHE_TTL_S", str(7 * 24 * 60 * 60)))
+COMPANY_BATCH_SIZE = int(getenv("COMPANY_BATCH_SIZE", "20"))
+COMPANY_BATCH_WAIT_S = float(getenv("COMPANY_BATCH_WAIT_S", "0.005"))
+TEXT_CACHE_SIZE = int(getenv("TEXT_CACHE_SIZE", "10000"))
+TEXT_CACHE_TTL_S = float(getenv("TEXT_CACHE_TTL_S", str(60 * 60)))
+TEXT_CACHE_STRIP = getenv("TEXT_CACHE_STRIP", "1") == "1"
+NO_TICKER_PATH = getenv("NO_TICKER_PATH", "")
+NO_TICKER_CAPACITY = int(getenv("NO_TICKER_CAPACITY", "200000"))
+NO_TICKER_ERROR_RATE = float(getenv("NO_TICKER_ERROR_RATE", "0.0001"))
+NO_TICKER_REBUILD_S = float(getenv("NO_TICKER_REBUILD_S", str(7 * 24 * 60 * 60)))
+WIKIDATA_ERROR_CODES = [429, 500, 502, 503, 504]
+WIKIDATA = get_upstream("wikidata", slow_call_s=10)
+NL_ENTITIES = get_upstream("nl_entities")
+NL_SENTIMENT = get_upstream("nl_sentiment")
+COMPANY_CACHE = TTLCache(
+    COMPANY_CACHE_SIZE, COMPANY_CACHE_TTL_S, COMPANY_CACHE_MAX_STALE_S
+)
+QID_CACHE = TTLCache(COMPANY_CACHE_SIZE, QID_CACHE_TTL_S)
+LISTING_CACHE = TTLCache(COMPANY_CACHE_SIZE, COMPANY_CACHE_TTL_S)
+LABEL_CACHE = TTLCache(LABEL_CACHE_SIZE, LABEL_CACHE_TTL_S)
+TEXT_CACHE = TTLCache(TEXT_CACHE_SIZE, TEXT_CACHE_TTL_S)
+URL_PATTERN = compile(r"https?://\S+")
+MENTION_PATTERN = compile(r"@\w+")
+WHITESPACE_PATTERN = compile(r"\s+")
 
 MID_TO_TICKER_QUERY = (
     "SELECT ?companyLabel ?rootLabel ?tickerLabel ?exchangeNameLabel"
@@ -42,55 +104,535 @@ MID_TO_TICKER_QUERY = (
     " ORDER BY ?companyLabel ?rootLabel ?tickerLabel ?exchangeNameLabel"
 )
 
+COMPANY_COLUMNS = ["companyLabel", "rootLabel", "tickerLabel", "exchangeNameLabel"]
+ENTITY_PREFIX = "http://www.wikidata.org/entity/"
+
+# The ownership walk and exclusion filters of MID_TO_TICKER_QUERY, without
+# the MID lookup and the labels.
+LISTING_PATTERN = MID_TO_TICKER_QUERY.split('?entity wdt:P646 "%s" .')[1].split(
+    "  SERVICE wikibase:label"
+)[0]
+MIDS_TO_QIDS_QUERY = (
+    "SELECT ?mid ?entity WHERE {"
+    "  VALUES ?mid { %s } ."
+    "  ?entity wdt:P646 ?mid ."
+    " }"
+)
+QIDS_TO_LISTINGS_QUERY = (
+    "SELECT DISTINCT ?entity ?company ?root ?ticker ?exchangeName WHERE {"
+    "  VALUES ?entity { %s } ." + LISTING_PATTERN + " }"
+)
+QIDS_TO_LABELS_QUERY = (
+    "SELECT ?item ?itemLabel WHERE {"
+    "  VALUES ?item { %s } ."
+    "  SERVICE wikibase:label {"
+    '   bd:serviceParam wikibase:language "en" .'
+    "  }"
+    " }"
+)
+
+
+def get_qid(iri):
+    """Returns the item ID at the end of a Wikidata entity IRI."""
+
+    if not iri or not iri.startswith(ENTITY_PREFIX):
+
+        return None
+
+    return iri[len(ENTITY_PREFIX) :]
+
+
+def get_row_order(row):
+    """Sorts company rows like ORDER BY on their labels, unbound first."""
+
+    return [(row[name] is not None, row[name] or "") for name in COMPANY_COLUMNS]
+
+
+FANOUT_EXECUTOR = None
+FANOUT_EXECUTOR_LOCK = Lock()
+SENTIMENT_EXECUTOR = None
+SENTIMENT_EXECUTOR_LOCK = Lock()
+NO_TICKER_FILTERS = {}
+NO_TICKER_FILTER_LOCK = Lock()
+
+
+def get_fanout_executor():
+    """Returns the process-wide pool the remote calls of a tweet are fanned
+    out on, created on first use. It is shared by every worker so the
+    calls in flight stay bounded by FANOUT_WORKERS.
+    """
+
+    global FANOUT_EXECUTOR
+
+    with FANOUT_EXECUTOR_LOCK:
+        if not FANOUT_EXECUTOR:
+            FANOUT_EXECUTOR = ThreadPoolExecutor(
+                max_workers=FANOUT_WORKERS, thread_name_prefix="fanout"
+            )
+
+        return FANOUT_EXECUTOR
+
+
+def get_sentiment_executor():
+    """Returns the process-wide pool speculative sentiment requests run on,
+    created on first use. It is kept apart from the fan-out pool, so a
+    burst of company lookups cannot hold up the sentiment of a tweet.
+    """
+
+    global SENTIMENT_EXECUTOR
+
+    with SENTIMENT_EXECUTOR_LOCK:
+        if not SENTIMENT_EXECUTOR:
+            SENTIMENT_EXECUTOR = ThreadPoolExecutor(
+                max_workers=SENTIMENT_WORKERS, thread_name_prefix="sentiment"
+            )
+
+        return SENTIMENT_EXECUTOR
+
+
+def get_no_ticker_filter(path=NO_TICKER_PATH):
+    """Returns the process-wide filter of MIDs known to have no ticker,
+    loaded from the path on first use and saved back to it. Without a
+    path, the filter is kept in memory only.
+    """
+
+    with NO_TICKER_FILTER_LOCK:
+        if path not in NO_TICKER_FILTERS:
+            NO_TICKER_FILTERS[path] = NegativeFilter(
+                NO_TICKER_CAPACITY,
+                NO_TICKER_ERROR_RATE,
+                NO_TICKER_REBUILD_S,
+                path=path or None,
+            )
+
+        return NO_TICKER_FILTERS[path]
+
+
+def clear_caches():
+    """Empties the process-wide company, entity, label and text caches and
+    the no-ticker filters, so the next lookups go upstream again.
+    """
+
+    for cache in (COMPANY_CACHE, QID_CACHE, LISTING_CACHE, LABEL_CACHE, TEXT_CACHE):
+        cache.clear()
+    with NO_TICKER_FILTER_LOCK:
+        for no_ticker in NO_TICKER_FILTERS.values():
+            no_ticker.clear()
+
+
+def get_language():
+    """Imports the Cloud Natural Language library on first use, since its
+    gRPC and protobuf stack dominates startup time.
+    """
+
+    from google.cloud import language
+
+    return language
+
+
+def get_text_key(text, strip=TEXT_CACHE_STRIP):
+    """Returns a hash of the text with its whitespace collapsed, and with
+    URLs and remaining @mentions removed if strip is set, so reposts of the
+    same statement share a key.
+    """
+
+    if strip:
+        text = URL_PATTERN.sub(" ", text)
+        text = MENTION_PATTERN.sub(" ", text)
+    text = WHITESPACE_PATTERN.sub(" ", text).strip()
+
+    return sha1(text.encode("utf-8")).hexdigest()
+
 
 class Checker:
     """A helper for analyzing company data in text."""
 
-    def __init__(self):
-        self.language_client = language.LanguageServiceClient()
-        self.twitter = Twitter()
+    def __init__(self, twitter=None, no_ticker_path=NO_TICKER_PATH):
+        self._language_client = None
+        self._twitter = twitter
+        self._skipped_types = None
+        self.company_cache = COMPANY_CACHE
+        self.qid_cache = QID_CACHE
+        self.listing_cache = LISTING_CACHE
+        self.label_cache = LABEL_CACHE
+        self.text_cache = TEXT_CACHE
+        self.no_ticker = get_no_ticker_filter(no_ticker_path)
+        self.refreshing = set()
+        self.refreshing_lock = Lock()
+        self.mid_counts = Counter()
+        self.mid_counts_lock = Lock()
+        self.company_batcher = MicroBatcher(
+            self.fetch_cmpy_infos, COMPANY_BATCH_SIZE, COMPANY_BATCH_WAIT_S
+        )
 
-    def scrape_cmpy_info(self, mid):
+    @property
+    def language_client(self):
+        """The Natural Language client, created on first use."""
 
-        query = MID_TO_TICKER_QUERY % mid
-        bindings = self.retrieve_wikidata_data(query)
+        if not self._language_client:
+            self._language_client = get_language().LanguageServiceClient()
 
-        if not bindings:
-            return None
+        return self._language_client
 
-        datas = []
-        for binding in bindings:
-            try:
-                name = binding["companyLabel"]["value"]
-            except KeyError:
-                name = None
+    @property
+    def twitter(self):
+        """The Twitter helper, created on first use."""
+
+        if not self._twitter:
+            from twitter import Twitter
+
+            self._twitter = Twitter()
+
+        return self._twitter
+
+    def warm_up(self):
+        """Imports the client libraries and builds the Natural Language
+        client ahead of the first request.
+        """
+
+        import requests  # noqa: F401
+
+        return self.language_client
+
+    @property
+    def skipped_types(self):
+        """The entity types that never map to a ticker."""
+
+        if self._skipped_types is None:
+            entity_type = get_language().enums.Entity.Type
+            self._skipped_types = {
+                entity_type[name] for name in SKIPPED_ENTITY_TYPES if name
+            }
+
+        return self._skipped_types
+
+    def prioritize_entities(self, entities):
+        """Returns the entities worth resolving, most salient first, with
+        one entity per MID.
+        """
+
+        candidates = {}
+        for entity in entities:
+            if not entity.mid or entity.type in self.skipped_types:
+
+                continue
+
+            if entity.salience < ENTITY_MIN_SALIENCE:
+
+                continue
+
+            existing = candidates.get(entity.mid)
+            if not existing or existing.salience < entity.salience:
+                candidates[entity.mid] = entity
+
+        return sorted(
+            candidates.values(), key=lambda entity: entity.salience, reverse=True
+        )
+
+    def resolve_entities(self, entities, deadline):
+        """Looks up company data for every entity concurrently on the
+        fan-out pool and waits for the lookups until the deadline. Returns
+        the company data by MID, without the lookups still running at the
+        deadline, or None if there were any and such tweets are dropped,
+        and whether any lookup failed or was left running.
+        """
+
+        candidates = self.prioritize_entities(entities)
+        with self.mid_counts_lock:
+            self.mid_counts.update(entity.mid for entity in candidates)
+
+        executor = get_fanout_executor()
+        futures = {
+            entity.mid: executor.submit(
+                self.lookup_cmpy_info_until, entity.mid, deadline
+            )
+            for entity in candidates
+        }
+
+        _, pending = wait(futures.values(), timeout=max(deadline - monotonic(), 0))
+        for future in pending:
+            future.cancel()
+        if pending and TWEET_DEADLINE_DROP:
+
+            return None, True
+
+        resolved = {}
+        degraded = bool(pending)
+        for mid, future in futures.items():
+            if future in pending:
+
+                continue
 
             try:
-                root = binding["rootLabel"]["value"]
-            except KeyError:
-                root = None
+                resolved[mid] = future.result()
+            except (UpstreamError, ResultTimeout):
+                report_error("Company lookup failed", sample_rate=0.1, mid=mid)
+                resolved[mid] = None
+                degraded = True
+
+        return resolved, degraded
+
+    def lookup_cmpy_info_until(self, mid, deadline):
+        """Looks up the company rows for a MID, waiting until the deadline."""
+
+        return self.lookup_cmpy_info(mid, timeout=max(deadline - monotonic(), 0))
+
+    def scrape_cmpy_info(self, mid, timeout=None):
+        """Returns the company rows for a MID, or None if it has none or the
+        lookup failed.
+        """
+
+        try:
+            return self.lookup_cmpy_info(mid, timeout=timeout)
+        except (UpstreamError, ResultTimeout):
+            report_error("Company lookup failed", sample_rate=0.1, mid=mid)
 
+            return None
+
+    def lookup_cmpy_info(self, mid, timeout=None):
+        """Returns the company rows for a MID, from the cache if fresh. A
+        stale cached answer is returned straight away and refreshed in the
+        background, and is also served while Wikidata is failing. MIDs that
+        recently had no ticker are skipped without a lookup. Raises if the
+        lookup failed.
+        """
+
+        if mid in self.no_ticker:
+
+            return None
+
+        companies = self.company_cache.get(mid)
+        if companies is not MISSING:
+
+            return companies
+
+        companies = self.company_cache.get_stale(mid)
+        if companies is not MISSING:
+            self.refresh_cmpy_info(mid)
+
+            return companies
+
+        return self.company_batcher.get(mid, timeout=timeout)
+
+    def warm_companies(self, count):
+        """Looks up the count most frequently seen MIDs in batches, so
+        their company rows are fresh in the cache.
+        """
+
+        with self.mid_counts_lock:
+            mids = [mid for mid, _ in self.mid_counts.most_common(count)]
+        mids = [mid for mid in mids if mid not in self.no_ticker]
+
+        for start in range(0, len(mids), COMPANY_BATCH_SIZE):
             try:
-                ticker = binding["tickerLabel"]["value"]
-            except KeyError:
-                ticker = None
+                self.fetch_cmpy_infos(mids[start : start + COMPANY_BATCH_SIZE])
+            except UpstreamError:
+                report_error("Company warm-up failed")
+
+                return
+
+    def refresh_cmpy_info(self, mid):
+        """Re-fetches the company rows for a MID on a background thread,
+        unless a refresh is already running or Wikidata is failing.
+        """
+
+        if WIKIDATA.breaker.is_open():
+
+            return
+
+        with self.refreshing_lock:
+            if mid in self.refreshing:
+
+                return
+
+            self.refreshing.add(mid)
+
+        def refresh():
 
             try:
-                exchange = binding["exchangeNameLabel"]["value"]
-            except KeyError:
-                exchange = None
+                self.company_batcher.get(mid)
+            except UpstreamError:
+                report_error("Company refresh failed", sample_rate=0.1, mid=mid)
+
+            finally:
+                with self.refreshing_lock:
+                    self.refreshing.discard(mid)
+
+        thread = Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def fetch_cmpy_infos(self, mids, timeout=None):
+        """Looks up the company rows for several MIDs and caches them.
+        Returns the rows by MID and raises UpstreamError if Wikidata fails
+        or the timeout runs out.
+
+        Resolution runs in three batched phases, each with its own cache:
+        MIDs to Wikidata items, items to their listed owners with ticker
+        and exchange, and items to English labels. Only what none of the
+        caches hold is queried, and the phases share the timeout.
+        """
+
+        deadline = None if timeout is None else monotonic() + timeout
+        qids_by_mid = self.get_cached(
+            self.qid_cache, mids, partial(self.fetch_qids, deadline=deadline)
+        )
+        qids = unique(qid for qids in qids_by_mid.values() for qid in qids or [])
+        listings_by_qid = self.get_cached(
+            self.listing_cache, qids, partial(self.fetch_listings, deadline=deadline)
+        )
+        label_qids = unique(
+            qid
+            for listings in listings_by_qid.values()
+            for company, root, _, exchange in listings or []
+            for qid in [company, root, exchange]
+            if qid
+        )
+        labels = self.get_cached(
+            self.label_cache, label_qids, partial(self.fetch_labels, deadline=deadline)
+        )
+
+        companies_by_mid = {}
+        for mid in mids:
+            rows = []
+            for qid in qids_by_mid.get(mid) or []:
+                for company, root, ticker, exchange in listings_by_qid.get(qid) or []:
+                    rows.append(
+                        {
+                            "companyLabel": labels.get(company),
+                            "rootLabel": labels.get(root),
+                            "tickerLabel": ticker,
+                            "exchangeNameLabel": labels.get(exchange),
+                        }
+                    )
+            rows.sort(key=get_row_order)
+            companies = self.parse_cmpy_rows(rows)
+            self.company_cache.set(mid, companies)
+            if companies is None:
+                self.no_ticker.add(mid)
+            companies_by_mid[mid] = companies
+
+        return companies_by_mid
+
+    def get_cached(self, cache, keys, fetch):
+        """Returns the values for the keys, from the cache where fresh. The
+        rest are fetched with one call and cached, including misses.
+        """
 
-            data = {"name": name, "ticker": ticker, "exchange": exchange}
+        values = {}
+        missing = []
+        for key in keys:
+            value = cache.get(key)
+            if value is MISSING:
+                missing.append(key)
+            else:
+                values[key] = value
+
+        if missing:
+            fetched = fetch(missing)
+            for key in missing:
+                values[key] = fetched.get(key)
+                cache.set(key, values[key])
+
+        return values
+
+    def query_rows(self, query, key, deadline=None):
+        """Runs a SPARQL query and returns its rows grouped by the key
+        column, waiting until the deadline or TWEET_DEADLINE_S without
+        one. Raises UpstreamError if Wikidata fails or the deadline has
+        passed.
+        """
+
+        timeout = TWEET_DEADLINE_S
+        if deadline is not None:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+
+                raise UpstreamError("Wikidata deadline passed")
+
+        return WIKIDATA.call(self.get_wikidata_rows, query, key=key, timeout=timeout)
+
+    def fetch_qids(self, mids, deadline=None):
+        """Returns the Wikidata items of each MID."""
+
+        query = MIDS_TO_QIDS_QUERY % " ".join('"%s"' % mid for mid in mids)
+        rows_by_mid = self.query_rows(query, "mid", deadline)
 
-            if root and root != name:
-                data["root"] = root
+        return {
+            mid: tuple(get_qid(row["entity"]) for row in rows if "entity" in row)
+            for mid, rows in rows_by_mid.items()
+        }
 
-            if data not in datas:
-                datas.append(data)
+    def fetch_listings(self, qids, deadline=None):
+        """Returns the listings of each item or of its owners, as company,
+        root, ticker and exchange tuples with items as IDs.
+        """
+
+        query = QIDS_TO_LISTINGS_QUERY % " ".join("wd:%s" % qid for qid in qids)
+        rows_by_entity = self.query_rows(query, "entity", deadline)
+
+        return {
+            get_qid(entity): tuple(
+                (
+                    get_qid(row.get("company")),
+                    get_qid(row.get("root")),
+                    row.get("ticker"),
+                    get_qid(row.get("exchangeName")),
+                )
+                for row in rows
+            )
+            for entity, rows in rows_by_entity.items()
+        }
+
+    def fetch_labels(self, qids, deadline=None):
+        """Returns the English label of each item."""
+
+        query = QIDS_TO_LABELS_QUERY % " ".join("wd:%s" % qid for qid in qids)
+        rows_by_item = self.query_rows(query, "item", deadline)
+
+        return {
+            get_qid(item): rows[0].get("itemLabel", get_qid(item))
+            for item, rows in rows_by_item.items()
+        }
+
+    def parse_cmpy_rows(self, rows):
+        """Converts result rows of label by column name into company rows."""
+
+        if not rows:
+            return None
+
+        datas = []
+        for row in rows:
+            name = row.get("companyLabel")
+            root = row.get("rootLabel")
+            if not root or root == name:
+                root = None
 
-        return datas
+            datas.append(
+                Company(
+                    name=name,
+                    ticker=row.get("tickerLabel"),
+                    exchange=row.get("exchangeNameLabel"),
+                    root=root,
+                )
+            )
+
+        return unique(datas)
+
+    def search_company_intweet(self, tweet, latencies=None):
+        """Returns the companies mentioned in the tweet with its sentiment.
+        Results are cached by text, so reposts of a statement skip every
+        remote call, unless a lookup or the sentiment failed.
+
+        The sentiment is requested alongside the entity analysis unless
+        SENTIMENT_SPECULATIVE is off, and the entities are then looked up
+        concurrently, so a tweet takes about as long as its slowest calls
+        in sequence rather than all of them. A sentiment still missing at
+        the deadline counts as 0, as if the request had failed.
+        """
 
-    def search_company_intweet(self, tweet):
+        if latencies is None:
+            latencies = {}
 
         if not tweet:
 
@@ -101,39 +643,98 @@ class Checker:
 
             return None
 
+        text_key = get_text_key(text)
+        companies = self.text_cache.get(text_key)
+        if companies is not MISSING:
+
+            return list(companies)
+
+        language = get_language()
         document = language.types.Document(
             content=text, type=language.enums.Document.Type.PLAIN_TEXT, language="en"
         )
-        entities = self.language_client.analyze_entities(document).entities
+        start_time = monotonic()
+        deadline = start_time + TWEET_DEADLINE_S
+        if SENTIMENT_SPECULATIVE:
+            sentiment = get_sentiment_executor().submit(self.analyze_sentiment, text)
 
-        companies = []
-        for entity in entities:
+            def get_sentiment():
 
-            name = entity.name
-            metadata = entity.metadata
-            try:
-                mid = metadata["mid"]
-            except KeyError:
+                return sentiment.result(timeout=max(deadline - monotonic(), 0))
 
-                continue
+        else:
+            get_sentiment = partial(self.analyze_sentiment, text)
 
-            company_data = self.scrape_cmpy_info(mid)
+        try:
+            response = NL_ENTITIES.call(
+                self.language_client.analyze_entities, document
+            )
+        except Exception:
+            report_error("Entity analysis failed", tweet_id=tweet.get("id_str"))
+
+            return None
+
+        finally:
+            latencies["entities_s"] = monotonic() - start_time
+
+        entities = [Entity.from_api(entity) for entity in response.entities]
+        companies, degraded = self.find_companies(
+            entities, get_sentiment, deadline, latencies
+        )
+        if not degraded:
+            self.text_cache.set(text_key, tuple(companies))
+
+        return companies
+
+    def find_companies(self, entities, get_sentiment, deadline, latencies=None):
+        """Resolves the entities to one company row per ticker, in entity
+        order. get_sentiment is only called once a company is found, and if
+        it raises the sentiment is 0. Returns the companies and whether any
+        lookup or the sentiment failed. The time spent resolving and
+        waiting for the sentiment is added to latencies.
+        """
+
+        if latencies is None:
+            latencies = {}
+
+        start_time = monotonic()
+        resolved, degraded = self.resolve_entities(entities, deadline)
+        latencies["resolve_s"] = monotonic() - start_time
+        if resolved is None:
+
+            return [], degraded
+
+        companies = []
+        tickers = set()
+        sentiment = None
+        for entity in entities:
+
+            company_data = resolved.pop(entity.mid, None)
 
             if not company_data:
 
                 continue
 
+            if sentiment is None:
+                start_time = monotonic()
+                try:
+                    sentiment = get_sentiment()
+                except Exception:
+                    report_error("Sentiment analysis failed")
+                    sentiment = 0
+                    degraded = True
+                latencies["sentiment_s"] = monotonic() - start_time
+
             for company in company_data:
 
-                sentiment = self.gnlp_sentiment(text)
+                if company.ticker in tickers:
 
-                company["sentiment"] = sentiment
+                    continue
 
-                tickers = [existing["ticker"] for existing in companies]
-                if not company["ticker"] in tickers:
-                    companies.append(company)
+                tickers.add(company.ticker)
+                companies.append(company.replace(sentiment=sentiment))
 
-        return companies
+        return companies, degraded
 
     def get_longtext(self, tweet):
         """Retrieves the text from a tweet with any @mentions expanded to
@@ -172,25 +773,74 @@ class Checker:
 
         return text
 
-    def retrieve_wikidata_data(self, query):
+    def get_wikidata_rows(self, query, key="mid", timeout=None):
+        """Runs a SPARQL query for CSV results and parses the rows as they
+        arrive, without holding the whole body. Returns the rows grouped by
+        the key column, each a dict of the bound values by column name.
+        Raises UpstreamError if Wikidata fails, also when the connection
+        breaks partway through the body.
+        """
 
-        query_url = WIKIDATA_QUERY_URL % quote_plus(query)
+        from requests import RequestException
+        from urllib3.exceptions import HTTPError as TransportError
 
-        response = get(query_url)
-        try:
-            response_json = response.json()
-        except ValueError:
+        response = self.get_wikidata(query, timeout=timeout)
+        rows_by_key = {}
+        with closing(response):
+            content_type = response.headers.get("Content-Type", "")
+            if not content_type.startswith(WIKIDATA_CSV_TYPE):
 
-            return None
+                return rows_by_key
+
+            response.raw.decode_content = True
+            lines = TextIOWrapper(response.raw, encoding="utf-8", newline="")
+            try:
+                for row in DictReader(lines):
+                    value = row.pop(key, None)
+                    if not value:
+
+                        continue
+
+                    row = {name: value for name, value in row.items() if value}
+                    rows_by_key.setdefault(value, []).append(row)
+            except (
+                RequestException,
+                TransportError,
+                OSError,
+                CsvError,
+                UnicodeDecodeError,
+            ) as exception:
+
+                raise UpstreamError("Wikidata error: %s" % exception)
+
+        return rows_by_key
+
+    def get_wikidata(self, query, timeout=None):
+        """Sends a SPARQL query for a streamed CSV response. Raises
+        UpstreamError on connection errors and on server-side or rate
+        limit responses.
+        """
+
+        from requests import get
+        from requests import RequestException
 
         try:
-            results = response_json["results"]
-            bindings = results["bindings"]
-        except KeyError:
+            response = get(
+                WIKIDATA_CSV_URL % quote_plus(query),
+                headers={"Accept": WIKIDATA_CSV_TYPE},
+                timeout=timeout,
+                stream=True,
+            )
+        except RequestException as exception:
 
-            return None
+            raise UpstreamError("Wikidata error: %s" % exception)
 
-        return bindings
+        if response.status_code in WIKIDATA_ERROR_CODES:
+            response.close()
+
+            raise UpstreamError("Wikidata error: %s" % response.status_code)
+
+        return response
 
     def convert_entity_string(self, entities):
 
@@ -215,16 +865,29 @@ class Checker:
 
     def gnlp_sentiment(self, text):
 
+        try:
+            return self.analyze_sentiment(text)
+        except Exception:
+            report_error("Sentiment analysis failed")
+
+            return 0
+
+    def analyze_sentiment(self, text):
+        """Returns the sentiment score of the text. Raises if the request
+        failed.
+        """
+
         if not text:
 
             return 0
 
+        language = get_language()
         document = language.types.Document(
             content=text, type=language.enums.Document.Type.PLAIN_TEXT, language="en"
         )
-        sentiment = self.language_client.analyze_sentiment(document).document_sentiment
+        response = NL_SENTIMENT.call(self.language_client.analyze_sentiment, document)
 
-        return sentiment.score
+        return response.document_sentiment.score
 
 
 ### Modification of https://github.com/maxbbraun/trump2cash
@@ -0,0 +1,537 @@
+from argparse import ArgumentParser
+from datetime import datetime
+from datetime import timezone
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from json import dumps
+from os.path import join
+from random import Random
+from ssl import PROTOCOL_TLS_SERVER
+from ssl import SSLContext
+from subprocess import run
+from tempfile import mkdtemp
+from threading import Event
+from threading import Lock
+from threading import Thread
+from time import monotonic
+from time import sleep
+from time import time
+from urllib.parse import parse_qsl
+from urllib.parse import urlparse
+from zlib import compressobj
+from zlib import Z_SYNC_FLUSH
+
+from freshness import TWITTER_EPOCH_MS
+from store import TWITTER_TIME_FORMAT
+from twitter import ACC_USER_ID
+
+
+STANDIN_HOST = "localhost"
+STANDIN_PORT = 8443
+TIMELINE_STEP_MS = 60 * 1000
+SHORT_TEXT_SIZE = 140
+STREAM_PATH = "/1.1/statuses/filter.json"
+UPDATE_PATH = "/1.1/statuses/update.json"
+TIMELINE_PATH = "/1.1/statuses/user_timeline.json"
+SHOW_PATH = "/1.1/statuses/show.json"
+STATS_PATH = "/stats"
+ERROR_MESSAGES = {
+    420: "Enhance Your Calm",
+    429: "Rate limit exceeded",
+    500: "Internal error",
+    503: "Over capacity",
+}
+COMPANIES = [
+    "Boeing",
+    "Ford",
+    "General Motors",
+    "Amazon",
+    "Toyota",
+    "Lockheed Martin",
+    "Harley-Davidson",
+    "Carrier",
+    "Apple",
+    "Exxon",
+]
+WORDS = (
+    "the great jobs deal tremendous trade china tariffs plant american"
+    " workers market fake news very bad unfair taxes cost billions of"
+    " dollars move back country thank you big announcement today"
+).split()
+
+
+class TweetFactory:
+    """Makes synthetic tweets shaped like the ones Twitter sends.
+
+    target_ratio of the stream tweets come from the followed account, the
+    rest from random users, as replies and retweets do. Each tweet has up
+    to max_mentions @mentions and a text of min_chars to max_chars, and
+    longer texts are truncated into extended_tweet like on the stream.
+    """
+
+    def __init__(
+        self, target_ratio=0.1, max_mentions=2, min_chars=40, max_chars=280, seed=None
+    ):
+
+        self.target_ratio = target_ratio
+        self.max_mentions = max_mentions
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.random = Random(seed)
+        self.lock = Lock()
+        self.sequence = 0
+
+    def next_id(self, timestamp_ms=None):
+        """Returns a snowflake ID for the time, unique within the factory."""
+
+        if timestamp_ms is None:
+            timestamp_ms = int(time() * 1000)
+
+        with self.lock:
+            self.sequence = (self.sequence + 1) % (1 << 22)
+            return ((timestamp_ms - TWITTER_EPOCH_MS) << 22) | self.sequence
+
+    def make_text(self, mentions):
+
+        size = self.random.randint(self.min_chars, self.max_chars)
+        words = ["@%s" % mention["screen_name"] for mention in mentions]
+        words.append(self.random.choice(COMPANIES))
+        while len(" ".join(words)) < size:
+            if self.random.random() < 0.1:
+                words.append(self.random.choice(COMPANIES))
+            else:
+                words.append(self.random.choice(WORDS))
+        self.random.shuffle(words)
+
+        return " ".join(words)[:size]
+
+    def make_mentions(self):
+
+        mentions = []
+        for _ in range(self.random.randint(0, self.max_mentions)):
+            user_id = str(self.random.randint(10 ** 8, 10 ** 10))
+            mentions.append(
+                {
+                    "id_str": user_id,
+                    "screen_name": "user%s" % user_id,
+                    "name": self.random.choice(COMPANIES),
+                }
+            )
+
+        return mentions
+
+    def make_tweet(self, user_id=None, tweet_id=None, text=None, extended=False):
+        """Returns a tweet as a dict. Without a user ID, the author is
+        picked by the target ratio. REST responses in extended mode carry
+        full_text instead of text.
+        """
+
+        if not user_id:
+            if self.random.random() < self.target_ratio:
+                user_id = ACC_USER_ID
+            else:
+                user_id = str(self.random.randint(10 ** 8, 10 ** 10))
+        if not tweet_id:
+            tweet_id = self.next_id()
+
+        mentions = self.make_mentions() if text is None else []
+        if text is None:
+            text = self.make_text(mentions)
+        timestamp = ((tweet_id >> 22) + TWITTER_EPOCH_MS) / 1000
+        created_at = datetime.fromtimestamp(timestamp, timezone.utc)
+        tweet = {
+            "created_at": created_at.strftime(TWITTER_TIME_FORMAT),
+            "id": tweet_id,
+            "id_str": str(tweet_id),
+            "user": {"id_str": user_id, "screen_name": "user%s" % user_id},
+            "entities": {"user_mentions": mentions, "hashtags": [], "urls": []},
+            "truncated": False,
+        }
+        if extended:
+            tweet["full_text"] = text
+        elif len(text) > SHORT_TEXT_SIZE:
+            tweet["text"] = "%s…" % text[: SHORT_TEXT_SIZE - 1]
+            tweet["truncated"] = True
+            tweet["extended_tweet"] = {
+                "full_text": text,
+                "entities": tweet["entities"],
+            }
+        else:
+            tweet["text"] = text
+
+        return tweet
+
+
+class StandIn:
+    """A local HTTPS server that speaks the parts of the Twitter API the
+    bot uses: the streaming filter endpoint, statuses/update,
+    statuses/user_timeline and statuses/show.
+
+    The stream sends length-delimited tweets at a Poisson rate, with
+    keep-alive newlines in between, and gzips them when asked to. Connections
+    are cut after an exponentially distributed time with a mean of
+    disconnect_s, and a new stream is refused with one of error_codes with
+    probability error_rate. REST calls fail with probability api_error_rate.
+    """
+
+    def __init__(
+        self,
+        factory,
+        certfile,
+        keyfile,
+        port=STANDIN_PORT,
+        rate=10.0,
+        keep_alive_s=30.0,
+        disconnect_s=0,
+        error_rate=0,
+        error_codes=(420, 503),
+        api_error_rate=0,
+        timeline_size=3200,
+    ):
+
+        self.factory = factory
+        self.rate = rate
+        self.keep_alive_s = keep_alive_s
+        self.disconnect_s = disconnect_s
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.api_error_rate = api_error_rate
+        self.timeline_size = timeline_size
+        self.timeline_start_ms = int(time() * 1000)
+        self.random = Random()
+        self.stopped = Event()
+        self.lock = Lock()
+        self.stats = {
+            "connections": 0,
+            "tweets": 0,
+            "keep_alives": 0,
+            "disconnects": 0,
+            "errors": 0,
+            "updates": 0,
+            "timeline_pages": 0,
+        }
+
+        self.server = ThreadingHTTPServer((STANDIN_HOST, port), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.standin = self
+        context = SSLContext(PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.port = self.server.server_address[1]
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+
+        self.thread.start()
+
+    def stop(self):
+
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name, amount=1):
+
+        with self.lock:
+            self.stats[name] += amount
+
+    def get_stats(self):
+
+        with self.lock:
+            return dict(self.stats)
+
+    def pick_error(self, error_rate):
+        """Returns an error code to inject, or None."""
+
+        if error_rate and self.random.random() < error_rate:
+            self.count("errors")
+
+            return self.random.choice(self.error_codes)
+
+        return None
+
+    def get_timeline(self, user_id, count, since_id=None, max_id=None):
+        """Returns a page of a synthetic timeline with one tweet a minute,
+        newest first.
+        """
+
+        tweets = []
+        for index in range(self.timeline_size):
+            timestamp_ms = self.timeline_start_ms - index * TIMELINE_STEP_MS
+            tweet_id = (timestamp_ms - TWITTER_EPOCH_MS) << 22
+            if max_id and tweet_id > int(max_id):
+
+                continue
+
+            if since_id and tweet_id <= int(since_id):
+
+                break
+
+            tweets.append(
+                self.factory.make_tweet(user_id, tweet_id=tweet_id, extended=True)
+            )
+            if len(tweets) >= count:
+
+                break
+
+        self.count("timeline_pages")
+        return tweets
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+
+        pass
+
+    @property
+    def standin(self):
+
+        return self.server.standin
+
+    def get_params(self):
+        """Returns the query and form parameters of the request."""
+
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            params.update(parse_qsl(self.rfile.read(length).decode("utf-8")))
+
+        return url.path, params
+
+    def send_json(self, value, status=200):
+
+        body = dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_api_error(self, status):
+
+        message = ERROR_MESSAGES.get(status, "Error")
+        self.send_json({"errors": [{"code": status, "message": message}]}, status)
+
+    def do_GET(self):
+
+        path, params = self.get_params()
+        if path == STATS_PATH:
+            self.send_json(self.standin.get_stats())
+
+            return
+
+        if path not in (TIMELINE_PATH, SHOW_PATH):
+            self.send_api_error(404)
+
+            return
+
+        status = self.standin.pick_error(self.standin.api_error_rate)
+        if status:
+            self.send_api_error(status)
+
+            return
+
+        extended = params.get("tweet_mode") == "extended"
+        if path == SHOW_PATH:
+            tweet = self.standin.factory.make_tweet(
+                ACC_USER_ID, tweet_id=int(params["id"]), extended=extended
+            )
+            self.send_json(tweet)
+
+            return
+
+        self.send_json(
+            self.standin.get_timeline(
+                params.get("user_id", ACC_USER_ID),
+                min(int(params.get("count", 20)), 200),
+                since_id=params.get("since_id"),
+                max_id=params.get("max_id"),
+            )
+        )
+
+    def do_POST(self):
+
+        path, params = self.get_params()
+        if path == STREAM_PATH:
+            self.stream()
+        elif path == UPDATE_PATH:
+            status = self.standin.pick_error(self.standin.api_error_rate)
+            if status:
+                self.send_api_error(status)
+
+                return
+
+            self.standin.count("updates")
+            self.send_json(
+                self.standin.factory.make_tweet(text=params.get("status", ""))
+            )
+        else:
+            self.send_api_error(404)
+
+    def stream(self):
+        """Streams tweets until the client goes away, the stand-in stops or
+        a disconnect is injected.
+        """
+
+        standin = self.standin
+        status = standin.pick_error(standin.error_rate)
+        if status:
+            self.send_api_error(status)
+
+            return
+
+        gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+        compressor = compressobj(wbits=31) if gzip else None
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        if gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        standin.count("connections")
+        self.close_connection = True
+
+        now = monotonic()
+        next_tweet = now + standin.random.expovariate(standin.rate)
+        next_keep_alive = now + standin.keep_alive_s
+        disconnect_at = float("inf")
+        if standin.disconnect_s:
+            disconnect_at = now + standin.random.expovariate(1 / standin.disconnect_s)
+
+        try:
+            while not standin.stopped.is_set():
+                now = monotonic()
+                if now >= disconnect_at:
+                    standin.count("disconnects")
+
+                    return
+
+                if now >= next_tweet:
+                    payload = "%s\r\n" % dumps(standin.factory.make_tweet())
+                    payload = payload.encode("utf-8")
+                    self.write_chunk(b"%d\r\n%s" % (len(payload), payload), compressor)
+                    standin.count("tweets")
+                    next_tweet += standin.random.expovariate(standin.rate)
+                    next_keep_alive = now + standin.keep_alive_s
+
+                    continue
+
+                if now >= next_keep_alive:
+                    self.write_chunk(b"\r\n", compressor)
+                    standin.count("keep_alives")
+                    next_keep_alive = now + standin.keep_alive_s
+
+                sleep(max(0, min(next_tweet, next_keep_alive, disconnect_at) - now))
+        except (BrokenPipeError, ConnectionResetError):
+
+            return
+
+    def write_chunk(self, data, compressor):
+        """Writes data as one HTTP chunk, compressed and flushed if the
+        stream is gzipped.
+        """
+
+        if compressor:
+            data = compressor.compress(data) + compressor.flush(Z_SYNC_FLUSH)
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def make_certificate(directory):
+    """Creates a self-signed certificate for localhost and a CA bundle
+    that trusts it on top of the usual roots. Returns the certificate, key
+    and bundle paths.
+    """
+
+    import certifi
+
+    certfile = join(directory, "cert.pem")
+    keyfile = join(directory, "key.pem")
+    bundle = join(directory, "ca-bundle.pem")
+    run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "30",
+            "-subj",
+            "/CN=%s" % STANDIN_HOST,
+            "-addext",
+            "subjectAltName=DNS:%s,IP:127.0.0.1" % STANDIN_HOST,
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    with open(bundle, "w") as bundle_file:
+        for path in [certfile, certifi.where()]:
+            with open(path) as cert_file:
+                bundle_file.write(cert_file.read())
+
+    return certfile, keyfile, bundle
+
+
+def parse_args():
+
+    parser = ArgumentParser(description="Local Twitter API stand-in.")
+    parser.add_argument("--port", type=int, default=STANDIN_PORT)
+    parser.add_argument("--rate", type=float, default=10.0, help="tweets/s")
+    parser.add_argument("--target-ratio", type=float, default=0.1)
+    parser.add_argument("--max-mentions", type=int, default=2)
+    parser.add_argument("--min-chars", type=int, default=40)
+    parser.add_argument("--max-chars", type=int, default=280)
+    parser.add_argument("--keep-alive-s", type=float, default=30.0)
+    parser.add_argument("--disconnect-s", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-codes", default="420,503")
+    parser.add_argument("--api-error-rate", type=float, default=0)
+    parser.add_argument("--timeline-size", type=int, default=3200)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--cert-dir", help="where to write the certificate")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    certfile, keyfile, bundle = make_certificate(args.cert_dir or mkdtemp())
+    factory = TweetFactory(
+        target_ratio=args.target_ratio,
+        max_mentions=args.max_mentions,
+        min_chars=args.min_chars,
+        max_chars=args.max_chars,
+        seed=args.seed,
+    )
+    standin = StandIn(
+        factory,
+        certfile,
+        keyfile,
+        port=args.port,
+        rate=args.rate,
+        keep_alive_s=args.keep_alive_s,
+        disconnect_s=args.disconnect_s,
+        error_rate=args.error_rate,
+        error_codes=[int(code) for code in args.error_codes.split(",")],
+        api_error_rate=args.api_error_rate,
+        timeline_size=args.timeline_size,
+    )
+    host = "%s:%s" % (STANDIN_HOST, standin.port)
+    print("export TWITTER_STREAM_HOST=%s" % host)
+    print("export TWITTER_API_HOST=%s" % host)
+    print("export REQUESTS_CA_BUNDLE=%s" % bundle)
+    standin.start()
+    try:
+        standin.stopped.wait()
+    except KeyboardInterrupt:
+        standin.stop()
@@ -0,0 +1,105 @@
+import builtins
+from contextlib import contextmanager
+from os import getenv
+from sys import modules
+from sys import stderr
+from threading import Lock
+from time import perf_counter
+
+
+STARTUP_REPORT = getenv("STARTUP_REPORT", "1") == "1"
+IMPORT_TIME_MIN_US = int(getenv("STARTUP_IMPORT_TIME_MIN_US", "1000"))
+IMPORT_TIME_HEADER = "import time: self [us] | cumulative | imported package"
+IMPORT_TIME_LINE = "import time: %9d | %10d | %s%s"
+PHASE_LINE = "startup: %10.1f ms | %s"
+
+
+class StartupTimer:
+    """Records how long each startup phase and each import takes, in the
+    style of python -X importtime.
+    """
+
+    def __init__(self):
+
+        self.start_time = perf_counter()
+        self.phases = []
+        self.imports = []
+        self.lock = Lock()
+        self.stack = []
+
+    @contextmanager
+    def phase(self, name):
+        """Times a named startup phase, including the imports it triggers."""
+
+        original_import = builtins.__import__
+        builtins.__import__ = self.timed_import(original_import)
+        start_time = perf_counter()
+        try:
+            yield
+        finally:
+            builtins.__import__ = original_import
+            self.phases.append((name, perf_counter() - start_time))
+
+    def timed_import(self, original_import):
+        """Wraps __import__ to record the self and cumulative time of every
+        module that is imported for the first time.
+        """
+
+        def timed(name, globals=None, locals=None, fromlist=(), level=0):
+
+            if level or name in modules:
+
+                return original_import(name, globals, locals, fromlist, level)
+
+            with self.lock:
+                depth = len(self.stack)
+                self.stack.append(0.0)
+
+            start_time = perf_counter()
+            try:
+                return original_import(name, globals, locals, fromlist, level)
+            finally:
+                cumulative = perf_counter() - start_time
+                with self.lock:
+                    nested = self.stack.pop()
+                    if self.stack:
+                        self.stack[-1] += cumulative
+                    self.imports.append((depth, name, cumulative - nested, cumulative))
+
+        return timed
+
+    def elapsed(self):
+        """Returns the seconds since the timer was created."""
+
+        return perf_counter() - self.start_time
+
+    def report(self):
+        """Returns the phase timings followed by the import breakdown."""
+
+        lines = []
+        for name, duration in self.phases:
+            lines.append(PHASE_LINE % (duration * 1000, name))
+        lines.append(PHASE_LINE % (self.elapsed() * 1000, "total"))
+
+        lines.append(IMPORT_TIME_HEADER)
+        for depth, name, self_time, cumulative in self.imports:
+            cumulative_us = cumulative * 1e6
+            if cumulative_us < IMPORT_TIME_MIN_US:
+
+                continue
+
+            lines.append(
+                IMPORT_TIME_LINE
+                % (self_time * 1e6, cumulative_us, "  " * depth, name)
+            )
+
+        return "\n".join(lines)
+
+    def print_report(self):
+        """Writes the report to stderr, if enabled."""
+
+        if not STARTUP_REPORT:
+
+            return
+
+        print(self.report(), file=stderr)
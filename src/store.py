@@ -0,0 +1,201 @@
+from datetime import datetime
+from json import dumps
+from json import loads
+from os import getenv
+from queue import Empty
+from queue import Queue
+from sqlite3 import connect
+from threading import Thread
+from time import time
+
+from logs import report_error
+
+
+STORE_PATH = getenv("STORE_PATH", "signals.db")
+STORE_BATCH_SIZE = 500
+STORE_FLUSH_S = 1.0
+TWITTER_TIME_FORMAT = "%a %b %d %H:%M:%S %z %Y"
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS tweets ("
+    " id TEXT PRIMARY KEY,"
+    " created_at REAL,"
+    " account TEXT,"
+    " latencies TEXT);"
+    "CREATE TABLE IF NOT EXISTS signals ("
+    " tweet_id TEXT,"
+    " created_at REAL,"
+    " account TEXT,"
+    " name TEXT,"
+    " ticker TEXT,"
+    " exchange TEXT,"
+    " root TEXT,"
+    " sentiment REAL);"
+    "CREATE INDEX IF NOT EXISTS signals_ticker_time"
+    " ON signals (ticker, created_at);"
+    "CREATE INDEX IF NOT EXISTS signals_time ON signals (created_at);"
+    "CREATE INDEX IF NOT EXISTS signals_tweet ON signals (tweet_id);"
+    "CREATE INDEX IF NOT EXISTS tweets_time ON tweets (created_at);"
+)
+INSERT_TWEET = "INSERT OR REPLACE INTO tweets VALUES (?, ?, ?, ?)"
+DELETE_SIGNALS = "DELETE FROM signals WHERE tweet_id = ?"
+INSERT_SIGNAL = "INSERT INTO signals VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+SELECT_SIGNALS = (
+    "SELECT s.tweet_id, s.created_at, s.account, s.name, s.ticker,"
+    " s.exchange, s.root, s.sentiment, t.latencies"
+    " FROM signals s JOIN tweets t ON t.id = s.tweet_id"
+    " WHERE s.ticker = ? AND s.created_at >= ?"
+    " ORDER BY s.created_at"
+)
+SIGNAL_FIELDS = [
+    "id_str",
+    "created_at",
+    "account",
+    "name",
+    "ticker",
+    "exchange",
+    "root",
+    "sentiment",
+    "latencies",
+]
+
+
+def parse_created_at(tweet):
+    """Returns the tweet's creation time in seconds since the epoch."""
+
+    try:
+        created_at = tweet["created_at"]
+    except (KeyError, TypeError):
+
+        return None
+
+    try:
+        return datetime.strptime(created_at, TWITTER_TIME_FORMAT).timestamp()
+    except (TypeError, ValueError):
+
+        return None
+
+
+class SignalStore:
+    """Keeps every analyzed tweet and its company signals in SQLite.
+
+    add() only queues the result. A background thread writes queued
+    results in batches, one transaction per batch. Signals are indexed by
+    ticker and time, so recent signals for a ticker are a single index
+    range scan.
+    """
+
+    def __init__(self, path=STORE_PATH):
+
+        self.path = path
+        self.queue = Queue()
+        connection = connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        connection.close()
+        self.thread = Thread(target=self.write_queue)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, tweet, companies, latencies=None):
+        """Queues an analyzed tweet with its companies and the time each
+        stage took.
+        """
+
+        self.queue.put((tweet, companies or [], latencies or {}))
+
+    def close(self):
+        """Writes everything still queued and stops the writer thread."""
+
+        self.queue.put(None)
+        self.thread.join()
+
+    def write_queue(self):
+        """Writes queued results in batches until closed."""
+
+        connection = connect(self.path)
+        closed = False
+        while not closed:
+            batch = []
+            try:
+                item = self.queue.get(timeout=STORE_FLUSH_S)
+                while True:
+                    if item is None:
+                        closed = True
+
+                        break
+
+                    batch.append(item)
+                    if len(batch) >= STORE_BATCH_SIZE:
+
+                        break
+
+                    item = self.queue.get_nowait()
+            except Empty:
+
+                pass
+
+            if batch:
+                try:
+                    self.write_batch(connection, batch)
+                except Exception:
+                    report_error("Writing signals failed", results=len(batch))
+
+        connection.close()
+
+    def write_batch(self, connection, batch):
+        """Writes a batch of results in one transaction. A tweet written
+        again replaces its earlier result.
+        """
+
+        latest = {}
+        for tweet, companies, latencies in batch:
+            latest[tweet.get("id_str")] = (tweet, companies, latencies)
+
+        tweet_rows = []
+        signal_rows = []
+        tweet_ids = []
+        for tweet_id, (tweet, companies, latencies) in latest.items():
+            created_at = parse_created_at(tweet) or time()
+            account = tweet.get("user", {}).get("id_str")
+            tweet_ids.append((tweet_id,))
+            tweet_rows.append((tweet_id, created_at, account, dumps(latencies)))
+            for company in companies:
+                signal_rows.append(
+                    (
+                        tweet_id,
+                        created_at,
+                        account,
+                        company.get("name"),
+                        company.get("ticker"),
+                        company.get("exchange"),
+                        company.get("root"),
+                        company.get("sentiment"),
+                    )
+                )
+
+        with connection:
+            connection.executemany(INSERT_TWEET, tweet_rows)
+            connection.executemany(DELETE_SIGNALS, tweet_ids)
+            connection.executemany(INSERT_SIGNAL, signal_rows)
+
+    def get_signals(self, ticker, hours):
+        """Returns all signals for the ticker from the last hours, oldest
+        first.
+        """
+
+        connection = connect(self.path)
+        try:
+            rows = connection.execute(
+                SELECT_SIGNALS, (ticker, time() - hours * 60 * 60)
+            ).fetchall()
+        finally:
+            connection.close()
+
+        signals = []
+        for row in rows:
+            signal = dict(zip(SIGNAL_FIELDS, row))
+            signal["latencies"] = loads(signal["latencies"])
+            signals.append(signal)
+
+        return signals
@@ -0,0 +1,95 @@
+from os import getenv
+from threading import Event
+from threading import Thread
+from time import monotonic
+from tweepy import Stream
+
+
+STREAM_STALL_S = float(getenv("STREAM_STALL_S", "45"))
+STREAM_WATCHDOG_S = 1.0
+
+
+class CountingReader:
+    """Wraps a response body to time and count what is read from it."""
+
+    def __init__(self, raw, stats):
+
+        self.raw = raw
+        self.stats = stats
+        self.last_read = monotonic()
+
+    @property
+    def closed(self):
+
+        return self.raw.closed
+
+    def read(self, amt=None):
+
+        wire_start = self.raw.tell()
+        data = self.raw.read(amt)
+        if data:
+            self.last_read = monotonic()
+        self.stats.add_bytes(self.raw.tell() - wire_start, len(data))
+
+        return data
+
+    def close(self):
+
+        self.raw.close()
+
+
+class CompressedStream(Stream):
+    """A tweepy Stream that asks for a gzip-compressed connection and
+    reconnects as soon as the data and keep-alive newlines stop.
+
+    Twitter sends a keep-alive newline every 30 seconds. A watchdog closes
+    the connection once nothing has arrived for stall_s seconds, and the
+    read loop then returns normally, so tweepy reconnects straight away
+    instead of waiting for its read timeout and treating it as an error.
+    """
+
+    def __init__(self, auth, listener, stats, stall_s=STREAM_STALL_S, **options):
+
+        super().__init__(
+            auth,
+            listener,
+            headers={"Accept-Encoding": "deflate, gzip"},
+            timeout=stall_s * 2,
+            **options
+        )
+        self.stats = stats
+        self.stall_s = stall_s
+
+    def _read_loop(self, resp):
+
+        resp.raw.decode_content = True
+        reader = CountingReader(resp.raw, self.stats)
+        resp.raw = reader
+        stalled = Event()
+        stopped = Event()
+        watchdog = Thread(target=self.watch, args=[resp, reader, stalled, stopped])
+        watchdog.daemon = True
+
+        self.stats.connected()
+        watchdog.start()
+        try:
+            super()._read_loop(resp)
+        except Exception:
+            if not stalled.is_set():
+
+                raise
+
+        finally:
+            stopped.set()
+            self.stats.disconnected()
+
+    def watch(self, resp, reader, stalled, stopped):
+        """Closes the connection if nothing has been read for stall_s."""
+
+        while not stopped.wait(STREAM_WATCHDOG_S):
+            if monotonic() - reader.last_read > self.stall_s:
+                stalled.set()
+                self.stats.stalled()
+                resp.close()
+
+                return
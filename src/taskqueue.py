@@ -0,0 +1,424 @@
+from os import getenv
+from os import getpid
+from os import makedirs
+from os.path import join
+from queue import Empty
+from queue import Queue
+from socket import gethostname
+from sqlite3 import connect
+from threading import Condition
+from threading import local
+from threading import Lock
+from threading import Thread
+from time import sleep
+from time import time
+from zlib import crc32
+
+from logs import report_error
+from records import Record
+
+
+TASKQUEUE_DIR = getenv("TASKQUEUE_DIR", "tasks")
+TASKQUEUE_PARTITIONS = int(getenv("TASKQUEUE_PARTITIONS", "8"))
+TASKQUEUE_LEASE_S = float(getenv("TASKQUEUE_LEASE_S", "60"))
+TASKQUEUE_MAX_DELIVERIES = int(getenv("TASKQUEUE_MAX_DELIVERIES", "5"))
+TASKQUEUE_RETENTION_S = float(getenv("TASKQUEUE_RETENTION_S", str(24 * 60 * 60)))
+TASKQUEUE_POLL_S = 0.1
+TASKQUEUE_MAX_POLL_S = float(getenv("TASKQUEUE_MAX_POLL_S", "2"))
+TASKQUEUE_BUSY_TIMEOUT_S = 30.0
+PARTITION_NAME = "partition-%03d.db"
+PENDING = 0
+DONE = 1
+DEAD = 2
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS tasks ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    " key TEXT UNIQUE,"
+    " payload TEXT,"
+    " enqueued_at REAL,"
+    " state INTEGER DEFAULT 0,"
+    " deliveries INTEGER DEFAULT 0,"
+    " owner TEXT,"
+    " lease_until REAL DEFAULT 0,"
+    " finished_at REAL);"
+    "CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, id);"
+)
+INSERT_TASK = (
+    "INSERT OR IGNORE INTO tasks (key, payload, enqueued_at, lease_until)"
+    " VALUES (?, ?, ?, ?)"
+)
+EXPIRE_TASKS = (
+    "UPDATE tasks SET state = 2, finished_at = ?"
+    " WHERE state = 0 AND lease_until < ? AND deliveries >= ?"
+)
+READY_TASK = "SELECT 1 FROM tasks WHERE state = 0 AND lease_until < ? LIMIT 1"
+SELECT_TASKS = (
+    "SELECT id, key, payload, deliveries + 1 FROM tasks"
+    " WHERE state = 0 AND lease_until < ? ORDER BY id LIMIT ?"
+)
+LEASE_TASKS = (
+    "UPDATE tasks SET owner = ?, lease_until = ?, deliveries = deliveries + 1"
+    " WHERE id IN (%s)"
+)
+ACK_TASK = (
+    "UPDATE tasks SET state = 1, finished_at = ?"
+    " WHERE id = ? AND state = 0 AND owner = ?"
+)
+RELEASE_TASK = (
+    "UPDATE tasks SET owner = NULL, lease_until = 0"
+    " WHERE id = ? AND state = 0 AND owner = ?"
+)
+DEFER_TASK = (
+    "UPDATE tasks SET owner = NULL, lease_until = ?, deliveries = deliveries - 1"
+    " WHERE id = ? AND state = 0 AND owner = ?"
+)
+PURGE_TASKS = "DELETE FROM tasks WHERE state != 0 AND finished_at < ?"
+COUNT_TASKS = (
+    "SELECT state, lease_until >= ?, owner IS NULL, COUNT(*) FROM tasks"
+    " GROUP BY 1, 2, 3"
+)
+
+
+def get_partition(key, partitions):
+    """Returns the partition of a key, the same in every process."""
+
+    return crc32(key.encode("utf-8")) % partitions
+
+
+class TaskDeferred(Exception):
+    """Raised by a task handler to have the task delivered again at a
+    later time.
+    """
+
+    def __init__(self, ready_at):
+
+        super().__init__("Deferred until %s" % ready_at)
+        self.ready_at = ready_at
+
+
+class Task(Record):
+    """A leased task: where it is stored, its key and payload, and how
+    often it was delivered, this time included.
+    """
+
+    __slots__ = ("partition", "id", "key", "payload", "deliveries")
+
+
+class TaskQueue:
+    """A durable work queue split over SQLite files in a directory, which
+    any number of producer and worker processes can open.
+
+    Tasks go to the partition their key hashes to, and a key is only ever
+    queued once, so a task enqueued again by a restarted producer is not
+    done twice. Workers lease tasks for lease_s and acknowledge them when
+    done. A task whose worker dies or gives up is leased again once its
+    lease runs out, up to max_deliveries times before it is set aside as
+    dead. Acknowledging checks the lease is still held, so a task is
+    only recorded done by the worker that last leased it. Each partition
+    is its own file with its own write lock, and workers start their scans
+    at different partitions, so adding workers spreads the contention.
+    """
+
+    def __init__(
+        self,
+        directory=TASKQUEUE_DIR,
+        partitions=TASKQUEUE_PARTITIONS,
+        lease_s=TASKQUEUE_LEASE_S,
+        max_deliveries=TASKQUEUE_MAX_DELIVERIES,
+        retention_s=TASKQUEUE_RETENTION_S,
+    ):
+
+        self.directory = directory
+        self.partitions = partitions
+        self.lease_s = lease_s
+        self.max_deliveries = max_deliveries
+        self.retention_s = retention_s
+        self.connections = local()
+        makedirs(directory, exist_ok=True)
+        for partition in range(partitions):
+            connection = self.get_connection(partition)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    def get_connection(self, partition):
+        """Returns this thread's connection to a partition."""
+
+        connections = getattr(self.connections, "by_partition", None)
+        if connections is None:
+            connections = self.connections.by_partition = {}
+
+        connection = connections.get(partition)
+        if not connection:
+            path = join(self.directory, PARTITION_NAME % partition)
+            connection = connect(path, timeout=TASKQUEUE_BUSY_TIMEOUT_S)
+            connections[partition] = connection
+
+        return connection
+
+    def put(self, key, payload, ready_at=0):
+        """Queues a payload under a key, to be delivered from the ready_at
+        time on. Returns False if the key was queued before.
+        """
+
+        connection = self.get_connection(get_partition(key, self.partitions))
+        with connection:
+            cursor = connection.execute(
+                INSERT_TASK, (key, payload, time(), ready_at)
+            )
+
+        return cursor.rowcount == 1
+
+    def lease(self, owner, count=1, start=0):
+        """Leases up to count of the oldest ready tasks to the owner, from
+        the first partition from start on that has any.
+        """
+
+        for offset in range(self.partitions):
+            partition = (start + offset) % self.partitions
+            tasks = self.lease_partition(partition, owner, count)
+            if tasks:
+
+                return tasks
+
+        return []
+
+    def lease_partition(self, partition, owner, count):
+        """Leases up to count of the oldest ready tasks of a partition. It
+        is only write locked once a read found a task ready, and then for
+        the whole select and update, so two workers never lease the same
+        task.
+        """
+
+        now = time()
+        connection = self.get_connection(partition)
+        if not connection.execute(READY_TASK, (now,)).fetchone():
+
+            return []
+
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(EXPIRE_TASKS, (now, now, self.max_deliveries))
+            rows = connection.execute(SELECT_TASKS, (now, count)).fetchall()
+            if rows:
+                connection.execute(
+                    LEASE_TASKS % ", ".join("?" * len(rows)),
+                    [owner, now + self.lease_s] + [row[0] for row in rows],
+                )
+
+        return [Task(partition, *row) for row in rows]
+
+    def ack(self, task, owner):
+        """Marks a leased task done. Returns False if the owner's lease
+        had run out and it was leased again or set aside.
+        """
+
+        connection = self.get_connection(task.partition)
+        with connection:
+            cursor = connection.execute(ACK_TASK, (time(), task.id, owner))
+
+        return cursor.rowcount == 1
+
+    def release(self, task, owner):
+        """Gives a leased task back, so it is delivered again right away."""
+
+        connection = self.get_connection(task.partition)
+        with connection:
+            connection.execute(RELEASE_TASK, (task.id, owner))
+
+    def defer(self, task, owner, ready_at):
+        """Gives a leased task back until the ready_at time, without
+        counting the delivery.
+        """
+
+        connection = self.get_connection(task.partition)
+        with connection:
+            connection.execute(DEFER_TASK, (ready_at, task.id, owner))
+
+    def purge(self):
+        """Deletes finished tasks older than the retention."""
+
+        cutoff = time() - self.retention_s
+        for partition in range(self.partitions):
+            connection = self.get_connection(partition)
+            with connection:
+                connection.execute(PURGE_TASKS, (cutoff,))
+
+    def get_stats(self):
+        """Returns how many tasks are ready, leased, due later, done and
+        dead.
+        """
+
+        stats = {"ready": 0, "leased": 0, "later": 0, "done": 0, "dead": 0}
+        now = time()
+        for partition in range(self.partitions):
+            rows = self.get_connection(partition).execute(COUNT_TASKS, (now,))
+            for state, waiting, unowned, count in rows:
+                if state == PENDING and not waiting:
+                    stats["ready"] += count
+                elif state == PENDING:
+                    stats["later" if unowned else "leased"] += count
+                elif state == DONE:
+                    stats["done"] += count
+                else:
+                    stats["dead"] += count
+
+        return stats
+
+
+class TaskWorker:
+    """Leases tasks from a queue and hands their payloads to a handler,
+    acknowledging each one the handler finishes without raising and giving
+    back the others. A handler raising TaskDeferred has its task given
+    back until the time it names.
+    """
+
+    def __init__(self, task_queue, handler, worker_id=0):
+
+        self.task_queue = task_queue
+        self.handler = handler
+        self.owner = "%s:%d:%d" % (gethostname(), getpid(), worker_id)
+        self.start = get_partition(self.owner, task_queue.partitions) + worker_id
+        self.handled = 0
+        self.failed = 0
+        self.lost = 0
+        self.lock = Lock()
+
+    def run_once(self):
+        """Handles one task. Returns False if none was ready."""
+
+        tasks = self.task_queue.lease(self.owner, start=self.start)
+        if not tasks:
+
+            return False
+
+        self.handle(tasks[0])
+
+        return True
+
+    def handle(self, task):
+        """Hands a leased task to the handler, then acknowledges, defers or
+        gives it back.
+        """
+
+        try:
+            self.handler(task.payload)
+        except TaskDeferred as deferred:
+            self.task_queue.defer(task, self.owner, deferred.ready_at)
+
+            return
+
+        except Exception:
+            report_error("Task failed", key=task.key, deliveries=task.deliveries)
+            with self.lock:
+                self.failed += 1
+            self.task_queue.release(task, self.owner)
+
+            return
+
+        acked = self.task_queue.ack(task, self.owner)
+        with self.lock:
+            self.handled += 1
+            if not acked:
+                self.lost += 1
+
+    def run(self, stop_event):
+        """Handles tasks until the event is set, polling while there are
+        none.
+        """
+
+        while not stop_event.is_set():
+            if not self.run_once():
+                sleep(TASKQUEUE_POLL_S)
+
+
+class TaskPool:
+    """Handles tasks with a number of threads fed by one leasing thread.
+
+    The leaser leases as many tasks at once as there are idle threads and
+    queues them in memory. While the partitions have none ready, it waits
+    twice as long after each empty poll, up to TASKQUEUE_MAX_POLL_S, so
+    an idle process takes a few reads a second instead of a write per
+    thread and partition.
+    """
+
+    def __init__(self, task_queue, handler, workers, worker_id=0):
+
+        self.worker = TaskWorker(task_queue, handler, worker_id)
+        self.task_queue = task_queue
+        self.workers = workers
+        self.tasks = Queue()
+        self.idle = Condition()
+
+    def get_idle(self):
+        """Returns how many threads have no task queued or in hand."""
+
+        return self.workers - self.tasks.unfinished_tasks
+
+    def run(self, stop_event):
+        """Leases and handles tasks until the event is set, then gives
+        back the leased tasks no thread has started.
+        """
+
+        threads = []
+        for _ in range(self.workers):
+            thread = Thread(target=self.handle_tasks, args=[stop_event])
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            self.lease_tasks(stop_event)
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+            while True:
+                try:
+                    task = self.tasks.get_nowait()
+                except Empty:
+
+                    break
+
+                self.task_queue.release(task, self.worker.owner)
+
+    def lease_tasks(self, stop_event):
+        """Keeps every idle thread supplied with a leased task, backing off
+        while there are none.
+        """
+
+        start = self.worker.start
+        poll_s = TASKQUEUE_POLL_S
+        while not stop_event.is_set():
+            with self.idle:
+                self.idle.wait_for(self.get_idle, TASKQUEUE_POLL_S)
+            idle = self.get_idle()
+            if idle <= 0:
+
+                continue
+
+            tasks = self.task_queue.lease(self.worker.owner, idle, start)
+            start = (start + 1) % self.task_queue.partitions
+            for task in tasks:
+                self.tasks.put(task)
+            if tasks:
+                poll_s = TASKQUEUE_POLL_S
+            else:
+                stop_event.wait(poll_s)
+                poll_s = min(2 * poll_s, TASKQUEUE_MAX_POLL_S)
+
+    def handle_tasks(self, stop_event):
+
+        while not stop_event.is_set():
+            try:
+                task = self.tasks.get(timeout=TASKQUEUE_POLL_S)
+            except Empty:
+
+                continue
+
+            try:
+                self.worker.handle(task)
+            finally:
+                with self.idle:
+                    self.tasks.task_done()
+                    self.idle.notify()
@@ -1,21 +1,24 @@
 from json import loads
 from os import getenv
 from queue import Empty
-from queue import Queue
 from threading import Event
+from threading import Lock
 from threading import Thread
+from time import monotonic
 from time import time
-from tweepy import API
-from tweepy import Cursor
-from tweepy import OAuthHandler
-from tweepy import Stream
-from tweepy.streaming import StreamListener
+
+from freshness import FreshnessQueue
+from logs import log
+from logs import report_error
+from upstream import get_upstream
 
 
 TWITTER_ACCESS_TOKEN = getenv("TWITTER_ACCESS_TOKEN")
 TWITTER_ACCESS_TOKEN_SECRET = getenv("TWITTER_ACCESS_TOKEN_SECRET")
 TWITTER_CONSUMER_KEY = getenv("TWITTER_CONSUMER_KEY")
 TWITTER_CONSUMER_SECRET = getenv("TWITTER_CONSUMER_SECRET")
+TWITTER_API_HOST = getenv("TWITTER_API_HOST", "api.twitter.com")
+TWITTER_STREAM_HOST = getenv("TWITTER_STREAM_HOST", "stream.twitter.com")
 ACC_USER_ID = "1112802541018992640"
 TWEET_URL = "https://twitter.com/%s/status/%s"
 GRAPH_UP = "\U0001F4C8"
@@ -24,35 +27,78 @@ NEUTRAL = "\U0001F340"
 MAX_TWEET_SIZE = 140
 NUM_THREADS = 100
 QUEUE_TIMEOUT_S = 5 * 60
-API_RETRY_COUNT = 60
+TIMELINE_PAGE_SIZE = 200
+API_RETRY_COUNT = 3
 API_RETRY_DELAY_S = 1
 API_RETRY_ERRORS = [400, 401, 500, 502, 503, 504]
+TWITTER = get_upstream("twitter", slow_call_s=15)
 
 
 class Twitter:
-    """A helper for talking to Twitter APIs."""
+    """A helper for talking to Twitter APIs. Given an Archiver, every raw
+    stream payload is archived as it arrives.
+    """
 
-    def __init__(self):
+    def __init__(self, archive=None):
 
-        self.twitter_auth = OAuthHandler(TWITTER_CONSUMER_KEY, TWITTER_CONSUMER_SECRET)
-        self.twitter_auth.set_access_token(
-            TWITTER_ACCESS_TOKEN, TWITTER_ACCESS_TOKEN_SECRET
-        )
-        self.twitter_api = API(
-            auth_handler=self.twitter_auth,
-            retry_count=API_RETRY_COUNT,
-            retry_delay=API_RETRY_DELAY_S,
-            retry_errors=API_RETRY_ERRORS,
-            wait_on_rate_limit=True,
-            wait_on_rate_limit_notify=True,
-        )
+        self.archive = archive
+        self._twitter_auth = None
+        self._twitter_api = None
         self.twitter_listener = None
 
+    @property
+    def twitter_auth(self):
+        """The OAuth handler, created on first use."""
+
+        if not self._twitter_auth:
+            from tweepy import OAuthHandler
+
+            twitter_auth = OAuthHandler(TWITTER_CONSUMER_KEY, TWITTER_CONSUMER_SECRET)
+            twitter_auth.set_access_token(
+                TWITTER_ACCESS_TOKEN, TWITTER_ACCESS_TOKEN_SECRET
+            )
+            self._twitter_auth = twitter_auth
+
+        return self._twitter_auth
+
+    @property
+    def twitter_api(self):
+        """The REST API client, created on first use."""
+
+        if not self._twitter_api:
+            from tweepy import API
+
+            self._twitter_api = API(
+                auth_handler=self.twitter_auth,
+                host=TWITTER_API_HOST,
+                retry_count=API_RETRY_COUNT,
+                retry_delay=API_RETRY_DELAY_S,
+                retry_errors=API_RETRY_ERRORS,
+                wait_on_rate_limit=True,
+                wait_on_rate_limit_notify=True,
+            )
+
+        return self._twitter_api
+
+    def warm_up(self):
+        """Imports tweepy and builds the API clients ahead of the first
+        request.
+        """
+
+        return self.twitter_api
+
     def start_streaming(self, callback):
         """Starts streaming tweets and returning data to the callback."""
 
-        self.twitter_listener = TwitterListener(callback=callback)
-        twitter_stream = Stream(self.twitter_auth, self.twitter_listener)
+        from streaming import CompressedStream
+
+        self.twitter_listener = TwitterListener(callback=callback, archive=self.archive)
+        twitter_stream = CompressedStream(
+            self.twitter_auth,
+            self.twitter_listener,
+            STREAM_STATS,
+            host=TWITTER_STREAM_HOST,
+        )
 
         twitter_stream.filter(follow=[ACC_USER_ID])
 
@@ -61,6 +107,17 @@ class Twitter:
                 "Twitter API error: %s" % self.twitter_listener.get_error_status()
             )
 
+    def get_queue_stats(self):
+        """Returns the scheduling statistics of the current stream's work
+        queue, or None if not streaming.
+        """
+
+        if not self.twitter_listener:
+
+            return None
+
+        return self.twitter_listener.queue.get_stats()
+
     def stop_streaming(self):
         """Stops the current stream."""
 
@@ -73,39 +130,35 @@ class Twitter:
 
     def tweet(self, companies, tweet):
         """Posts a tweet listing the companies, their ticker symbols, and a
-        quote of the original tweet.
+        quote of the original tweet. Returns whether the post went out.
         """
 
         link = self.get_tweet_link(tweet)
         text = self.make_tweet_text(companies, link)
 
-        self.twitter_api.update_status(text)
+        try:
+            TWITTER.call(self.twitter_api.update_status, text)
+        except Exception:
+            report_error("Failed to post tweet", tweet_id=tweet.get("id_str"))
+
+            return False
+
+        return True
 
     def make_tweet_text(self, companies, link):
         """Generates the text for a tweet."""
 
-        names = []
-        for company in companies:
-            name = company["name"]
-            if name not in names:
-                names.append(name)
-
         tickers = {}
         sentiments = {}
-        for name in names:
-            tickers[name] = []
-            for company in companies:
-                if company["name"] == name:
-                    ticker = company["ticker"]
-                    tickers[name].append(ticker)
-                    sentiment = company["sentiment"]
-
-                    sentiments[name] = sentiment
+        for company in companies:
+            name = company["name"]
+            tickers.setdefault(name, []).append(company["ticker"])
+            sentiments[name] = company["sentiment"]
 
         lines = []
-        for name in names:
+        for name, name_tickers in tickers.items():
             sentiment_str = self.gnlp_sentiment_emoji(sentiments[name])
-            tickers_str = " ".join(["$%s" % t for t in tickers[name]])
+            tickers_str = " ".join(["$%s" % t for t in name_tickers])
             line = "%s %s %s" % (name, sentiment_str, tickers_str)
             lines.append(line)
 
@@ -137,7 +190,9 @@ class Twitter:
     def get_tweet(self, tweet_id):
         """Looks up metadata for a single tweet."""
 
-        status = self.twitter_api.get_status(tweet_id, tweet_mode="extended")
+        status = TWITTER.call(
+            self.twitter_api.get_status, tweet_id, tweet_mode="extended"
+        )
         if not status:
 
             return None
@@ -145,23 +200,42 @@ class Twitter:
         return status._json
 
     def get_tweets(self, since_id):
-        """Looks up metadata for all Trump tweets since the specified ID."""
+        """Looks up metadata for all Trump tweets since the specified ID,
+        including it.
+        """
 
         tweets = []
 
         since_id = str(int(since_id) - 1)
 
-        for status in Cursor(
-            self.twitter_api.user_timeline,
-            user_id=ACC_USER_ID,
-            since_id=since_id,
-            tweet_mode="extended",
-        ).items():
+        for page in self.get_timeline_pages(ACC_USER_ID, since_id=since_id):
 
-            tweets.append(status._json)
+            tweets.extend(page)
 
         return tweets
 
+    def get_timeline_pages(self, user_id, since_id=None, max_id=None):
+        """Lazily yields pages of tweets from a user's timeline, newest first,
+        walking back from max_id (inclusive) to since_id (exclusive).
+        """
+
+        while True:
+            statuses = TWITTER.call(
+                self.twitter_api.user_timeline,
+                user_id=user_id,
+                count=TIMELINE_PAGE_SIZE,
+                since_id=since_id,
+                max_id=max_id,
+                tweet_mode="extended",
+            )
+            if not statuses:
+
+                return
+
+            yield [status._json for status in statuses]
+
+            max_id = statuses[-1].id - 1
+
     def get_tweet_text(self, tweet):
         """Returns the full text of a tweet."""
 
@@ -197,19 +271,100 @@ class Twitter:
         return link
 
 
-class TwitterListener(StreamListener):
-    """A listener class for handling streaming Twitter data."""
+class StreamStats:
+    """Keeps track of the health of the streaming connection."""
+
+    def __init__(self):
+
+        self.lock = Lock()
+        self.connects = 0
+        self.stalls = 0
+        self.keep_alives = 0
+        self.connected_at = None
+        self.uptime_s = 0.0
+        self.wire_bytes = 0
+        self.data_bytes = 0
+
+    def connected(self):
+        """Records a new connection."""
+
+        with self.lock:
+            self.connects += 1
+            self.connected_at = monotonic()
+
+    def disconnected(self):
+        """Records the end of the current connection."""
+
+        with self.lock:
+            if self.connected_at is not None:
+                self.uptime_s += monotonic() - self.connected_at
+            self.connected_at = None
+
+    def stalled(self):
+        """Records a connection dropped for going quiet."""
+
+        with self.lock:
+            self.stalls += 1
+
+    def keep_alive(self):
+        """Records a keep-alive newline."""
+
+        with self.lock:
+            self.keep_alives += 1
 
-    def __init__(self, callback):
+    def add_bytes(self, wire_bytes, data_bytes):
+        """Records bytes read, before and after decompression."""
+
+        with self.lock:
+            self.wire_bytes += wire_bytes
+            self.data_bytes += data_bytes
+
+    def get_stats(self):
+        """Returns connection uptime, throughput and stall counts."""
+
+        with self.lock:
+            connection_uptime_s = 0.0
+            if self.connected_at is not None:
+                connection_uptime_s = monotonic() - self.connected_at
+            uptime_s = self.uptime_s + connection_uptime_s
+
+            return {
+                "connected": self.connected_at is not None,
+                "connection_uptime_s": connection_uptime_s,
+                "uptime_s": uptime_s,
+                "connects": self.connects,
+                "stalls": self.stalls,
+                "keep_alives": self.keep_alives,
+                "wire_bytes": self.wire_bytes,
+                "data_bytes": self.data_bytes,
+                "wire_bytes_per_s": self.wire_bytes / uptime_s if uptime_s else 0.0,
+                "data_bytes_per_s": self.data_bytes / uptime_s if uptime_s else 0.0,
+            }
+
+
+STREAM_STATS = StreamStats()
+
+
+class TwitterListener:
+    """A listener class for handling streaming Twitter data.
+
+    Implements the callbacks a tweepy Stream invokes, so that tweepy itself
+    is only imported once streaming starts.
+    """
+
+    def __init__(self, callback, archive=None):
 
         self.callback = callback
+        self.archive = archive
         self.error_status = None
         self.start_queue()
 
     def start_queue(self):
-        """Creates a queue and starts the worker threads."""
+        """Creates a queue that serves the freshest tweets first and starts
+        the worker threads.
+        """
 
-        self.queue = Queue()
+        self.queue = FreshnessQueue()
         self.stop_event = Event()
 
         self.workers = []
@@ -240,7 +395,10 @@ class TwitterListener(StreamListener):
             try:
                 data = self.queue.get(block=True, timeout=QUEUE_TIMEOUT_S)
                 start_time = time()
-                self.handle_data(data)
+                try:
+                    self.handle_data(data)
+                except Exception:
+                    report_error("Failed to handle stream data", worker_id=worker_id)
                 self.queue.task_done()
                 end_time = time()
                 qsize = self.queue.qsize()
@@ -249,10 +407,33 @@ class TwitterListener(StreamListener):
 
                 continue
 
+    def on_connect(self):
+        """Called once connected to the streaming server."""
+
+        pass
+
+    def keep_alive(self):
+        """Called when a keep-alive newline arrives."""
+
+        STREAM_STATS.keep_alive()
+
+    def on_timeout(self):
+        """Called when the stream connection times out."""
+
+        log("Stream timed out", severity="WARNING")
+        return
+
+    def on_exception(self, exception):
+        """Called when an unhandled exception ends the stream."""
+
+        report_error("Stream failed: %s" % exception)
+        return
+
     def on_error(self, status):
         """Handles any API errors."""
 
         self.error_status = status
+        log("Stream error status %s" % status, severity="ERROR")
         self.stop_queue()
         return False
 
@@ -266,6 +447,8 @@ class TwitterListener(StreamListener):
         if self.stop_event.is_set():
             return False
 
+        if self.archive:
+            self.archive.append(data)
         self.queue.put(data)
         return True
 
@@ -277,6 +460,7 @@ class TwitterListener(StreamListener):
         try:
             tweet = loads(data)
         except ValueError:
+            report_error("Invalid stream data", sample_rate=0.1, data=data[:200])
 
             return
 
@@ -0,0 +1,78 @@
+from threading import Lock
+from time import monotonic
+
+from breaker import BreakerOpen
+from breaker import get_breaker
+from faults import INJECTOR
+from limits import get_limiter
+
+
+class Upstream:
+    """Guards the calls to one upstream service with its circuit breaker and
+    its limiter.
+
+    Calls fail fast while the breaker is open, then queue on the limiter.
+    Only the call itself is timed for the breaker and the limiter, so time
+    spent queueing is not mistaken for upstream latency. Faults injected
+    for the upstream count as part of the call.
+    """
+
+    def __init__(self, name, **breaker_options):
+
+        self.name = name
+        self.breaker = get_breaker(name, **breaker_options)
+        self.limiter = get_limiter(name)
+
+    def call(self, func, *args, **kwargs):
+        """Calls the function under the breaker and the limiter."""
+
+        if self.breaker.is_open():
+
+            raise BreakerOpen("%s circuit breaker is open" % self.name)
+
+        with self.limiter:
+            start_time = monotonic()
+            try:
+                result = self.breaker.call(
+                    INJECTOR.call, self.name, func, *args, **kwargs
+                )
+            except BreakerOpen:
+                raise
+
+            except Exception:
+                self.limiter.record_result(monotonic() - start_time, False)
+                raise
+
+            self.limiter.record_result(monotonic() - start_time, True)
+            return result
+
+    def get_stats(self):
+        """Returns the breaker and limiter statistics."""
+
+        return {
+            "breaker": self.breaker.get_stats(),
+            "limiter": self.limiter.get_stats(),
+        }
+
+
+UPSTREAMS = {}
+UPSTREAMS_LOCK = Lock()
+
+
+def get_upstream(name, **breaker_options):
+    """Returns the process-wide guard for the named upstream."""
+
+    with UPSTREAMS_LOCK:
+        if name not in UPSTREAMS:
+            UPSTREAMS[name] = Upstream(name, **breaker_options)
+
+        return UPSTREAMS[name]
+
+
+def get_upstream_stats():
+    """Returns the statistics of every upstream by name."""
+
+    with UPSTREAMS_LOCK:
+        upstreams = list(UPSTREAMS.values())
+
+    return {upstream.name: upstream.get_stats() for upstream in upstreams}
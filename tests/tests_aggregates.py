@@ -0,0 +1,58 @@
+from pytest import approx
+
+from aggregates import SignalAggregates
+from records import Company
+
+NOW = 1553000000.0
+
+
+def company(ticker, sentiment):
+    return Company(name=ticker, ticker=ticker, exchange="NYSE", sentiment=sentiment)
+
+
+def test_windows():
+    aggregates = SignalAggregates()
+    aggregates.add([company("BA", 0.5)], NOW - 2 * 60 * 60)
+    aggregates.add([company("BA", -0.5)], NOW - 30 * 60)
+    aggregates.add([company("BA", 0.1), company("F", 0.2)], NOW - 60)
+    windows = aggregates.get("BA", NOW)["windows"]
+    assert windows["5m"]["count"] == 1
+    assert windows["5m"]["mean_sentiment"] == approx(0.1)
+    assert windows["1h"]["count"] == 2
+    assert windows["1h"]["mean_sentiment"] == approx(-0.2)
+    assert windows["1d"]["count"] == 3
+    assert aggregates.get_tickers() == ["BA", "F"]
+    assert aggregates.get("GM") is None
+
+
+def test_momentum():
+    aggregates = SignalAggregates()
+    aggregates.add([company("BA", -0.5)], NOW - 50 * 60)
+    aggregates.add([company("BA", 0.5)], NOW - 10 * 60)
+    assert aggregates.get("BA", NOW)["windows"]["1h"]["momentum"] == approx(1.0)
+    assert aggregates.get("BA", NOW)["windows"]["5m"]["momentum"] is None
+
+
+def test_expiry():
+    aggregates = SignalAggregates()
+    aggregates.add([company("BA", 0.5)], NOW)
+    later = NOW + 2 * 24 * 60 * 60
+    aggregates.add([company("BA", -0.5)], later)
+    windows = aggregates.get("BA", later)["windows"]
+    assert windows["1d"]["count"] == 1
+    assert windows["1d"]["mean_sentiment"] == approx(-0.5)
+
+
+def test_ewma():
+    aggregates = SignalAggregates()
+    aggregates.add([company("BA", 1.0)], NOW)
+    aggregates.add([company("BA", 0.0)], NOW)
+    assert aggregates.get("BA", NOW)["ewma_sentiment"] == approx(0.5)
+    aggregates.add([company("BA", 0.0)], NOW + 10 * 60 * 60)
+    assert aggregates.get("BA", NOW)["ewma_sentiment"] < 0.01
+
+
+def test_skips_missing_sentiment():
+    aggregates = SignalAggregates()
+    aggregates.add([Company(name="Boeing", ticker="BA")], NOW)
+    assert aggregates.get("BA", NOW) is None
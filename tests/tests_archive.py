@@ -0,0 +1,93 @@
+from json import dumps
+from os import utime
+from pytest import fixture
+
+from archive import Archiver
+from archive import ArchiveReader
+from archive import get_tweet_id
+
+START = 1553000000.0
+
+
+def payload(tweet_id):
+    return dumps({"created_at": "Tue Mar 19 12:00:00 +0000 2019", "id": tweet_id})
+
+
+class FakeListener:
+    def __init__(self):
+        self.data = []
+
+    def on_data(self, data):
+        self.data.append(data)
+
+
+@fixture
+def directory(tmpdir):
+    archiver = Archiver(str(tmpdir), block_bytes=500, segment_bytes=500)
+    for index in range(100):
+        archiver.append(payload(1000 + index), START + index)
+    archiver.append('{"limit":{"track":1}}', START + 100)
+    archiver.close()
+    return str(tmpdir)
+
+
+def test_get_tweet_id():
+    assert get_tweet_id(payload(123).encode("utf-8")) == 123
+    assert get_tweet_id(b'{"limit":{"track":1}}') == 0
+
+
+def test_segments(directory):
+    reader = ArchiveReader(directory)
+    assert len(reader.get_segments()) > 1
+    assert all(len(reader.get_index(name)) > 1 for name in reader.get_segments()[:-1])
+
+
+def test_get(directory):
+    reader = ArchiveReader(directory)
+    assert reader.get(1042) == payload(1042).encode("utf-8")
+    assert reader.get(1200) is None
+
+
+def test_get_range(directory):
+    reader = ArchiveReader(directory)
+    records = list(reader.get_range(START + 10, START + 19))
+    assert [tweet_id for tweet_id, _, _ in records] == list(range(1010, 1020))
+    assert len(list(reader.get_range(START, START + 1000))) == 101
+
+
+def test_replay(directory):
+    listener = FakeListener()
+    reader = ArchiveReader(directory)
+    assert reader.replay(START + 50, START + 59, listener) == 10
+    assert listener.data[0] == payload(1050)
+
+
+def test_retention(tmpdir):
+    for suffix in [".arc", ".idx"]:
+        path = tmpdir.join("segment-000000000000001" + suffix)
+        path.write("")
+        utime(str(path), (START, START))
+    archiver = Archiver(str(tmpdir), retention_s=60)
+    archiver.append(payload(1), START)
+    archiver.close()
+    assert ArchiveReader(str(tmpdir)).get(1) == payload(1).encode("utf-8")
+    assert not tmpdir.join("segment-000000000000001.arc").exists()
+
+
+def test_write_failure(tmpdir, monkeypatch):
+    archiver = Archiver(str(tmpdir), flush_s=0.01)
+    write_block = archiver.write_block
+
+    def fail_once(block):
+        monkeypatch.setattr(archiver, "write_block", write_block)
+        raise OSError("disk full")
+
+    monkeypatch.setattr(archiver, "write_block", fail_once)
+    monkeypatch.setattr("archive.report_error", lambda message, **fields: None)
+    archiver.append(payload(1), START)
+    while archiver.write_block is not write_block:
+        archiver.thread.join(0.01)
+    archiver.append(payload(2), START + 1)
+    archiver.close()
+    reader = ArchiveReader(str(tmpdir))
+    assert (reader.get(1), reader.get(2)) == (None, payload(2).encode("utf-8"))
@@ -0,0 +1,77 @@
+from json import loads
+from pytest import fixture
+
+from backfill import Backfill
+
+
+class FakeTwitter:
+    """Serves a fixed timeline two tweets per page."""
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def get_timeline_pages(self, user_id, since_id=None, max_id=None):
+        ids = [i for i in self.ids
+               if (not max_id or i <= int(max_id))
+               and (not since_id or i > int(since_id))]
+        for start in range(0, len(ids), 2):
+            yield [{
+                "id": i,
+                "id_str": str(i),
+                "created_at": "Fri Mar 24 17:59:42 +0000 2017",
+                "user": {"id_str": user_id}} for i in ids[start:start + 2]]
+
+
+class FakeChecker:
+    """Finds Ford in every odd tweet ID."""
+
+    def search_company_intweet(self, tweet):
+        if tweet["id"] % 2:
+            return [{"name": "Ford", "ticker": "F"}]
+        return []
+
+
+@fixture
+def paths(tmp_path):
+    return str(tmp_path / "out.jsonl"), str(tmp_path / "state.json")
+
+
+def read_ids(output_path):
+    with open(output_path) as output:
+        return [loads(line)["id_str"] for line in output]
+
+
+def test_backfill(paths):
+    output_path, state_path = paths
+    backfill = Backfill(
+        FakeChecker(), FakeTwitter([15, 14, 13, 12, 11]), output_path,
+        state_path, workers=2)
+    backfill.run(["25073877"])
+    assert read_ids(output_path) == ["15", "14", "13", "12", "11"]
+    assert backfill.load_state() == {
+        "25073877": {"max_id": "10", "done": True, "since_id": None}}
+
+
+def test_backfill_resume(paths):
+    output_path, state_path = paths
+    backfill = Backfill(
+        FakeChecker(), FakeTwitter([15, 14, 13, 12, 11]), output_path,
+        state_path, workers=2)
+    backfill.state = {"25073877": {"max_id": "12", "done": False}}
+    backfill.run(["25073877"])
+    assert read_ids(output_path) == ["12", "11"]
+    backfill.run(["25073877"])
+    assert read_ids(output_path) == ["12", "11"]
+
+
+def test_backfill_since_id_changed(paths):
+    output_path, state_path = paths
+    backfill = Backfill(
+        FakeChecker(), FakeTwitter([15, 14, 13, 12, 11]), output_path,
+        state_path, workers=2)
+    backfill.run(["25073877"], since_id="13")
+    assert read_ids(output_path) == ["15", "14"]
+    backfill.run(["25073877"], since_id="13")
+    assert read_ids(output_path) == ["15", "14"]
+    backfill.run(["25073877"], since_id="11")
+    assert read_ids(output_path) == ["15", "14", "15", "14", "13", "12"]
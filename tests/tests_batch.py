@@ -0,0 +1,69 @@
+from pytest import fixture
+from types import SimpleNamespace
+
+from batch import BATCH_SEPARATOR
+from batch import BatchAnnotator
+
+
+@fixture
+def annotator():
+    return BatchAnnotator(checker=None, max_chars=30)
+
+
+def make_entity(name, mid, salience, offsets):
+    """Creates an annotateText entity with mentions at the offsets."""
+
+    return SimpleNamespace(
+        name=name,
+        type=3,
+        metadata={"mid": mid},
+        salience=salience,
+        mentions=[SimpleNamespace(text=SimpleNamespace(begin_offset=offset))
+                  for offset in offsets])
+
+
+def make_sentence(offset, score):
+    """Creates an annotateText sentence at the offset."""
+
+    return SimpleNamespace(
+        text=SimpleNamespace(begin_offset=offset),
+        sentiment=SimpleNamespace(score=score))
+
+
+def test_pack(annotator):
+    documents = annotator.pack([
+        (0, "Ford is great."), (2, "GM is bad."), (3, "Boeing is too expensive!")])
+    assert documents == [
+        ("Ford is great.%sGM is bad." % BATCH_SEPARATOR,
+         [(0, 0, 14), (2, 16, 26)]),
+        ("Boeing is too expensive!", [(3, 0, 24)])]
+
+
+def test_split(annotator):
+    content, spans = annotator.pack([(0, "Ford is great."), (1, "GM is bad.")])[0]
+    assert content[16:18] == "GM"
+    response = SimpleNamespace(
+        entities=[
+            make_entity("Ford", "/m/02zs4", 0.5, [0]),
+            make_entity("GM", "/m/035nm", 0.4, [16])],
+        sentences=[make_sentence(0, 0.8), make_sentence(16, -0.6)])
+    split = list(annotator.split(response, spans))
+    assert [(index, [e.name for e in entities], sentiment)
+            for index, entities, sentiment in split] == [
+        (0, ["Ford"], 0.8), (1, ["GM"], -0.6)]
+
+
+def test_annotation_failure(monkeypatch):
+    checker = SimpleNamespace(
+        get_longtext=lambda tweet: tweet["text"],
+        search_company_intweet=lambda tweet: [tweet["text"]])
+    annotator = BatchAnnotator(checker, max_chars=30)
+
+    def annotate(content):
+        raise ValueError(content)
+
+    monkeypatch.setattr(annotator, "annotate", annotate)
+    monkeypatch.setattr("batch.report_error", lambda message, **fields: None)
+    tweets = [{"text": "Ford is great."}, {"text": ""}, {"text": "GM is bad."}]
+    assert annotator.search_companies(tweets) == [
+        ["Ford is great."], None, ["GM is bad."]]
@@ -0,0 +1,64 @@
+from pytest import raises
+from threading import Thread
+
+from batcher import MicroBatcher
+
+
+def get_all(batcher, keys):
+    """Requests the keys concurrently and returns the results by key."""
+
+    results = {}
+
+    def get(key):
+        results[key] = batcher.get(key)
+
+    threads = [Thread(target=get, args=[key]) for key in keys]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_batches_unique_keys():
+    calls = []
+
+    def resolve(keys, timeout):
+        calls.append(sorted(keys))
+        return {key: key.upper() for key in keys}
+
+    batcher = MicroBatcher(resolve, max_items=10, max_wait_s=0.05)
+    results = get_all(batcher, ["a", "b", "a", "c", "b"])
+    assert results == {"a": "A", "b": "B", "c": "C"}
+    assert calls == [["a", "b", "c"]]
+    assert batcher.get_stats()["requests"] == 5
+
+
+def test_full_batch():
+    batcher = MicroBatcher(
+        lambda keys, timeout: {key: len(keys) for key in keys}, max_items=2,
+        max_wait_s=10)
+    assert get_all(batcher, ["a", "b"]) == {"a": 2, "b": 2}
+
+
+def test_error():
+    def resolve(keys, timeout):
+        raise ValueError("down")
+
+    batcher = MicroBatcher(resolve, max_items=10, max_wait_s=0.01)
+    with raises(ValueError):
+        batcher.get("a")
+
+
+def test_timeout():
+    timeouts = []
+
+    def resolve(keys, timeout):
+        timeouts.append(timeout)
+        return {}
+
+    batcher = MicroBatcher(resolve, max_items=1, max_wait_s=0)
+    batcher.get("a", timeout=5)
+    batcher.get("b")
+    assert 4 < timeouts[0] <= 5
+    assert timeouts[1] is None
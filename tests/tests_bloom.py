@@ -0,0 +1,73 @@
+from os.path import join
+from time import time
+
+from bloom import BloomFilter
+from bloom import get_filter_size
+from bloom import NegativeFilter
+
+
+def test_get_filter_size():
+    bits, hashes = get_filter_size(1000, 0.01)
+    assert bits % 8 == 0
+    assert 9000 < bits < 10000
+    assert hashes == 7
+
+
+def test_bloom_filter():
+    bits, hashes = get_filter_size(1000, 0.01)
+    bloom = BloomFilter(bits, hashes)
+    for i in range(1000):
+        bloom.add("/m/%d" % i)
+    assert all("/m/%d" % i in bloom for i in range(1000))
+    false_positives = sum("/g/%d" % i in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_negative_filter_rebuild():
+    negatives = NegativeFilter(100, 0.01, 60)
+    negatives.add("/m/0")
+    now = time()
+    with negatives.lock:
+        negatives.rebuild_if_due(now + 60)
+    assert "/m/0" in negatives
+    with negatives.lock:
+        negatives.rebuild_if_due(now + 120)
+    assert "/m/0" not in negatives
+    assert negatives.get_stats()["rebuilds"] == 2
+
+
+def test_negative_filter_clear():
+    negatives = NegativeFilter(100, 0.01, 60)
+    negatives.add("/m/0")
+    with negatives.lock:
+        negatives.rebuild_if_due(time() + 60)
+    negatives.add("/m/1")
+    negatives.clear()
+    assert "/m/0" not in negatives
+    assert "/m/1" not in negatives
+
+
+def test_negative_filter_capacity():
+    negatives = NegativeFilter(10, 0.01, 60)
+    for i in range(10):
+        negatives.add("/m/%d" % i)
+    negatives.add("/m/10")
+    assert negatives.get_stats()["keys"] == 1
+    assert negatives.get_stats()["previous_keys"] == 10
+    assert "/m/0" in negatives
+
+
+def test_negative_filter_save_load(tmpdir):
+    path = join(str(tmpdir), "no_ticker.filter")
+    negatives = NegativeFilter(100, 0.01, 60, path=path)
+    negatives.add("/m/0")
+    negatives.stop()
+
+    loaded = NegativeFilter(100, 0.01, 60, path=path)
+    assert "/m/0" in loaded
+    assert "/m/1" not in loaded
+    loaded.stop()
+
+    resized = NegativeFilter(1000, 0.01, 60, path=path)
+    assert "/m/0" not in resized
+    resized.stop()
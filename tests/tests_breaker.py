@@ -0,0 +1,46 @@
+from pytest import fixture
+from pytest import raises
+from time import sleep
+
+from breaker import BreakerOpen
+from breaker import CircuitBreaker
+
+
+@fixture
+def breaker():
+    return CircuitBreaker(
+        "test", window_size=4, min_calls=4, slow_call_s=0.05, open_s=0.05)
+
+
+def fail():
+    raise ValueError("upstream down")
+
+
+def test_stays_closed(breaker):
+    for _ in range(10):
+        assert breaker.call(lambda: 1) == 1
+    assert breaker.get_stats()["state"] == "closed"
+
+
+def test_opens_on_errors(breaker):
+    for _ in range(4):
+        with raises(ValueError):
+            breaker.call(fail)
+    assert breaker.is_open()
+    with raises(BreakerOpen):
+        breaker.call(lambda: 1)
+
+
+def test_opens_on_slow_calls(breaker):
+    for _ in range(4):
+        breaker.call(sleep, 0.06)
+    assert breaker.is_open()
+
+
+def test_half_open_probe(breaker):
+    for _ in range(4):
+        with raises(ValueError):
+            breaker.call(fail)
+    sleep(0.06)
+    assert breaker.call(lambda: 1) == 1
+    assert breaker.get_stats()["state"] == "closed"
@@ -0,0 +1,35 @@
+from pytest import fixture
+from time import sleep
+
+from cache import MISSING
+from cache import TTLCache
+
+
+@fixture
+def cache():
+    return TTLCache(2, 0.05, max_stale_s=0.2)
+
+
+def test_get(cache):
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert cache.get("b") is MISSING
+
+
+def test_stale(cache):
+    cache.set("a", None)
+    sleep(0.06)
+    assert cache.get("a") is MISSING
+    assert cache.get_stale("a") is None
+    sleep(0.15)
+    assert cache.get_stale("a") is MISSING
+
+
+def test_lru_eviction(cache):
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
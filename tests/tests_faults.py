@@ -0,0 +1,130 @@
+from itertools import count
+from pytest import raises
+from time import monotonic
+
+from cache import TTLCache
+from capacity import get_percentile
+from capacity import measure
+from capacity import sweep
+from faults import FaultInjector
+from faults import FaultPlan
+from faults import get_partial
+from faults import InjectedError
+from faults import INJECTOR
+
+
+def test_latency_distributions():
+    assert FaultPlan("fixed", latency_s=0.2).get_latency() == 0.2
+    uniform = FaultPlan("uniform", min_s=0.1, max_s=0.3, seed=1)
+    assert all(0.1 <= uniform.get_latency() <= 0.3 for _ in range(100))
+    lognormal = FaultPlan("lognormal", median_s=0.3, p99_s=5, seed=1)
+    latencies = sorted(lognormal.get_latency() for _ in range(10000))
+    assert 0.25 < latencies[5000] < 0.35
+    assert 3.5 < latencies[9900] < 7
+    assert FaultPlan().get_latency() == 0.0
+    with raises(ValueError):
+        FaultPlan("pareto")
+    with raises(ValueError):
+        FaultPlan("lognormal", median_s=0.3)
+    with raises(ValueError):
+        FaultPlan.from_options({"error_rate": "often"})
+
+
+def test_injected_faults():
+    injector = FaultInjector({"nl": FaultPlan(error_rate=1)})
+    with raises(InjectedError):
+        injector.call("nl", lambda: 1)
+    assert injector.call("wikidata", lambda: 1) == 1
+
+    injector.set_plan("nl", FaultPlan("fixed", latency_s=1))
+    start_time = monotonic()
+    with raises(InjectedError):
+        injector.call("nl", lambda timeout: 1, timeout=0.1)
+    assert monotonic() - start_time < 0.5
+
+    injector.set_plan("nl", FaultPlan(partial_rate=1))
+    assert injector.call("nl", lambda: [1, 2, 3, 4]) == [1, 2]
+
+    injector.set_plan("nl", None)
+    assert injector.call("nl", lambda: [1, 2]) == [1, 2]
+    stats = injector.get_stats()["nl"]
+    assert stats["plan"] is None
+    assert (stats["calls"], stats["errors"], stats["timeouts"]) == (3, 1, 1)
+    assert stats["partials"] == 1
+
+
+def test_from_json():
+    injector = FaultInjector.from_json(
+        '{"wikidata": {"distribution": "fixed", "latency_s": 0.5, "error_rate": 0.1}}'
+    )
+    plan = injector.get_plan("wikidata")
+    assert (plan.latency_s, plan.error_rate) == (0.5, 0.1)
+
+
+def test_get_partial():
+    assert get_partial({"a": 1, "b": 2}) == {"a": 1}
+    assert get_partial((1, 2, 3)) == (1,)
+    assert get_partial("text") == "text"
+
+
+def test_get_percentile():
+    assert get_percentile([], 50) is None
+    assert get_percentile(list(range(100)), 99) == 99
+    assert get_percentile(list(range(100)), 50) == 50
+
+
+def test_sweep():
+    def handler(item):
+        INJECTOR.call("test", lambda: item)
+
+    slow = {"distribution": "fixed", "latency_s": 0.05}
+    scenarios = [
+        {"name": "fast", "faults": {}},
+        {"name": "slow", "faults": {"test": slow}},
+    ]
+    rows = sweep(handler, lambda: 1, scenarios, [1, 4], 0.3)
+    assert [(row["scenario"], row["workers"]) for row in rows] == [
+        ("fast", 1),
+        ("fast", 4),
+        ("slow", 1),
+        ("slow", 4),
+    ]
+    slow_1, slow_4 = rows[2], rows[3]
+    assert 0.05 <= slow_1["p50_s"] < 0.1
+    assert slow_4["throughput_per_s"] > 2 * slow_1["throughput_per_s"]
+    assert INJECTOR.get_plan("test") is None
+
+
+def test_sweep_cold_caches():
+    cache = TTLCache(100, 60)
+    keys = count()
+
+    def handler(item):
+        if cache.get(item, None) is None:
+            cache.set(item, INJECTOR.call("wikidata", lambda: item))
+
+    slow = {"distribution": "fixed", "latency_s": 0.05}
+    scenarios = [
+        {"name": "fast", "faults": {}},
+        {"name": "slow", "faults": {"wikidata": slow}},
+    ]
+    def make_item():
+        return next(keys) % 20
+
+    warm = sweep(handler, make_item, scenarios, [1], 0.3)
+    assert [row["cache"] for row in warm] == ["warm", "warm"]
+    assert warm[1]["p50_s"] < 0.01
+
+    cold = sweep(handler, make_item, scenarios, [1], 0.3, reset=cache.clear)
+    assert [row["cache"] for row in cold] == ["cold", "cold"]
+    assert cold[1]["p50_s"] >= 0.05
+
+
+def test_measure_errors():
+    def handler(item):
+        raise ValueError(item)
+
+    row = measure(handler, lambda: 1, 2, 0.05)
+    assert row["completed"] == 0
+    assert row["errors"] > 0
+    assert row["p50_s"] is None
@@ -0,0 +1,85 @@
+from json import dumps
+from json import loads
+from pytest import raises
+from queue import Empty
+from threading import Thread
+from time import time
+
+from freshness import FreshnessQueue
+from freshness import get_account
+from freshness import get_created_s
+from freshness import parse_weights
+from freshness import TWITTER_EPOCH_MS
+
+
+def make_payload(age_s, text, user_id="1"):
+    tweet_id = (int((time() - age_s) * 1000) - TWITTER_EPOCH_MS) << 22
+    return dumps({"id": tweet_id, "text": text, "user": {"id": 5, "id_str": user_id}})
+
+
+def get_texts(queue):
+    texts = []
+    while queue.qsize():
+        texts.append(loads(queue.get(block=False))["text"])
+        queue.task_done()
+    return texts
+
+
+def test_parse():
+    assert parse_weights("1:2, 3:0.5,") == {"1": 2.0, "3": 0.5}
+    assert get_account(make_payload(0, "", "42").encode()) == "42"
+    assert get_account(b"{}") is None
+    assert get_created_s(1 << 22) == (TWITTER_EPOCH_MS + 1) / 1000
+
+
+def test_newest_first():
+    queue = FreshnessQueue("newest", max_age_s=60, weights={})
+    for age_s, text in [(30, "old"), (1, "new"), (10, "mid"), (600, "stale")]:
+        queue.put(make_payload(age_s, text))
+    assert get_texts(queue) == ["new", "mid", "old", "stale"]
+    queue.put('{"limit":{"track":1}}')
+    assert queue.get(block=False) == '{"limit":{"track":1}}'
+    assert queue.get_stats()["fresh_served"] == 4
+
+
+def test_deadline_first():
+    queue = FreshnessQueue("deadline", max_age_s=60, weights={})
+    for age_s, text in [(10, "mid"), (1, "new"), (30, "old")]:
+        queue.put(make_payload(age_s, text))
+    assert get_texts(queue) == ["old", "mid", "new"]
+
+
+def test_backfill_lane():
+    queue = FreshnessQueue("newest", max_age_s=60, weights={})
+    for age_s, text in [(600, "stale"), (900, "staler"), (5, "fresh")]:
+        queue.put(make_payload(age_s, text))
+    assert get_texts(queue) == ["fresh", "staler", "stale"]
+    stats = queue.get_stats()
+    assert (stats["fresh_served"], stats["backfill_served"]) == (1, 2)
+    assert stats["expired"] == 2
+
+
+def test_account_weights():
+    queue = FreshnessQueue("newest", max_age_s=60, boost_s=60, weights={"2": 2})
+    queue.put(make_payload(1, "other", "1"))
+    queue.put(make_payload(30, "weighted", "2"))
+    assert get_texts(queue) == ["weighted", "other"]
+
+
+def test_get_join():
+    queue = FreshnessQueue()
+    with raises(Empty):
+        queue.get(timeout=0.01)
+    with raises(ValueError):
+        FreshnessQueue("random")
+
+    def work():
+        queue.get()
+        queue.task_done()
+
+    worker = Thread(target=work)
+    worker.start()
+    queue.put(make_payload(0, "tweet"))
+    queue.join()
+    worker.join()
+    assert queue.qsize() == 0
@@ -0,0 +1,111 @@
+from pytest import raises
+from threading import Thread
+from time import monotonic
+from time import sleep
+
+from limits import AdaptiveLimiter
+from limits import Limiter
+from limits import LimitTimeout
+from limits import TokenBucket
+
+
+def test_token_bucket_burst():
+    bucket = TokenBucket(10, 2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0 < bucket.reserve() <= 0.1
+
+
+def test_token_bucket_unlimited():
+    bucket = TokenBucket(0, 0)
+    assert all(bucket.reserve() == 0 for _ in range(100))
+
+
+def test_limiter_concurrency():
+    limiter = Limiter("test", 2, 0, 0)
+    peak = []
+
+    def work():
+        with limiter:
+            peak.append(limiter.get_stats()["in_flight"])
+            sleep(0.02)
+
+    threads = [Thread(target=work) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) <= 2
+    assert limiter.get_stats()["waits"] == 6
+
+
+def test_limiter_rate():
+    limiter = Limiter("test", 10, 50, 1)
+    start_time = monotonic()
+    for _ in range(5):
+        with limiter:
+            pass
+    assert monotonic() - start_time >= 0.07
+
+
+def test_limiter_timeout():
+    limiter = Limiter("test", 1, 0, 0, max_wait_s=0.01)
+    limiter.acquire()
+    with raises(LimitTimeout):
+        limiter.acquire()
+
+
+def test_adaptive_limiter_increase():
+    limiter = AdaptiveLimiter("test", 2, 4, 0, 0)
+    limiter.acquire()
+    limiter.acquire()
+    for _ in range(20):
+        limiter.record_result(0.01, True)
+    assert limiter.get_limit() == 4
+    assert limiter.get_stats()["long_latency_s"] == 0.01
+
+
+def test_adaptive_limiter_idle():
+    limiter = AdaptiveLimiter("test", 2, 4, 0, 0)
+    for _ in range(20):
+        limiter.record_result(0.01, True)
+    assert limiter.get_limit() == 2
+
+
+def test_adaptive_limiter_decrease():
+    limiter = AdaptiveLimiter("test", 8, 8, 0, 0, backoff_ratio=0.5)
+    for _ in range(20):
+        limiter.record_result(0.01, True)
+    limiter.record_result(0.1, True)
+    assert limiter.get_limit() == 8
+    for _ in range(10):
+        limiter.record_result(0.1, True)
+    assert limiter.get_limit() == 4
+    sleep(0.1)
+    limiter.record_result(0.01, False)
+    assert limiter.get_limit() == 2
+    for _ in range(5):
+        limiter.record_result(0.01, False)
+    assert limiter.get_limit() == 2
+    assert limiter.get_stats()["decreases"] == 2
+
+
+def test_adaptive_limiter_mixed_latencies():
+    limiter = AdaptiveLimiter("test", 2, 5, 0, 0)
+    limiter.acquire()
+    limiter.acquire()
+    for _ in range(100):
+        for latency_s in [0.05, 0.8, 0.15]:
+            limiter.record_result(latency_s, True)
+    assert limiter.get_limit() == 5
+
+
+def test_limiter_set_concurrency():
+    limiter = Limiter("test", 1, 0, 0, max_wait_s=1)
+    limiter.acquire()
+    acquired = []
+    thread = Thread(target=lambda: acquired.append(limiter.acquire()))
+    thread.start()
+    limiter.set_concurrency(2)
+    thread.join()
+    assert limiter.get_stats()["in_flight"] == 2
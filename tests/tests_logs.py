@@ -0,0 +1,49 @@
+from json import loads
+from threading import Event
+
+from logs import FileSink
+from logs import Shipper
+
+
+class SlowSink:
+    def __init__(self):
+        self.release = Event()
+        self.records = []
+
+    def write(self, records):
+        self.release.wait()
+        self.records.extend(records)
+
+
+class FailingSink:
+    def write(self, records):
+        raise IOError("sink down")
+
+
+def test_file_sink(tmpdir):
+    path = str(tmpdir.join("test.log"))
+    shipper = Shipper(FileSink(path), flush_s=0.01)
+    shipper.put({"message": "one"})
+    shipper.put({"message": "two"})
+    shipper.close()
+    with open(path) as log_file:
+        assert [loads(line)["message"] for line in log_file] == ["one", "two"]
+    assert shipper.get_stats()["shipped"] == 2
+
+
+def test_shipper_drops_when_full():
+    sink = SlowSink()
+    shipper = Shipper(sink, max_size=5, batch_size=1, flush_s=0.01)
+    for index in range(100):
+        shipper.put({"message": index})
+    assert shipper.get_stats()["dropped"] >= 90
+    sink.release.set()
+    shipper.close()
+    assert len(sink.records) <= 10
+
+
+def test_shipper_sink_failure():
+    shipper = Shipper(FailingSink(), flush_s=0.01)
+    shipper.put({"message": "lost"})
+    shipper.close()
+    assert shipper.get_stats()["failed"] == 1
@@ -0,0 +1,50 @@
+from json import dumps
+from pytest import raises
+from time import sleep
+from types import SimpleNamespace
+
+from archive import Archiver
+from main import get_worker_path
+from main import Main
+from main import parse_args
+from records import Company
+from twitter import ACC_USER_ID
+
+START = 1553000000.0
+
+
+def test_replay_does_not_post(tmpdir, monkeypatch):
+    directory = str(tmpdir.join("archive"))
+    archiver = Archiver(directory)
+    archiver.append(dumps({
+        "id": 1,
+        "id_str": "1",
+        "text": "Ford is great.",
+        "user": {"id_str": ACC_USER_ID, "screen_name": "account"}}), START)
+    archiver.close()
+
+    monkeypatch.setattr("twitter.NUM_THREADS", 2)
+    monkeypatch.setattr("twitter.QUEUE_TIMEOUT_S", 0.1)
+    main = Main(store_path="", post=True)
+    posts = []
+    monkeypatch.setattr(main.twitter, "_twitter_api", SimpleNamespace(
+        update_status=lambda text: posts.append(text)))
+    monkeypatch.setattr(
+        main.checker, "search_company_intweet",
+        lambda tweet, latencies: [
+            Company(name="Ford", ticker="F", exchange="NYSE", sentiment=0.5)])
+    assert main.run_replay(START - 1, START + 1, directory=directory) == 1
+    sleep(0.2)
+    assert posts == []
+    assert main.aggregates.get_tickers() == ["F"]
+
+
+def test_work_needs_worker_id(monkeypatch):
+    monkeypatch.setattr("sys.argv", ["main.py", "work"])
+    with raises(SystemExit):
+        parse_args()
+    monkeypatch.setattr("sys.argv", ["main.py", "work", "--worker-id", "2"])
+    args = parse_args()
+    assert args.worker_id == 2
+    assert get_worker_path("signals.db", args.worker_id) == "signals-2.db"
+    assert get_worker_path("", args.worker_id) == ""
@@ -0,0 +1,77 @@
+from datetime import date
+from datetime import datetime
+from pytz import utc
+from threading import Event
+
+from market import CLOSED
+from market import get_early_closes
+from market import get_market_holidays
+from market import MARKET_TIMEZONE
+from market import MarketCalendar
+from market import MarketScheduler
+from market import OPEN
+from market import PRE_OPEN
+
+
+def new_york(*args):
+    return MARKET_TIMEZONE.localize(datetime(*args))
+
+
+def test_market_holidays():
+    holidays = get_market_holidays(2022)
+    assert date(2022, 4, 15) in holidays  # Good Friday
+    assert date(2022, 6, 20) in holidays  # Juneteenth (observed)
+    assert date(2022, 12, 26) in holidays  # Christmas Day (observed)
+    assert date(2022, 10, 10) not in holidays  # Columbus Day
+    assert date(2021, 12, 31) not in get_market_holidays(2021)
+
+
+def test_early_closes():
+    assert get_early_closes(2019) == {
+        date(2019, 7, 3), date(2019, 11, 29), date(2019, 12, 24)}
+    assert get_early_closes(2020) == {date(2020, 11, 27), date(2020, 12, 24)}
+    assert get_early_closes(2021) == {date(2021, 11, 26)}
+    calendar = MarketCalendar()
+    assert calendar.get_phase(new_york(2019, 11, 29, 12, 59)) == OPEN
+    assert calendar.get_phase(new_york(2019, 11, 29, 13, 0)) == CLOSED
+
+
+def test_phases():
+    calendar = MarketCalendar(pre_open_s=15 * 60)
+    assert calendar.get_phase(new_york(2019, 3, 4, 9, 20)) == PRE_OPEN
+    assert calendar.get_phase(new_york(2019, 3, 4, 9, 30)) == OPEN
+    assert calendar.get_phase(new_york(2019, 3, 4, 16, 0)) == CLOSED
+    assert calendar.get_phase(new_york(2019, 3, 9, 12, 0)) == CLOSED
+    assert calendar.get_phase(new_york(2019, 7, 4, 12, 0)) == CLOSED
+
+
+def test_phase_in_utc():
+    calendar = MarketCalendar()
+    assert calendar.get_phase(datetime(2019, 3, 4, 15, 0, tzinfo=utc)) == OPEN
+    assert calendar.get_phase(datetime(2019, 3, 4, 14, 0, tzinfo=utc)) == CLOSED
+
+
+def test_next_open():
+    calendar = MarketCalendar()
+    assert calendar.next_open(new_york(2019, 7, 3, 17, 0)) == new_york(
+        2019, 7, 5, 9, 30
+    )
+
+
+def test_scheduler():
+    phases = []
+    changed = Event()
+
+    class FixedCalendar:
+        def get_phase(self):
+            return OPEN
+
+    def on_phase(phase):
+        phases.append(phase)
+        changed.set()
+
+    scheduler = MarketScheduler(on_phase, calendar=FixedCalendar(), check_s=0.01)
+    scheduler.start()
+    assert changed.wait(1)
+    scheduler.stop()
+    assert phases == [OPEN]
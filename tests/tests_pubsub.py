@@ -0,0 +1,58 @@
+from pytest import fixture
+from socket import AF_UNIX
+from socket import SOCK_STREAM
+from socket import socket
+from threading import Thread
+from time import monotonic
+from time import sleep
+
+from pubsub import Publisher
+from pubsub import subscribe
+from records import Company
+
+TWEET = {"id_str": "1", "created_at": None, "user": {"id_str": "2"}}
+COMPANIES = [Company(name="Boeing", ticker="BA", exchange="NYSE", sentiment=0.5)]
+
+
+@fixture
+def publisher(tmpdir):
+    publisher = Publisher(str(tmpdir.join("test.sock")), buffer_size=10)
+    yield publisher
+    publisher.close()
+
+
+def wait_for_subscribers(publisher, count):
+    deadline = monotonic() + 5
+    while publisher.get_stats()["subscribers"] < count and monotonic() < deadline:
+        sleep(0.01)
+
+
+def test_publish(publisher):
+    messages = []
+
+    def read():
+        messages.append(next(subscribe(publisher.path)))
+
+    readers = [Thread(target=read) for _ in range(3)]
+    for reader in readers:
+        reader.start()
+    wait_for_subscribers(publisher, 3)
+    publisher.publish(TWEET, COMPANIES)
+    for reader in readers:
+        reader.join(5)
+    assert len(messages) == 3
+    assert messages[0]["id_str"] == "1"
+    assert messages[0]["account"] == "2"
+    assert messages[0]["companies"] == [dict(COMPANIES[0])]
+
+
+def test_slow_consumer_dropped(publisher):
+    slow = socket(AF_UNIX, SOCK_STREAM)
+    slow.connect(publisher.path)
+    wait_for_subscribers(publisher, 1)
+    start_time = monotonic()
+    for _ in range(5000):
+        publisher.publish(TWEET, COMPANIES * 20)
+    assert monotonic() - start_time < 5
+    assert publisher.get_stats()["dropped"] > 0
+    slow.close()
@@ -0,0 +1,54 @@
+from pytest import fixture
+from pytest import raises
+
+from records import Company
+from records import Entity
+from records import unique
+
+
+@fixture
+def company():
+    return Company(
+        name="YouTube", ticker="GOOG", exchange="NASDAQ", root="Alphabet Inc.")
+
+
+def test_company_dict_view(company):
+    assert company == {
+        "exchange": "NASDAQ",
+        "name": "YouTube",
+        "root": "Alphabet Inc.",
+        "ticker": "GOOG"}
+    assert company["ticker"] == "GOOG"
+    assert "sentiment" not in company
+
+
+def test_company_no_root():
+    assert Company(name="Ford", ticker="F", exchange="NYSE") == {
+        "exchange": "NYSE",
+        "name": "Ford",
+        "ticker": "F"}
+
+
+def test_company_replace(company):
+    assert company.replace(sentiment=0.0)["sentiment"] == 0.0
+    assert "sentiment" not in company
+
+
+def test_company_immutable(company):
+    with raises(AttributeError):
+        company.ticker = "GOOGL"
+
+
+def test_company_from_dict(company):
+    assert Company.from_dict(dict(company)) == company
+
+
+def test_unique(company):
+    other = company.replace(ticker="GOOGL")
+    assert unique([company, other, Company.from_dict(dict(company))]) == [
+        company, other]
+
+
+def test_entity_dict_view():
+    entity = Entity(name="jobs", type=0, mid=None, salience=0.3)
+    assert entity == {"name": "jobs", "type": 0, "salience": 0.3}
@@ -1,10 +1,24 @@
 from ast import literal_eval
+from collections import OrderedDict
+from io import BytesIO
 from google.cloud import language
 from os import getenv
 from pytest import fixture
-
+from pytest import raises
+from requests import Response
+from time import monotonic
+from time import sleep
+from urllib3 import HTTPResponse
+
+from bloom import NegativeFilter
+from breaker import UpstreamError
+from records import Company
+from records import Entity
 from sentiment import Checker
-from sentiment import MID_TO_TICKER_QUERY
+from sentiment import clear_caches
+from sentiment import get_no_ticker_filter
+from sentiment import get_text_key
+from sentiment import MIDS_TO_QIDS_QUERY
 from twitter import Twitter
 
 
@@ -157,6 +171,53 @@ def test_scrape_cmpy_info_empty(checker):
     assert checker.scrape_cmpy_info("") is None
 
 
+def test_prioritize_entities(checker):
+    entities = [Entity.from_api(entity) for entity in [make_entity(
+        name="Trump",
+        type=language.enums.Entity.Type.PERSON,
+        metadata={"mid": "/m/0cqt90"},
+        salience=0.6,
+        mentions=["Trump"]), make_entity(
+        name="Ford",
+        type=language.enums.Entity.Type.ORGANIZATION,
+        metadata={"mid": "/m/02zs4"},
+        salience=0.1,
+        mentions=["Ford"]), make_entity(
+        name="jobs",
+        type=language.enums.Entity.Type.OTHER,
+        metadata={},
+        salience=0.2,
+        mentions=["jobs"]), make_entity(
+        name="General Motors",
+        type=language.enums.Entity.Type.ORGANIZATION,
+        metadata={"mid": "/m/035nm"},
+        salience=0.3,
+        mentions=["General Motors"])]]
+    assert [entity.name for entity in checker.prioritize_entities(entities)] == [
+        "General Motors", "Ford"]
+
+
+def test_get_text_key():
+    key = get_text_key("Boeing is great https://t.co/abc @realDonaldTrump")
+    assert key == get_text_key("Boeing  is great\nhttps://t.co/xyz")
+    assert key != get_text_key("Boeing is bad")
+    assert get_text_key("Boeing https://t.co/abc", strip=False) != get_text_key(
+        "Boeing https://t.co/xyz", strip=False
+    )
+
+
+def test_search_company_intweet_cached(checker):
+    tweet = {
+        "full_text": "Boeing is a great company https://t.co/abc",
+        "truncated": False,
+        "entities": {"user_mentions": []},
+    }
+    companies = checker.search_company_intweet(tweet)
+    checker._language_client = object()
+    tweet["full_text"] = "Boeing is a great company https://t.co/xyz"
+    assert checker.search_company_intweet(tweet) == companies
+
+
 def test_convert_oneentity_1(checker):
     assert checker.convert_oneentity(make_entity(
         name="General Motors",
@@ -281,7 +342,7 @@ def test_search_company_intweet_3(checker):
     assert checker.search_company_intweet(get_tweet("816260343391514624")) == [{
         "exchange": "New York Stock Exchange",
         "name": "General Motors",
-        "sentiment": 0.0
+        "sentiment": 0.0,
         "ticker": "GM"}]
 
 
@@ -472,25 +533,223 @@ def test_get_longtext_none(checker):
     assert checker.get_longtext(None) is None
 
 
-def test_retrieve_wikidata_data(checker):
-    assert checker.retrieve_wikidata_data(
-        MID_TO_TICKER_QUERY % "/m/02y1vz") == [{
-            "companyLabel": {
-                "type": "literal",
-                "value": "Facebook",
-                "xml:lang": "en"},
-            "rootLabel": {
-                "type": "literal",
-                "value": "Facebook Inc.",
-                "xml:lang": "en"},
-            "exchangeNameLabel": {
-                "type": "literal",
-                "value": "NASDAQ",
-                "xml:lang": "en"},
-            "tickerLabel": {
-                "type": "literal",
-                "value": "FB"}}]
-
-
-def test_retrieve_wikidata_data_empty(checker):
-    assert checker.retrieve_wikidata_data("") is None
+def test_query_rows(checker):
+    assert checker.query_rows(MIDS_TO_QIDS_QUERY % '"/m/02y1vz"', "mid") == {
+        "/m/02y1vz": [{"entity": "http://www.wikidata.org/entity/Q380"}]}
+
+
+def csv_response(body):
+    response = Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = "text/csv; charset=UTF-8"
+    response.raw = HTTPResponse(body=BytesIO(body), preload_content=False)
+    return response
+
+
+def test_get_wikidata_rows(checker, monkeypatch):
+    body = (
+        b"mid,companyLabel,rootLabel,tickerLabel,exchangeNameLabel\r\n"
+        b"/m/02y1vz,Facebook,Facebook Inc.,FB,NASDAQ\r\n"
+        b'/m/0hkqn,"Lockheed Martin, Corp.",,LMT,New York Stock Exchange\r\n'
+    )
+    monkeypatch.setattr(
+        checker, "get_wikidata", lambda query, timeout: csv_response(body)
+    )
+    rows_by_mid = checker.get_wikidata_rows("")
+    assert checker.parse_cmpy_rows(rows_by_mid["/m/02y1vz"]) == [
+        {
+            "name": "Facebook",
+            "ticker": "FB",
+            "exchange": "NASDAQ",
+            "root": "Facebook Inc.",
+        }
+    ]
+    assert checker.parse_cmpy_rows(rows_by_mid["/m/0hkqn"]) == [
+        {
+            "name": "Lockheed Martin, Corp.",
+            "ticker": "LMT",
+            "exchange": "New York Stock Exchange",
+        }
+    ]
+
+
+class BrokenBody:
+    def __init__(self, data):
+        self.data = BytesIO(data)
+        self.closed = False
+
+    def read(self, *args):
+        if self.data.tell():
+            raise ConnectionResetError("Connection reset by peer")
+        return self.data.read(40)
+
+    read1 = read
+
+    def close(self):
+        self.closed = True
+
+
+def test_get_wikidata_rows_broken(checker, monkeypatch):
+    body = b"mid,companyLabel\r\n" + b"/m/02y1vz,Facebook\r\n" * 1000
+    response = csv_response(body)
+    response.raw = HTTPResponse(body=BrokenBody(body), preload_content=False)
+    monkeypatch.setattr(
+        checker, "get_wikidata", lambda query, timeout: response
+    )
+    with raises(UpstreamError):
+        checker.get_wikidata_rows("")
+
+
+def test_parse_cmpy_rows(checker):
+    rows = [
+        {
+            "companyLabel": "Facebook",
+            "rootLabel": "Facebook",
+            "tickerLabel": "FB",
+            "exchangeNameLabel": "NASDAQ",
+        }
+    ]
+    assert checker.parse_cmpy_rows(rows) == [
+        {"name": "Facebook", "ticker": "FB", "exchange": "NASDAQ"}
+    ]
+    assert checker.parse_cmpy_rows([]) is None
+
+
+def test_get_wikidata_rows_empty(checker, monkeypatch):
+    response = csv_response(b"")
+    response.headers["Content-Type"] = "application/sparql-results+json"
+    monkeypatch.setattr(checker, "get_wikidata", lambda query, timeout: response)
+    assert checker.get_wikidata_rows("") == {}
+
+
+def test_query_rows_deadline(checker, monkeypatch):
+    timeouts = []
+
+    def get_wikidata_rows(query, key, timeout):
+        timeouts.append(timeout)
+        return {}
+
+    monkeypatch.setattr(checker, "get_wikidata_rows", get_wikidata_rows)
+    assert checker.query_rows("", "mid", monotonic() + 2) == {}
+    assert 1 < timeouts[0] <= 2
+    with raises(UpstreamError):
+        checker.query_rows("", "mid", monotonic() - 1)
+
+
+def test_fetch_cmpy_infos_phases(checker, monkeypatch):
+    entity = "http://www.wikidata.org/entity/"
+    results = {
+        "mid": {"/m/0k8z": [{"entity": entity + "Q312"}], "/m/0none": []},
+        "entity": {
+            entity + "Q312": [
+                {
+                    "company": entity + "Q312",
+                    "root": entity + "Q312",
+                    "ticker": "AAPL",
+                    "exchangeName": entity + "Q82059",
+                }
+            ]
+        },
+        "item": {
+            entity + "Q312": [{"itemLabel": "Apple Inc."}],
+            entity + "Q82059": [{"itemLabel": "NASDAQ"}],
+        },
+    }
+    queries = []
+
+    def query_rows(query, key, deadline=None):
+        queries.append(key)
+        return results[key]
+
+    monkeypatch.setattr(checker, "query_rows", query_rows)
+    caches = [
+        checker.company_cache,
+        checker.qid_cache,
+        checker.listing_cache,
+        checker.label_cache,
+    ]
+    for cache in caches:
+        monkeypatch.setattr(cache, "entries", OrderedDict())
+    monkeypatch.setattr(checker, "no_ticker", NegativeFilter(100, 0.01, 60))
+
+    companies = checker.fetch_cmpy_infos(["/m/0k8z", "/m/0none"])
+    assert companies == {
+        "/m/0k8z": [{"name": "Apple Inc.", "ticker": "AAPL", "exchange": "NASDAQ"}],
+        "/m/0none": None,
+    }
+    assert queries == ["mid", "entity", "item"]
+    assert "/m/0none" in checker.no_ticker
+    assert checker.scrape_cmpy_info("/m/0none") is None
+
+    checker.company_cache.entries.clear()
+    assert checker.fetch_cmpy_infos(["/m/0k8z"]) == {
+        "/m/0k8z": companies["/m/0k8z"]
+    }
+    assert queries == ["mid", "entity", "item"]
+
+
+def test_no_ticker_filter_in_memory(tmpdir):
+    no_ticker = get_no_ticker_filter("")
+    assert no_ticker.path is None
+    assert Checker(no_ticker_path="").no_ticker is no_ticker
+    path = str(tmpdir.join("no_ticker.filter"))
+    assert Checker(no_ticker_path=path).no_ticker is get_no_ticker_filter(path)
+
+
+def test_clear_caches(tmpdir):
+    checker = Checker(no_ticker_path=str(tmpdir.join("no_ticker.filter")))
+    checker.company_cache.set("/m/0k8z", [])
+    checker.label_cache.set("Q1", "Ford")
+    checker.no_ticker.add("/m/0none")
+    clear_caches()
+    assert len(checker.company_cache) == 0
+    assert len(checker.label_cache) == 0
+    assert "/m/0none" not in checker.no_ticker
+
+
+def test_resolve_entities_concurrent(checker, monkeypatch):
+    def lookup_cmpy_info(mid, timeout=None):
+        sleep(0.2)
+        return [Company(name=mid, ticker=mid.upper())]
+
+    monkeypatch.setattr(checker, "lookup_cmpy_info", lookup_cmpy_info)
+    monkeypatch.setattr(checker, "_skipped_types", set())
+    entities = [
+        Entity(name=mid, type="ORGANIZATION", mid=mid, salience=0.1)
+        for mid in ["/m/a", "/m/b", "/m/c"]
+    ]
+    start_time = monotonic()
+    companies, degraded = checker.find_companies(
+        entities, lambda: 0.5, monotonic() + 10
+    )
+    assert monotonic() - start_time < 0.5
+    assert [company["ticker"] for company in companies] == ["/M/A", "/M/B", "/M/C"]
+    assert not degraded
+
+
+def test_find_companies_degraded(checker, monkeypatch):
+    def lookup_cmpy_info(mid, timeout=None):
+        if mid == "/m/down":
+            raise UpstreamError(mid)
+        return [Company(name=mid, ticker=mid.upper())]
+
+    def get_sentiment():
+        raise UpstreamError("sentiment")
+
+    monkeypatch.setattr("sentiment.report_error", lambda message, **fields: None)
+    monkeypatch.setattr(checker, "lookup_cmpy_info", lookup_cmpy_info)
+    monkeypatch.setattr(checker, "_skipped_types", set())
+    entities = [
+        Entity(name=mid, type="ORGANIZATION", mid=mid, salience=0.1)
+        for mid in ["/m/up", "/m/down"]
+    ]
+    companies, degraded = checker.find_companies(
+        entities, lambda: 0.5, monotonic() + 10
+    )
+    assert [company["ticker"] for company in companies] == ["/M/UP"]
+    assert degraded
+    companies, degraded = checker.find_companies(
+        entities[:1], get_sentiment, monotonic() + 10
+    )
+    assert companies[0]["sentiment"] == 0
+    assert degraded
@@ -0,0 +1,143 @@
+from pytest import fixture
+from requests import get
+from requests import post
+from threading import Event
+
+from standin import make_certificate
+from standin import StandIn
+from standin import TweetFactory
+from streaming import CompressedStream
+from twitter import ACC_USER_ID
+from twitter import StreamStats
+
+
+class FakeAuth:
+    def apply_auth(self):
+        return None
+
+
+class CountingListener:
+    def __init__(self, count):
+        self.count = count
+        self.data = []
+        self.done = Event()
+
+    def on_connect(self):
+        pass
+
+    def keep_alive(self):
+        pass
+
+    def on_data(self, data):
+        self.data.append(data)
+        if len(self.data) >= self.count:
+            self.done.set()
+            return False
+        return True
+
+    def on_error(self, status):
+        return False
+
+    def on_timeout(self):
+        pass
+
+    def on_exception(self, exception):
+        pass
+
+
+@fixture(scope="module")
+def certificate(tmpdir_factory):
+    return make_certificate(str(tmpdir_factory.mktemp("standin")))
+
+
+@fixture
+def standin(certificate):
+    certfile, keyfile, _ = certificate
+    standin = StandIn(TweetFactory(seed=1), certfile, keyfile, port=0, rate=200)
+    standin.start()
+    yield standin
+    standin.stop()
+
+
+def url(standin, path):
+    return "https://localhost:%s%s" % (standin.port, path)
+
+
+def test_make_tweet():
+    factory = TweetFactory(target_ratio=1, min_chars=200, max_chars=200, seed=1)
+    tweet = factory.make_tweet()
+    assert tweet["user"]["id_str"] == ACC_USER_ID
+    assert tweet["truncated"]
+    assert len(tweet["extended_tweet"]["full_text"]) == 200
+    assert len(tweet["text"]) == 140
+    assert "full_text" in factory.make_tweet(extended=True)
+
+
+def test_timeline(standin, certificate):
+    response = get(
+        url(standin, "/1.1/statuses/user_timeline.json"),
+        params={"user_id": ACC_USER_ID, "count": 50},
+        verify=certificate[0],
+    )
+    page = response.json()
+    assert len(page) == 50
+    response = get(
+        url(standin, "/1.1/statuses/user_timeline.json"),
+        params={"user_id": ACC_USER_ID, "count": 50, "max_id": page[-1]["id"] - 1},
+        verify=certificate[0],
+    )
+    assert response.json()[0]["id"] < page[-1]["id"]
+
+
+def test_update(standin, certificate):
+    response = post(
+        url(standin, "/1.1/statuses/update.json"),
+        data={"status": "Boeing $BA"},
+        verify=certificate[0],
+    )
+    assert response.json()["text"] == "Boeing $BA"
+    assert standin.get_stats()["updates"] == 1
+
+
+def test_api_errors(standin, certificate):
+    standin.api_error_rate = 1
+    response = post(
+        url(standin, "/1.1/statuses/update.json"),
+        data={"status": "Boeing"},
+        verify=certificate[0],
+    )
+    assert response.status_code in (420, 503)
+
+
+def test_stream(standin, certificate):
+    listener = CountingListener(20)
+    stats = StreamStats()
+    stream = CompressedStream(
+        FakeAuth(),
+        listener,
+        stats,
+        host="localhost:%s" % standin.port,
+        verify=certificate[0],
+    )
+    stream.filter(follow=[ACC_USER_ID], is_async=True)
+    assert listener.done.wait(10)
+    stream.disconnect()
+    assert '"id_str"' in listener.data[0]
+    assert stats.get_stats()["wire_bytes"] < stats.get_stats()["data_bytes"]
+
+
+def test_stream_error(standin, certificate):
+    standin.error_rate = 1
+    standin.error_codes = [420]
+    statuses = []
+    listener = CountingListener(1)
+    listener.on_error = lambda status: statuses.append(status) or False
+    stream = CompressedStream(
+        FakeAuth(),
+        listener,
+        StreamStats(),
+        host="localhost:%s" % standin.port,
+        verify=certificate[0],
+    )
+    stream.filter(follow=[ACC_USER_ID])
+    assert statuses == [420]
@@ -0,0 +1,25 @@
+from pytest import fixture
+
+from startup import IMPORT_TIME_HEADER
+from startup import StartupTimer
+
+
+@fixture
+def timer():
+    return StartupTimer()
+
+
+def test_phase(timer):
+    with timer.phase("first"):
+        pass
+    with timer.phase("second"):
+        pass
+    assert [name for name, _ in timer.phases] == ["first", "second"]
+
+
+def test_report(timer):
+    with timer.phase("json"):
+        import json  # noqa: F401
+    report = timer.report()
+    assert "| json" in report.splitlines()[0]
+    assert IMPORT_TIME_HEADER in report
@@ -0,0 +1,69 @@
+from pytest import fixture
+from threading import Event
+from time import gmtime
+from time import strftime
+from time import time
+
+from store import parse_created_at
+from store import SignalStore
+
+
+def make_tweet(tweet_id, created_at):
+    return {
+        "id_str": tweet_id,
+        "created_at": strftime("%a %b %d %H:%M:%S +0000 %Y", gmtime(created_at)),
+        "user": {"id_str": "25073877"}}
+
+
+@fixture
+def store(tmp_path):
+    return SignalStore(str(tmp_path / "signals.db"))
+
+
+def test_parse_created_at():
+    assert parse_created_at({
+        "created_at": "Fri Mar 24 17:59:42 +0000 2017"}) == 1490378382
+    assert parse_created_at({}) is None
+
+
+def test_get_signals(store):
+    now = time()
+    store.add(make_tweet("1", now - 2 * 60 * 60), [
+        {"name": "Ford", "ticker": "F", "sentiment": 0.2}])
+    store.add(make_tweet("2", now - 60), [
+        {"name": "Ford", "ticker": "F", "sentiment": -0.3},
+        {"name": "General Motors", "ticker": "GM", "sentiment": -0.3}],
+        {"analysis_s": 0.5})
+    store.add(make_tweet("3", now), [])
+    store.close()
+    signals = store.get_signals("F", 1)
+    assert [signal["id_str"] for signal in signals] == ["2"]
+    assert signals[0]["sentiment"] == -0.3
+    assert signals[0]["latencies"] == {"analysis_s": 0.5}
+    assert len(store.get_signals("F", 3)) == 2
+
+
+def test_rewrite(store):
+    tweet = make_tweet("1", time())
+    store.add(tweet, [{"name": "Ford", "ticker": "F", "sentiment": 0.2}])
+    store.add(tweet, [{"name": "Ford", "ticker": "F", "sentiment": 0.4}])
+    store.close()
+    assert [signal["sentiment"] for signal in store.get_signals("F", 1)] == [0.4]
+
+
+def test_failed_batch(store, monkeypatch):
+    write_batch = store.write_batch
+    failed = Event()
+
+    def fail_once(connection, batch):
+        monkeypatch.setattr(store, "write_batch", write_batch)
+        failed.set()
+        raise ValueError("disk full")
+
+    monkeypatch.setattr(store, "write_batch", fail_once)
+    monkeypatch.setattr("store.report_error", lambda message, **fields: None)
+    store.add(make_tweet("1", time()), [{"name": "Ford", "ticker": "F"}])
+    assert failed.wait(5)
+    store.add(make_tweet("2", time()), [{"name": "Ford", "ticker": "F"}])
+    store.close()
+    assert [signal["id_str"] for signal in store.get_signals("F", 1)] == ["2"]
@@ -0,0 +1,76 @@
+from pytest import fixture
+from requests.structures import CaseInsensitiveDict
+from threading import Event
+
+import streaming
+from streaming import CompressedStream
+from twitter import StreamStats
+
+
+class FakeRaw:
+    """A response body that serves some chunks and then goes quiet."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.position = 0
+        self.closed = False
+        self.closed_event = Event()
+        self.decode_content = False
+
+    def read(self, amt=None):
+        if self.chunks:
+            chunk = self.chunks.pop(0)
+            self.position += len(chunk)
+            return chunk
+        self.closed_event.wait(5)
+        return b""
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.closed = True
+        self.closed_event.set()
+
+
+class FakeResponse:
+    def __init__(self, raw):
+        self.raw = raw
+        self.headers = CaseInsensitiveDict()
+
+    def close(self):
+        self.raw.close()
+
+
+class FakeListener:
+    def __init__(self):
+        self.data = []
+        self.keep_alives = 0
+
+    def keep_alive(self):
+        self.keep_alives += 1
+
+    def on_data(self, data):
+        self.data.append(data)
+
+
+@fixture
+def stats():
+    return StreamStats()
+
+
+def test_stall_reconnects(monkeypatch, stats):
+    monkeypatch.setattr(streaming, "STREAM_WATCHDOG_S", 0.01)
+    listener = FakeListener()
+    stream = CompressedStream(None, listener, stats, stall_s=0.05)
+    stream.running = True
+    raw = FakeRaw([b"\r\n", b"2\r\n{}"])
+    stream._read_loop(FakeResponse(raw))
+    assert raw.decode_content
+    assert listener.data == ["{}"]
+    assert listener.keep_alives >= 1
+    result = stats.get_stats()
+    assert result["stalls"] == 1
+    assert result["connects"] == 1
+    assert not result["connected"]
+    assert result["data_bytes"] == 7
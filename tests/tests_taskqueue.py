@@ -0,0 +1,174 @@
+from threading import Event
+from threading import Lock
+from threading import Thread
+from time import sleep
+from time import time
+
+from taskqueue import TaskDeferred
+from taskqueue import TaskPool
+from taskqueue import TaskQueue
+from taskqueue import TaskWorker
+
+
+def test_put_lease_ack(tmpdir):
+    task_queue = TaskQueue(str(tmpdir), partitions=4)
+    assert task_queue.put("1", "one")
+    assert not task_queue.put("1", "again")
+    tasks = task_queue.lease("a", count=10)
+    assert [(task.key, task.payload, task.deliveries) for task in tasks] == [
+        ("1", "one", 1)
+    ]
+    assert task_queue.lease("b", count=10) == []
+    assert task_queue.get_stats()["leased"] == 1
+    assert task_queue.ack(tasks[0], "a")
+    assert task_queue.get_stats() == {
+        "ready": 0,
+        "leased": 0,
+        "later": 0,
+        "done": 1,
+        "dead": 0,
+    }
+
+
+def test_lease_many(tmpdir):
+    task_queue = TaskQueue(str(tmpdir), partitions=1)
+    for i in range(5):
+        task_queue.put(str(i), str(i))
+    tasks = task_queue.lease("a", count=3)
+    assert [(task.key, task.deliveries) for task in tasks] == [
+        ("0", 1),
+        ("1", 1),
+        ("2", 1),
+    ]
+    assert [task.key for task in task_queue.lease("b", count=3)] == ["3", "4"]
+    assert task_queue.get_stats()["leased"] == 5
+
+
+def test_redelivery(tmpdir):
+    task_queue = TaskQueue(str(tmpdir), partitions=2, lease_s=0.1, max_deliveries=2)
+    task_queue.put("1", "one")
+    (first,) = task_queue.lease("a")
+    sleep(0.2)
+    (second,) = task_queue.lease("b")
+    assert second.deliveries == 2
+    assert not task_queue.ack(first, "a")
+    sleep(0.2)
+    assert task_queue.lease("c") == []
+    assert task_queue.get_stats()["dead"] == 1
+
+
+def test_release(tmpdir):
+    task_queue = TaskQueue(str(tmpdir), partitions=2)
+    task_queue.put("1", "one")
+    (task,) = task_queue.lease("a")
+    task_queue.release(task, "b")
+    assert task_queue.lease("b") == []
+    task_queue.release(task, "a")
+    assert task_queue.lease("b")[0].deliveries == 2
+
+
+def test_ready_at_and_defer(tmpdir):
+    task_queue = TaskQueue(str(tmpdir), partitions=2)
+    task_queue.put("1", "one", ready_at=time() + 60)
+    assert task_queue.lease("a") == []
+    assert task_queue.get_stats()["later"] == 1
+    task_queue.put("2", "two")
+
+    def handler(payload):
+        raise TaskDeferred(time() + 0.1)
+
+    worker = TaskWorker(task_queue, handler)
+    assert worker.run_once()
+    assert task_queue.get_stats()["later"] == 2
+    sleep(0.2)
+    (task,) = task_queue.lease("b")
+    assert (task.key, task.deliveries) == ("2", 1)
+
+
+def test_workers_handle_each_task_once(tmpdir, monkeypatch):
+    monkeypatch.setattr("taskqueue.report_error", lambda message, **fields: None)
+    task_queue = TaskQueue(str(tmpdir), partitions=4)
+    for i in range(200):
+        task_queue.put(str(i), str(i))
+
+    handled = []
+    lock = Lock()
+
+    def handler(payload):
+        if payload == "13" and "13" not in failed:
+            failed.append(payload)
+            raise ValueError(payload)
+        with lock:
+            handled.append(payload)
+
+    failed = []
+    stop_event = Event()
+    workers = [TaskWorker(task_queue, handler, worker_id) for worker_id in range(4)]
+    threads = [Thread(target=worker.run, args=[stop_event]) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for _ in range(100):
+        if task_queue.get_stats()["done"] == 200:
+            break
+        sleep(0.1)
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(handled, key=int) == [str(i) for i in range(200)]
+    assert sum(worker.failed for worker in workers) == 1
+
+
+def test_pool_handles_each_task_once(tmpdir):
+    task_queue = TaskQueue(str(tmpdir), partitions=4)
+    for i in range(200):
+        task_queue.put(str(i), str(i))
+
+    handled = []
+    lock = Lock()
+
+    def handler(payload):
+        sleep(0.001)
+        with lock:
+            handled.append(payload)
+
+    pool = TaskPool(task_queue, handler, 8)
+    stop_event = Event()
+    thread = Thread(target=pool.run, args=[stop_event])
+    thread.start()
+    for _ in range(100):
+        if task_queue.get_stats()["done"] == 200:
+            break
+        sleep(0.1)
+    stop_event.set()
+    thread.join()
+
+    assert sorted(handled, key=int) == [str(i) for i in range(200)]
+    assert pool.worker.handled == 200
+
+
+def test_pool_backs_off_when_idle(tmpdir, monkeypatch):
+    monkeypatch.setattr("taskqueue.TASKQUEUE_MAX_POLL_S", 0.4)
+    task_queue = TaskQueue(str(tmpdir), partitions=4)
+    polls = []
+    lease = task_queue.lease
+
+    def count_lease(owner, count=1, start=0):
+        polls.append(count)
+        return lease(owner, count, start)
+
+    monkeypatch.setattr(task_queue, "lease", count_lease)
+    pool = TaskPool(task_queue, lambda payload: None, 100)
+    stop_event = Event()
+    thread = Thread(target=pool.run, args=[stop_event])
+    thread.start()
+    sleep(1.5)
+    idle_polls = len(polls)
+    task_queue.put("1", "one")
+    sleep(0.6)
+    stop_event.set()
+    thread.join()
+
+    assert 4 <= idle_polls <= 7
+    assert polls[:idle_polls] == [100] * idle_polls
+    assert task_queue.get_stats()["done"] == 1